@@ -1,17 +1,94 @@
 import os
-
-from PIL import Image
+import tempfile
 
 MAX_UPLOAD_SIZE = os.getenv("MAX_UPLOAD_SIZE", 10_000_000)  # Bytes.
 # Maximum number of concurrent transform operations.
-TRANSFORM_WORKERS = os.getenv("TRANSFORM_WORKERS", 10)
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", 10))
+# Worker processes of each transformation service (0 transforms in the request thread),
+# the number of jobs which may wait for a free process and the timeout of each job.
+TRANSFORM_PROCESSES = int(os.getenv("TRANSFORM_PROCESSES", 0))
+TRANSFORM_QUEUE_SIZE = int(os.getenv("TRANSFORM_QUEUE_SIZE", TRANSFORM_PROCESSES * 2))
+TRANSFORM_TIMEOUT = float(os.getenv("TRANSFORM_TIMEOUT", 20))  # Seconds.
+TRANSFORM_RETRY_AFTER = int(os.getenv("TRANSFORM_RETRY_AFTER", 1))  # Seconds.
+# Maximum number of entries of a single bulk request processed concurrently.
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", TRANSFORM_WORKERS))
+BULK_ENTRY_TIMEOUT = float(os.getenv("BULK_ENTRY_TIMEOUT", 60))  # Seconds.
+# Images of a single batch upload and uploads validated and stored concurrently (shared
+# by every batch request of the process).
+MAX_BATCH_UPLOAD_ITEMS = int(os.getenv("MAX_BATCH_UPLOAD_ITEMS", 100))
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv("BATCH_UPLOAD_CONCURRENCY", TRANSFORM_WORKERS))
+# Maximum number of concurrent requests to each transformation service.
+SERVICE_CONCURRENCY = int(os.getenv("SERVICE_CONCURRENCY", TRANSFORM_WORKERS))
+# Retries of inter-service requests on connection errors and 502, 503 and 504.
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.2))  # Seconds.
+
+# Where to run transformations: "remote" sends every step to its service, "local"
+# runs the steps available in-process on a single decoded image.
+TRANSFORM_MODE = os.getenv("TRANSFORM_MODE", "remote")
+
+# Decode JPEGs at a reduced scale for thumbnails and reduce them in integer steps
+# until they are this many times larger than the thumbnail (0 disables both).
+THUMBNAIL_REDUCING_GAP = float(os.getenv("THUMBNAIL_REDUCING_GAP", 2.0)) or None
+# Use the preview embedded in the EXIF data when it's large enough.
+THUMBNAIL_USE_EXIF = os.getenv("THUMBNAIL_USE_EXIF", "1") == "1"
+
+# Encoders hold every frame of an animation in memory. Larger animations are rejected,
+# the total counts the pixels of every frame.
+MAX_ANIMATION_FRAMES = int(os.getenv("MAX_ANIMATION_FRAMES", 1000))
+MAX_ANIMATION_PIXELS = int(os.getenv("MAX_ANIMATION_PIXELS", 250_000_000))
+
+# Images with more pixels are rejected (413) based on their header, before they are
+# decoded. Requested output sizes (thumbnails, image sets) are capped per dimension.
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))
+MAX_OUTPUT_DIMENSION = int(os.getenv("MAX_OUTPUT_DIMENSION", 8192))
+# Megapixels each process may decode at the same time (0 disables the limit). Requests
+# wait for their share up to the timeout, then they are rejected (429).
+DECODE_BUDGET = float(os.getenv("DECODE_BUDGET", 200))  # Megapixels.
+DECODE_BUDGET_TIMEOUT = float(os.getenv("DECODE_BUDGET_TIMEOUT", 5))  # Seconds.
+
+# Encoding profile used unless a request asks for a different one, see
+# ProgImage.formats.encoding_profiles.
+ENCODING_PROFILE = os.getenv("ENCODING_PROFILE", "balanced")
 
+# In-process LRU cache for converted and transformed images (derivatives).
+DERIVATIVE_CACHE_SIZE = int(os.getenv("DERIVATIVE_CACHE_SIZE", 64_000_000))  # Bytes.
+# Larger derivatives are only kept in the storage tier.
+DERIVATIVE_CACHE_ITEM_SIZE = int(
+    os.getenv("DERIVATIVE_CACHE_ITEM_SIZE", 4_000_000)
+)  # Bytes.
+# Persist derivatives via the storage engine so they are shared between processes.
+DERIVATIVE_CACHE_STORAGE = os.getenv("DERIVATIVE_CACHE_STORAGE", "1") == "1"
+# Concurrent requests for the same derivative share a single computation. With a lock
+# directory on the local disk they are also coalesced across the worker processes of a
+# host, which find each other's results in the storage tier of the derivative cache.
+SINGLEFLIGHT_LOCK_DIR = os.getenv("SINGLEFLIGHT_LOCK_DIR") or None
+# Number of image metadata records kept in memory.
+METADATA_INDEX_SIZE = int(os.getenv("METADATA_INDEX_SIZE", 100_000))
+# Store uploads content-addressed: identical images share a single id and blob, so
+# duplicate uploads aren't stored again.
+STORAGE_DEDUPLICATE = os.getenv("STORAGE_DEDUPLICATE", "0") == "1"
+# Uploads are spooled to disk above this size while their hash is computed.
+UPLOAD_SPOOL_SIZE = int(os.getenv("UPLOAD_SPOOL_SIZE", 1_000_000))  # Bytes.
 
-def get_format_for_mimetype(mimetype: str) -> str:
-    Image.init()  # Explicitly initialise PIL so it knows all available formats.
 
-    for image_format, image_mimetype in Image.MIME.items():
-        if image_mimetype == mimetype:
-            return image_format
+# Derivatives generated in the background right after an upload, so the first request
+# for them is a storage read. Presets are separated by ";", each one is the part of a
+# download URL after the image id, e.g. "?thumbnail-size=200*200;.webp?rotate-angle=90"
+# (without an extension the original's format is kept). Uploads can override them
+# with "eager" query parameters.
+EAGER_PRESETS = [
+    preset.strip() for preset in os.getenv("EAGER_PRESETS", "").split(";")
+    if preset.strip()
+]
+# The queue of eager derivatives is kept in an SQLite database on the local disk.
+EAGER_QUEUE_PATH = os.getenv(
+    "EAGER_QUEUE_PATH", os.path.join(tempfile.gettempdir(), "progimage-eager.sqlite3")
+)
+# Background threads generating eager derivatives in each process.
+EAGER_WORKERS = int(os.getenv("EAGER_WORKERS", 2))
 
-    raise ValueError(f'MIME type "{mimetype}" is not supported.')
+# Record request and processing stage metrics, exposed on /metrics of every service.
+METRICS_ENABLED = os.getenv("METRICS", "1") == "1"
+# Add the durations of the processing stages of each request in a Server-Timing header.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from types import ModuleType
+from typing import Optional, Tuple, Dict
+
+from .formats import get_profile_name
+from .metrics import timed
+
+
+def derivative_key(
+    image_id: str,
+    mimetype: str,
+    transformations: str = "",
+    profile: Optional[str] = None,
+) -> str:
+    # Derivative ids are prefixed with the original's id, so they are easy to find
+    # (e.g. for clean up) and can never clash with a generated uuid. The effective
+    # encoding profile is part of the key, so changing ENCODING_PROFILE doesn't serve
+    # derivatives encoded with the previous one.
+    profile = get_profile_name(profile)
+    digest = hashlib.sha256(
+        f"{image_id}\n{mimetype}\n{transformations}\n{profile}".encode("utf-8")
+    ).hexdigest()
+    return f"{image_id}--{digest[:32]}"
+
+
+# Two-tier cache of converted and transformed images. The front tier is an in-process
+# LRU bounded by the total size of the cached contents, the back tier is the storage
+# engine (if one is given) so derivatives are shared between workers and survive
+# restarts.
+class DerivativeCache:
+    def __init__(
+        self,
+        max_size: int,
+        max_item_size: Optional[int] = None,
+        storage: Optional[ModuleType] = None,
+    ):
+        self.max_size = max_size
+        self.max_item_size = max_item_size if max_item_size is not None else max_size
+        self.storage = storage
+
+        self._items: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("hits", "storage_hits", "misses", "evictions"), 0
+        )
+
+    def get(self, key: str, use_storage: bool = True) -> Optional[Tuple[bytes, str]]:
+        # Without use_storage, only the front tier is probed. That isn't counted as a
+        # miss, the caller looks the key up again with the storage tier.
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self._counters["hits"] += 1
+                return item
+        if not use_storage:
+            return None
+
+        if self.storage is not None:
+            try:
+                with timed("storage_retrieve", "derivatives"):
+                    item = self.storage.retrieve(image_id=key)
+            except FileNotFoundError:
+                pass
+            else:
+                self._remember(key, item)
+                with self._lock:
+                    self._counters["storage_hits"] += 1
+                return item
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key: str, contents: bytes, mimetype: str):
+        if self.storage is not None:
+            with timed("storage_store", "derivatives"):
+                self.storage.store(contents=contents, mimetype=mimetype, image_id=key)
+        self._remember(key, (contents, mimetype))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, items=len(self._items), size=self._size)
+
+    def _remember(self, key: str, item: Tuple[bytes, str]):
+        item_size = len(item[0])
+        if item_size > self.max_item_size:
+            return
+
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+
+            self._items[key] = item
+            self._size += item_size
+
+            while self._size > self.max_size:
+                _, (evicted_contents, _) = self._items.popitem(last=False)
+                self._size -= len(evicted_contents)
+                self._counters["evictions"] += 1
+
+
+# In-memory LRU index of image metadata records, bounded by the number of records.
+class MetadataIndex:
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+
+        self._items: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_id: str) -> Optional[dict]:
+        with self._lock:
+            metadata = self._items.get(image_id)
+            if metadata is not None:
+                self._items.move_to_end(image_id)
+            return metadata
+
+    def put(self, image_id: str, metadata: dict):
+        with self._lock:
+            self._items[image_id] = metadata
+            self._items.move_to_end(image_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
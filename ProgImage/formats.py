@@ -0,0 +1,252 @@
+import mimetypes
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Union, NamedTuple
+
+from PIL import ExifTags, Image, ImageSequence
+
+from . import ENCODING_PROFILE, MAX_ANIMATION_FRAMES, MAX_ANIMATION_PIXELS
+from .metrics import timed
+
+# The registry below is built once at import time instead of initialising PIL and
+# scanning its MIME types on every lookup.
+Image.init()  # Explicitly initialise PIL so it knows all available formats.
+
+format_mimetypes: Dict[str, str] = dict(Image.MIME)
+
+mimetype_formats: Dict[str, str] = {}
+for _image_format, _mimetype in Image.MIME.items():
+    mimetype_formats.setdefault(_mimetype, _image_format)
+
+# Extensions (with the leading dot) of every format known to PIL.
+extension_formats: Dict[str, str] = dict(Image.registered_extensions())
+
+mimetype_extensions: Dict[str, str] = {}
+for _extension, _image_format in extension_formats.items():
+    _mimetype = format_mimetypes.get(_image_format)
+    if _mimetype and _mimetype not in mimetype_extensions:
+        mimetype_extensions[_mimetype] = (
+            mimetypes.guess_extension(_mimetype) or _extension
+        )
+
+# Formats PIL can write, only these can be conversion or transformation targets.
+saveable_formats = frozenset(Image.SAVE)
+# Formats which keep the animation of animated images, others keep the first frame.
+animation_formats = frozenset(Image.SAVE_ALL) & {"GIF", "PNG", "WEBP"}
+
+
+class EncodingProfile(NamedTuple):
+    # Options passed to PIL when encoding each format.
+    encoder_options: Dict[str, dict]
+    # Drop EXIF data (except for the orientation) and ICC profiles from the output.
+    strip_metadata: bool
+
+
+encoding_profiles: Dict[str, EncodingProfile] = {
+    # Cheapest to encode, for latency sensitive requests.
+    "fast": EncodingProfile(
+        encoder_options={
+            "JPEG": {"quality": 80, "subsampling": "4:2:0"},
+            "PNG": {"compress_level": 1},
+            "WEBP": {"quality": 80, "method": 0},
+            "AVIF": {"quality": 60, "speed": 10},
+        },
+        strip_metadata=True,
+    ),
+    "balanced": EncodingProfile(
+        encoder_options={
+            "JPEG": {
+                "quality": 80,
+                "optimize": True,
+                "progressive": True,
+                "subsampling": "4:2:0",
+            },
+            "PNG": {"compress_level": 6},
+            "WEBP": {"quality": 80, "method": 4},
+            "AVIF": {"quality": 60, "speed": 6},
+        },
+        strip_metadata=False,
+    ),
+    # Smallest output at a higher encoding cost, for bandwidth sensitive clients.
+    "small": EncodingProfile(
+        encoder_options={
+            "JPEG": {
+                "quality": 70,
+                "optimize": True,
+                "progressive": True,
+                "subsampling": "4:2:0",
+            },
+            "PNG": {"compress_level": 9},
+            "WEBP": {"quality": 70, "method": 6},
+            "AVIF": {"quality": 50, "speed": 4},
+        },
+        strip_metadata=True,
+    ),
+}
+
+# Formats whose PIL plugins read the "exif" and "icc_profile" encoder options.
+metadata_formats = frozenset(("JPEG", "PNG", "WEBP", "TIFF", "AVIF"))
+
+
+def get_format_for_mimetype(mimetype: str) -> str:
+    try:
+        return mimetype_formats[mimetype]
+    except KeyError:
+        raise ValueError(f'MIME type "{mimetype}" is not supported.')
+
+
+def get_mimetype_for_format(image_format: str) -> str:
+    try:
+        return format_mimetypes[image_format]
+    except KeyError:
+        raise ValueError(f'Image format "{image_format}" is not supported.')
+
+
+@lru_cache(maxsize=None)
+def _get_mimetype_for_extension(extension: str) -> Optional[str]:
+    mimetype, _ = mimetypes.guess_type(f"image{extension}")
+    if not mimetype and extension in extension_formats:
+        mimetype = format_mimetypes.get(extension_formats[extension])
+    return mimetype
+
+
+def get_mimetype_for_path(path: Union[str, Path]) -> Optional[str]:
+    return _get_mimetype_for_extension(Path(path).suffix.lower())
+
+
+def get_extension_for_mimetype(mimetype: str) -> str:
+    return mimetype_extensions.get(mimetype, "")
+
+
+def is_saveable(image_format: str) -> bool:
+    return image_format in saveable_formats
+
+
+def get_profile_name(name: Optional[str] = None) -> str:
+    # The profile images are encoded with, ENCODING_PROFILE unless one is requested.
+    return name or ENCODING_PROFILE
+
+
+def get_encoding_profile(name: Optional[str] = None) -> EncodingProfile:
+    name = get_profile_name(name)
+    try:
+        return encoding_profiles[name]
+    except KeyError:
+        raise ValueError(
+            f'Unknown encoding profile "{name}". '
+            f"Choose one from: {', '.join(encoding_profiles)}"
+        )
+
+
+def is_animated(image: Image.Image) -> bool:
+    return getattr(image, "is_animated", False)
+
+
+def _save_animation(
+    image: Image.Image,
+    fp: BytesIO,
+    image_format: str,
+    options: dict,
+    transform: Optional[Callable[[Image.Image], Image.Image]],
+):
+    if (
+        image.n_frames > MAX_ANIMATION_FRAMES
+        or image.n_frames * image.width * image.height > MAX_ANIMATION_PIXELS
+    ):
+        raise ValueError(
+            f"Animations are limited to {MAX_ANIMATION_FRAMES} frames and "
+            f"{MAX_ANIMATION_PIXELS} pixels in total."
+        )
+
+    # Frames are decoded and transformed as the encoder consumes them, but the GIF,
+    # APNG and WebP encoders keep every frame until the animation is written.
+    # Durations are only known once a frame is loaded, the encoders look each one up
+    # after taking its frame.
+    durations = []
+
+    def get_frames() -> Iterator[Image.Image]:
+        for frame in ImageSequence.Iterator(image):
+            frame = frame.copy()
+            durations.append(frame.info.get("duration", 0))
+            if image_format != "GIF":
+                # The first frame of GIFs is usually "P" and the others "RGB", the
+                # other encoders can't mix modes.
+                frame = frame.convert("RGBA")
+            yield transform(frame) if transform else frame
+
+    frames = get_frames()
+    first_frame = next(frames)
+    if image_format == "PNG":
+        frames = list(frames)  # The APNG encoder iterates the frames twice.
+    first_frame.save(
+        fp,
+        format=image_format,
+        save_all=True,
+        append_images=frames,
+        duration=durations,
+        loop=image.info.get("loop", 0),
+        **options,
+    )
+
+
+def _get_orientation_exif(image: Image.Image) -> bytes:
+    # EXIF data with only the orientation of the image, without it oriented images
+    # would be displayed sideways or upside down.
+    orientation = image.getexif().get(ExifTags.Base.Orientation)
+    if orientation in (None, 1):
+        return b""
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    return exif.tobytes()
+
+
+def encode_image(
+    image: Image.Image,
+    image_format: str,
+    profile: Optional[str] = None,
+    transform: Optional[Callable[[Image.Image], Image.Image]] = None,
+) -> bytes:
+    # The transform is applied to every frame of animated images, or to the image.
+    if not is_saveable(image_format):
+        raise ValueError(f'Saving images as "{image_format}" is not supported.')
+
+    encoding_profile = get_encoding_profile(profile)
+    options = dict(encoding_profile.encoder_options.get(image_format, {}))
+    strips_metadata = (
+        image_format in metadata_formats and encoding_profile.strip_metadata
+    )
+    if image_format in metadata_formats:
+        if strips_metadata:
+            options.update(exif=b"", icc_profile=None)
+        else:
+            options.setdefault("exif", image.info.get("exif", b""))
+            options.setdefault("icc_profile", image.info.get("icc_profile"))
+
+    contents = BytesIO()
+    if is_animated(image) and image_format in animation_formats:
+        # Frames are decoded and transformed while they are encoded.
+        if strips_metadata:
+            options["exif"] = _get_orientation_exif(image)
+        with timed("encode", image_format):
+            _save_animation(image, contents, image_format, options, transform)
+    else:
+        # Transformations decode lazily opened images themselves, e.g. thumbnails of
+        # JPEGs at a reduced scale, so decoding is timed as part of them.
+        if transform:
+            with timed("transform", image.format or ""):
+                transformed_image = transform(image)
+            # Transformations may update the EXIF data, e.g. auto-orientation removes
+            # the orientation.
+            keeps_metadata = image_format in metadata_formats and not strips_metadata
+            if keeps_metadata and "exif" in transformed_image.info:
+                options["exif"] = transformed_image.info["exif"]
+            image = transformed_image
+        else:
+            with timed("decode", image.format or ""):
+                image.load()
+        if strips_metadata:
+            options["exif"] = _get_orientation_exif(image)
+        with timed("encode", image_format):
+            image.save(contents, format=image_format, **options)
+    return contents.getvalue()
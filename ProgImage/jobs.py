@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, Union
+
+
+class Job(NamedTuple):
+    id: int
+    payload: Any
+    enqueued_at: float
+    attempts: int
+
+
+# Durable FIFO queue of background jobs in a local SQLite database, so queued jobs
+# survive restarts. It can be shared by the processes of a host: a job is claimed in a
+# transaction, and a claim expires after the lease (e.g. its process was killed).
+class JobQueue:
+    def __init__(
+        self, path: Union[str, Path], lease: float = 300, max_attempts: int = 3
+    ):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        self._initialised = False
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    def put(self, payloads: Iterable[Any]) -> int:
+        now = time.time()
+        rows = [(json.dumps(payload), now) for payload in payloads]
+        if not rows:
+            return 0
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO jobs (payload, enqueued_at) VALUES (?, ?)", rows
+            )
+        return len(rows)
+
+    def claim(self) -> Optional[Job]:
+        now = time.time()
+        with self._transaction() as connection:
+            # Jobs whose last attempt expired (e.g. its process kept being killed) are
+            # dropped, like failed jobs which ran out of attempts.
+            dropped = connection.execute(
+                "DELETE FROM jobs WHERE claimed_at < ? AND attempts >= ?",
+                (now - self.lease, self.max_attempts),
+            ).rowcount
+            row = connection.execute(
+                "SELECT id, payload, enqueued_at, attempts FROM jobs "
+                "WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT 1",
+                (now - self.lease,),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET claimed_at = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (now, row[0]),
+                )
+
+        if dropped:
+            with self._lock:
+                self._dropped += dropped
+        if row is None:
+            return None
+        return Job(row[0], json.loads(row[1]), row[2], row[3] + 1)
+
+    def complete(self, job: Job):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def release(self, job: Job) -> bool:
+        # Makes a failed job available again, returns False if it was dropped because
+        # it ran out of attempts.
+        with self._transaction() as connection:
+            if job.attempts >= self.max_attempts:
+                connection.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+                return False
+            connection.execute(
+                "UPDATE jobs SET claimed_at = NULL WHERE id = ?", (job.id,)
+            )
+            return True
+
+    def stats(self) -> Dict[str, float]:
+        now = time.time()
+        with self._transaction() as connection:
+            depth, oldest, claimed = connection.execute(
+                "SELECT COUNT(*), MIN(enqueued_at), "
+                "COUNT(CASE WHEN claimed_at >= ? THEN 1 END) FROM jobs",
+                (now - self.lease,),
+            ).fetchone()
+        with self._lock:
+            dropped = self._dropped
+        # The lag is the age of the oldest job which hasn't completed yet. Expired
+        # claims aren't in progress anymore, dropped counts the jobs this process
+        # dropped when claiming.
+        return {
+            "depth": depth,
+            "in_progress": claimed,
+            "dropped": dropped,
+            "lag": now - oldest if oldest is not None else 0.0,
+        }
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # Connections aren't shared between threads, each operation opens its own.
+        self._initialise()
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+
+    def _initialise(self):
+        # The database is only created once the queue is used.
+        with self._lock:
+            if self._initialised:
+                return
+
+            os.makedirs(str(self.path.parent), exist_ok=True)
+            with closing(self._connect()) as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "payload TEXT NOT NULL, "
+                    "enqueued_at REAL NOT NULL, "
+                    "attempts INTEGER NOT NULL DEFAULT 0, "
+                    "claimed_at REAL)"
+                )
+            self._initialised = True
@@ -0,0 +1,115 @@
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, Iterator
+
+from PIL import Image, UnidentifiedImageError
+
+from . import (
+    DECODE_BUDGET,
+    DECODE_BUDGET_TIMEOUT,
+    MAX_IMAGE_PIXELS,
+    MAX_OUTPUT_DIMENSION,
+)
+from .metrics import decoded_pixels
+
+# PIL warns about images above its limit and refuses to open those with more than
+# twice as many pixels, which catches images that are opened without a check below.
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class DecodeBudgetExceeded(Exception):
+    pass
+
+
+# Errors of images that mustn't be decoded, PIL raises its own for decompression bombs.
+TOO_LARGE_ERRORS = (ImageTooLarge, Image.DecompressionBombError)
+
+
+def check_image(image: Image.Image):
+    # Only needs the header, i.e. a lazily opened image.
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(
+            f"Image has {image.width * image.height:,} pixels, "
+            f"images are limited to {MAX_IMAGE_PIXELS:,} pixels."
+        )
+
+
+def check_output_size(width: int, height: int):
+    if width > MAX_OUTPUT_DIMENSION or height > MAX_OUTPUT_DIMENSION:
+        raise ValueError(
+            f"Output size must not exceed {MAX_OUTPUT_DIMENSION} pixels per dimension."
+        )
+
+
+# Bounds the pixels of the images decoded at the same time in a process, so memory
+# stays bounded under bursts of large images. An image larger than the whole budget
+# waits until it is the only one.
+class PixelBudget:
+    def __init__(self, max_pixels: int, timeout: float):
+        self.max_pixels = max_pixels
+        self.timeout = timeout
+
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, pixels: int) -> Iterator[None]:
+        if not self.max_pixels:
+            yield
+            return
+
+        pixels = min(pixels, self.max_pixels)
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._in_use + pixels <= self.max_pixels, self.timeout
+            ):
+                raise DecodeBudgetExceeded(
+                    "Too many images are being processed, retry later."
+                )
+            self._in_use += pixels
+        decoded_pixels.inc(pixels)
+
+        try:
+            yield
+        finally:
+            decoded_pixels.dec(pixels)
+            with self._condition:
+                self._in_use -= pixels
+                self._condition.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {"in_use": self._in_use, "max": self.max_pixels}
+
+
+pixel_budget = PixelBudget(int(DECODE_BUDGET * 1_000_000), DECODE_BUDGET_TIMEOUT)
+
+
+@contextmanager
+def admit(image: Image.Image) -> Iterator[None]:
+    # Checks the header of a lazily opened image and holds its share of the decode
+    # budget while the caller decodes it. Conversions of animations hold every frame.
+    check_image(image)
+    frames = image.n_frames if getattr(image, "is_animated", False) else 1
+    with pixel_budget.reserve(frames * image.width * image.height):
+        yield
+
+
+@contextmanager
+def admit_contents(contents: bytes) -> Iterator[None]:
+    # Contents PIL can't identify aren't admitted, the transformation rejects them.
+    try:
+        image = Image.open(BytesIO(contents))
+    except UnidentifiedImageError:
+        image = None
+
+    if image is None:
+        yield
+        return
+    with image, admit(image):
+        yield
@@ -0,0 +1,248 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from flask import Flask, Response, g, request
+
+from . import METRICS_ENABLED, SERVER_TIMING
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds of the buckets of duration histograms, in seconds.
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_labels(label_names: Sequence[str], key: Tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+    labels = ",".join(
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"),
+        )
+        for name, value in zip(label_names, key)
+    )
+    return "{" + labels + "}"
+
+
+# Metrics in the Prometheus text format, without the client library. They are kept per
+# process, with several workers every process is scraped on its own. All updates are
+# skipped when METRICS is disabled.
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: Tuple[str, ...], value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            # Counts per bucket (not cumulative, the last one is +Inf), sum, count.
+            counts, total, count = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0, 0)
+            )
+            index = next(
+                (i for i, bound in enumerate(self.buckets) if value <= bound),
+                len(self.buckets),
+            )
+            counts = list(counts)
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _render_value(self, key: Tuple[str, ...], value) -> List[str]:
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.label_names + ("le",), key + (str(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+registry: Dict[str, Metric] = {}
+
+stage_duration = Histogram(
+    "progimage_stage_duration_seconds",
+    "Duration of the stages of image processing, the target is the storage engine, "
+    "image format or transformation service.",
+    ("stage", "target"),
+)
+request_duration = Histogram(
+    "progimage_request_duration_seconds",
+    "Duration of HTTP requests, including writing the response.",
+    ("endpoint", "method", "status"),
+)
+request_bytes = Counter(
+    "progimage_request_bytes_total", "Bytes received in request bodies.", ("endpoint",)
+)
+response_bytes = Counter(
+    "progimage_response_bytes_total",
+    "Bytes sent in response bodies (of known length).",
+    ("endpoint",),
+)
+errors = Counter("progimage_errors_total", "Errors by exception type.", ("type",))
+bulk_entries = Gauge(
+    "progimage_bulk_entries",
+    "Entries of bulk requests waiting for a worker (queued) or being transformed.",
+    ("state",),
+)
+decoded_pixels = Gauge(
+    "progimage_decoded_pixels",
+    "Pixels of the images being decoded, bounded by DECODE_BUDGET.",
+)
+
+# Durations of the stages of the current request, for the Server-Timing header.
+_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "timings", default=None
+)
+
+
+@contextmanager
+def timed(stage: str, target: str = ""):
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=stage, target=target)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((stage, duration))
+
+
+def render() -> str:
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _get_server_timing(timings: List[Tuple[str, float]], total: float) -> str:
+    # Stages that ran several times are summed up, e.g. frames or storage reads.
+    durations: Dict[str, float] = {}
+    for stage, duration in timings:
+        durations[stage] = durations.get(stage, 0.0) + duration
+    durations["total"] = total
+    return ", ".join(
+        f"{stage};dur={duration * 1000:.1f}" for stage, duration in durations.items()
+    )
+
+
+def init_app(app: Flask):
+    # Adds the /metrics endpoint and records the duration and size of every request.
+    @app.route("/metrics", methods=["GET"])
+    def metrics() -> Response:
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_token = _timings.set([])
+
+    @app.after_request
+    def record_request(response: Response) -> Response:
+        if "metrics_start" not in g:
+            return response
+
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        start = g.metrics_start
+        timings = _timings.get() or []
+        _timings.reset(g.metrics_token)
+
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = _get_server_timing(
+                timings, time.perf_counter() - start
+            )
+
+        request_bytes.inc(request.content_length or 0, endpoint=endpoint)
+        response_bytes.inc(response.content_length or 0, endpoint=endpoint)
+        labels = dict(
+            endpoint=endpoint, method=request.method, status=response.status_code
+        )
+        response.call_on_close(
+            lambda: request_duration.observe(time.perf_counter() - start, **labels)
+        )
+        return response
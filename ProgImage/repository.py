@@ -1,56 +1,334 @@
+import hashlib
 import os
-from importlib import import_module
+import struct
+import time
+from contextlib import closing
 from io import BytesIO
-from mimetypes import guess_extension, guess_type
 from pathlib import Path
-from typing import Union, Tuple
+from tempfile import SpooledTemporaryFile
+from typing import Union, Tuple, BinaryIO, Optional, Dict, List, Sequence
 
-from PIL import Image, UnidentifiedImageError
+from PIL import Image
 
-from . import MAX_UPLOAD_SIZE, get_format_for_mimetype
+from . import (
+    MAX_UPLOAD_SIZE,
+    DERIVATIVE_CACHE_SIZE,
+    DERIVATIVE_CACHE_ITEM_SIZE,
+    DERIVATIVE_CACHE_STORAGE,
+    EAGER_QUEUE_PATH,
+    METADATA_INDEX_SIZE,
+    SINGLEFLIGHT_LOCK_DIR,
+    UPLOAD_SPOOL_SIZE,
+)
+from .cache import DerivativeCache, MetadataIndex, derivative_key
+from .jobs import JobQueue
+from .limits import admit, check_image
+from .metrics import timed
+from .singleflight import SingleFlight
+from .storage import LazyEngine
+from .formats import (
+    encode_image,
+    get_extension_for_mimetype,
+    get_format_for_mimetype,
+    get_mimetype_for_format,
+    get_mimetype_for_path,
+    is_saveable,
+)
+
+# PIL only needs the header to identify an image. Start with a small chunk and read
+# more only for images with large headers (e.g. big EXIF blocks or ICC profiles).
+# Images still not identified from MAX_SNIFF_SIZE bytes are read from the whole upload.
+SNIFF_SIZE = 64 * 1024  # Bytes.
+MAX_SNIFF_SIZE = 1024 * 1024  # Bytes.
+CHUNK_SIZE = 64 * 1024  # Bytes.
+EXIF_ORIENTATION = 0x0112
+# Raised by PIL for unknown formats (UnidentifiedImageError is an OSError) and for
+# headers cut off by the sniffed window.
+SNIFF_ERRORS = (OSError, SyntaxError, ValueError, struct.error)
 
 storage_engine_type = os.getenv("STORAGE", "file")
-try:
-    storage_engine = import_module(
-        name=f".storage.{storage_engine_type}", package="ProgImage"
-    )
-except ModuleNotFoundError as error:
-    raise ValueError("Invalid storage engine type. Choose one from: file, s3")
+# The engine is only imported once it's used, services which never access the storage
+# (e.g. transformations of uploaded images) start without it.
+storage_engine = LazyEngine(storage_engine_type)
+
+derivative_cache = DerivativeCache(
+    max_size=DERIVATIVE_CACHE_SIZE,
+    max_item_size=DERIVATIVE_CACHE_ITEM_SIZE,
+    storage=storage_engine if DERIVATIVE_CACHE_STORAGE else None,
+)
+metadata_index = MetadataIndex(max_items=METADATA_INDEX_SIZE)
+# Coalesces concurrent computations of the same derivative.
+derivative_flights = SingleFlight(lock_dir=SINGLEFLIGHT_LOCK_DIR)
+# Eager derivatives of new uploads, generated by the workers of the repository service.
+eager_queue = JobQueue(EAGER_QUEUE_PATH)
+
+
+def parse_image_path(image_path: Union[str, Path]) -> Tuple[str, str]:
+    image_path = Path(image_path)
+    requested_mimetype = get_mimetype_for_path(image_path)
+    if not requested_mimetype:
+        raise ValueError("Requested MIME type is unknown.")
+
+    return str(image_path.with_suffix("")), requested_mimetype
+
+
+def _get_orientation(image: Image.Image) -> Optional[int]:
+    # Image.getexif of PNGs without an eXIf chunk in the header decodes the whole image
+    # to look for one after the pixels, which fails on a sniffed header. The base
+    # implementation only reads the EXIF data (and TIFF tags) already parsed.
+    return Image.Image.getexif(image).get(EXIF_ORIENTATION)
+
+
+class UploadStream:
+    # Read-only stream that enforces the upload size limit while the contents are
+    # passed on, and allows peeking at the beginning of the stream.
+    def __init__(self, stream: BinaryIO, max_size: int):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self._buffer = b""
+        self._exhausted = False
+
+    def peek(self, size: int) -> bytes:
+        while len(self._buffer) < size and not self._exhausted:
+            chunk = self._read_raw(size - len(self._buffer))
+            self._buffer += chunk
+        return self._buffer[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        if self._buffer:
+            if size is None or size < 0:
+                contents, self._buffer = self._buffer + self._read_raw(-1), b""
+            else:
+                contents, self._buffer = self._buffer[:size], self._buffer[size:]
+            return contents
+
+        return self._read_raw(size)
+
+    def _read_raw(self, size: int) -> bytes:
+        if self._exhausted:
+            return b""
+
+        chunk = self.stream.read(size if size is not None and size >= 0 else -1)
+        if not chunk or size is None or size < 0:
+            self._exhausted = True
+
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise ValueError(f"Image size must not exceed {self.max_size:,} bytes.")
+
+        return chunk
 
 
 class ImageRepository:
     def __init__(self):
         self.storage = storage_engine
 
-    def store(self, contents: bytes) -> str:
-        if len(contents) > MAX_UPLOAD_SIZE:
-            raise ValueError(f"Image size must not exceed {MAX_UPLOAD_SIZE:,} bytes.")
+    def store(self, contents: bytes, eager: Sequence[str] = ()) -> str:
+        return self.store_stream(BytesIO(contents), eager)
 
-        try:
-            image = Image.open(BytesIO(contents))
-            mimetype = Image.MIME[image.format]
-            image_id = self.storage.store(contents=contents, mimetype=mimetype)
-        except UnidentifiedImageError:
-            raise ValueError("Uploaded file is not an image or format is unknown.")
-
-        return image_id + (guess_extension(mimetype) or "")
-
-    def retrieve(self, image_path: Union[str, Path]) -> Tuple[bytes, str]:
-        image_path = Path(image_path)
-        requested_mimetype, _ = guess_type(image_path)
-        if not requested_mimetype:
-            raise ValueError("Requested MIME type is unknown.")
-
-        contents, original_mimetype = self.storage.retrieve(
-            image_id=image_path.with_suffix("")
+    def store_stream(self, stream: BinaryIO, eager: Sequence[str] = ()) -> str:
+        # Eager presets (see EAGER_PRESETS) are queued once the image is stored.
+        upload = UploadStream(stream, MAX_UPLOAD_SIZE)
+        metadata = self._sniff_metadata(upload)
+
+        # The content hash has to be known before the image is stored, so the upload
+        # is spooled (to disk for larger images) while it's being hashed.
+        with SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as spool:
+            content_hash = hashlib.sha256()
+            for chunk in iter(lambda: upload.read(CHUNK_SIZE), b""):
+                content_hash.update(chunk)
+                spool.write(chunk)
+            spool.seek(0)
+            if metadata is None:
+                metadata = self._read_metadata(spool)
+                spool.seek(0)
+            mimetype = get_mimetype_for_format(metadata["Format"])
+
+            metadata["Content-Length"] = upload.size
+            metadata["Content-Hash"] = content_hash.hexdigest()
+            with timed("storage_store", storage_engine_type):
+                image_id = self.storage.store_stream(
+                    stream=spool, mimetype=mimetype, metadata=metadata
+                )
+
+        metadata_index.put(
+            image_id,
+            dict(
+                metadata,
+                **{"Content-Type": mimetype, "Last-Modified": int(time.time())},
+            ),
         )
-        if requested_mimetype == original_mimetype:
-            return contents, original_mimetype
+        image_path = image_id + get_extension_for_mimetype(mimetype)
+        eager_queue.put({"image": image_path, "preset": preset} for preset in eager)
+        return image_path
+
+    def store_many(self, images: List[bytes]) -> List[str]:
+        # Stores images which are already in memory (e.g. generated derivatives) in a
+        # single batch of the storage engine.
+        batch = []
+        for contents in images:
+            upload = UploadStream(BytesIO(contents), MAX_UPLOAD_SIZE)
+            metadata = self._sniff_metadata(upload) or self._read_metadata(
+                BytesIO(contents)
+            )
+            metadata["Content-Length"] = len(contents)
+            metadata["Content-Hash"] = hashlib.sha256(contents).hexdigest()
+            batch.append(
+                (contents, get_mimetype_for_format(metadata["Format"]), metadata)
+            )
+
+        with timed("storage_store", storage_engine_type):
+            image_ids = self.storage.store_many(batch)
 
-        # Convert image if the requested MIME type is different than the original.
+        image_paths = []
+        last_modified = int(time.time())
+        for image_id, (_, mimetype, metadata) in zip(image_ids, batch):
+            metadata_index.put(
+                image_id,
+                dict(
+                    metadata,
+                    **{"Content-Type": mimetype, "Last-Modified": last_modified},
+                ),
+            )
+            image_paths.append(image_id + get_extension_for_mimetype(mimetype))
+
+        return image_paths
+
+    @staticmethod
+    def _sniff_metadata(upload: UploadStream) -> Optional[dict]:
+        # Returns None if the image isn't identified from the first MAX_SNIFF_SIZE
+        # bytes, but the upload is larger.
+        sniff_size = SNIFF_SIZE
+        while True:
+            header = upload.peek(sniff_size)
+            try:
+                return ImageRepository._get_metadata(BytesIO(header))
+            except SNIFF_ERRORS:
+                if len(header) < sniff_size:
+                    # The whole upload was read.
+                    raise ValueError(
+                        "Uploaded file is not an image or format is unknown."
+                    )
+                if sniff_size >= MAX_SNIFF_SIZE:
+                    return None
+                sniff_size *= 2
+
+    @staticmethod
+    def _read_metadata(fp: BinaryIO) -> dict:
+        try:
+            return ImageRepository._get_metadata(fp)
+        except SNIFF_ERRORS as error:
+            raise ValueError(
+                "Uploaded file is not an image or format is unknown."
+            ) from error
+
+    @staticmethod
+    def _get_metadata(fp: BinaryIO) -> dict:
+        # Image.open is lazy, only the header is parsed here.
+        with Image.open(fp) as image:
+            check_image(image)
+            return {
+                "Format": image.format,
+                "Width": image.width,
+                "Height": image.height,
+                "Mode": image.mode,
+                "Orientation": _get_orientation(image),
+            }
+
+    def metadata(self, image_path: Union[str, Path]) -> dict:
+        image_id = str(Path(image_path).with_suffix(""))
+        metadata = metadata_index.get(image_id)
+        if metadata is None:
+            with timed("storage_metadata", storage_engine_type):
+                metadata = self.storage.retrieve_metadata(image_id=image_id)
+            metadata_index.put(image_id, metadata)
+
+        return metadata
+
+    def retrieve(
+        self, image_path: Union[str, Path], profile: Optional[str] = None
+    ) -> Tuple[bytes, str]:
+        contents, mimetype = self.retrieve_stream(image_path, profile)
+        if not isinstance(contents, bytes):
+            with closing(contents):
+                contents = contents.read()
+
+        return contents, mimetype
+
+    def retrieve_many(self, image_paths: List[str]) -> Dict[str, Tuple[bytes, str]]:
+        # Fetches the originals in a single batch, images which don't exist are left
+        # out. Images requested in another format are converted one by one.
+        image_ids = {
+            image_path: parse_image_path(image_path) for image_path in image_paths
+        }
+        with timed("storage_retrieve", storage_engine_type):
+            originals = self.storage.retrieve_many(
+                list({image_id for image_id, _ in image_ids.values()})
+            )
+
+        images = {}
+        for image_path, (image_id, requested_mimetype) in image_ids.items():
+            if image_id not in originals:
+                continue
+            if originals[image_id][1] == requested_mimetype:
+                images[image_path] = originals[image_id]
+            else:
+                images[image_path] = self.retrieve(image_path)
+
+        return images
+
+    def retrieve_stream(
+        self, image_path: Union[str, Path], profile: Optional[str] = None
+    ) -> Tuple[Union[bytes, BinaryIO], str]:
+        image_id, requested_mimetype = parse_image_path(image_path)
         requested_format = get_format_for_mimetype(requested_mimetype)
-        converted_contents = BytesIO()
-        with Image.open(BytesIO(contents)) as image:
-            image.save(converted_contents, format=requested_format)
 
-        return bytes(converted_contents.getvalue()), requested_mimetype
+        # Originals in the requested format are never cached as derivatives.
+        if self.metadata(image_id)["Content-Type"] == requested_mimetype:
+            # Only opening the stream is timed, the response reads it.
+            with timed("storage_retrieve", storage_engine_type):
+                return self.storage.retrieve_stream(image_id=image_id)
+
+        # Reject unsupported conversions before anything is fetched from the storage.
+        if not is_saveable(requested_format):
+            raise ValueError(f'Conversion to "{requested_mimetype}" is not supported.')
+
+        conversion_key = derivative_key(image_id, requested_mimetype, profile=profile)
+        cached = derivative_cache.get(conversion_key, use_storage=False)
+        if cached:
+            return cached
+
+        return derivative_flights.do(
+            conversion_key,
+            self._convert,
+            image_id,
+            requested_mimetype,
+            profile,
+            conversion_key,
+        )
+
+    def _convert(
+        self,
+        image_id: str,
+        requested_mimetype: str,
+        profile: Optional[str],
+        conversion_key: str,
+    ) -> Tuple[bytes, str]:
+        cached = derivative_cache.get(conversion_key)
+        if cached:
+            return cached
+
+        with timed("storage_retrieve", storage_engine_type):
+            stream, _ = self.storage.retrieve_stream(image_id=image_id)
+        with closing(stream):
+            if not getattr(stream, "seekable", lambda: False)():
+                stream = BytesIO(stream.read())
+
+            with Image.open(stream) as image, admit(image):
+                converted_contents = encode_image(
+                    image, get_format_for_mimetype(requested_mimetype), profile
+                )
+
+        derivative_cache.put(conversion_key, converted_contents, requested_mimetype)
+        return converted_contents, requested_mimetype
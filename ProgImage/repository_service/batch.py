@@ -0,0 +1,64 @@
+import concurrent.futures
+import logging
+from typing import BinaryIO, Callable, Iterator, List, Sequence, Tuple, Union
+
+from requests import RequestException
+
+from .. import BATCH_UPLOAD_CONCURRENCY
+from ..limits import TOO_LARGE_ERRORS
+from ..repository import ImageRepository
+from ..sessions import HTTP_TIMEOUT, get_session
+
+# Shared by every batch upload of the process, so the number of uploads validated and
+# written to the storage engine at the same time is bounded globally.
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=BATCH_UPLOAD_CONCURRENCY, thread_name_prefix="batch-upload"
+)
+
+
+def store_file(stream: BinaryIO, eager: Sequence[str] = ()) -> str:
+    return ImageRepository().store_stream(stream, eager=eager)
+
+
+def store_uri(uri: str, eager: Sequence[str] = ()) -> str:
+    # Downloads share the pooled session for arbitrary hosts (one session per origin
+    # would grow without bound) and are streamed into the storage engine, the upload
+    # size limit applies while reading. URIs aren't checked against private addresses,
+    # see the README.
+    try:
+        with get_session().get(uri, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return ImageRepository().store_stream(response.raw, eager=eager)
+    except RequestException as error:
+        raise ValueError(f"Unable to download image: {error}") from error
+
+
+def upload_entry(store: Callable[[], str]) -> Union[str, dict]:
+    try:
+        return store()
+    except ValueError as error:
+        return {"error": str(error), "status": 400}
+    except TOO_LARGE_ERRORS as error:
+        return {"error": str(error), "status": 413}
+    except Exception:
+        logging.getLogger(__name__).exception("Batch upload entry failed")
+        return {"error": "Upload error.", "status": 500}
+
+
+def run_batch_upload(
+    uploads: List[Callable[[], str]]
+) -> Iterator[Tuple[int, Union[str, dict]]]:
+    # Yields (index, image path or error) pairs as soon as each upload completes. Each
+    # upload is validated from its header and stored by a thread of the pool.
+    futures = {
+        executor.submit(upload_entry, store): index
+        for index, store in enumerate(uploads)
+    }
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # The client went away or the generator was closed early.
+        for future in futures:
+            future.cancel()
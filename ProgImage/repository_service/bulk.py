@@ -0,0 +1,191 @@
+import asyncio
+import concurrent.futures
+import threading
+from collections import deque
+from typing import Any, Dict, Iterator, Tuple, List, Optional
+
+from .transformations import Transformations, TransformationError
+from .. import TRANSFORM_WORKERS, BULK_CONCURRENCY, BULK_ENTRY_TIMEOUT, TRANSFORM_MODE
+from ..limits import TOO_LARGE_ERRORS, DecodeBudgetExceeded
+from ..metrics import bulk_entries
+from ..repository import ImageRepository
+
+# Shared by every bulk request of the process, so the number of transformations in
+# flight is bounded globally and not per request.
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=TRANSFORM_WORKERS, thread_name_prefix="bulk"
+)
+
+
+# Fetches the originals of the entries in batches via retrieve_many: the first entry of
+# a batch fetches the images of the next entries which haven't started yet. Each image
+# is only kept until its entry picks it up, so at most a few batches are in memory.
+class Prefetcher:
+    def __init__(self, image_paths: List[str], batch_size: int):
+        self.batch_size = batch_size
+
+        self._upcoming = deque(image_paths)
+        self._claimed = set()
+        self._batches: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def retrieve(self, image_path: str) -> Tuple[bytes, str]:
+        batch = None
+        with self._lock:
+            future = self._batches.get(image_path)
+            if future is None:
+                future = concurrent.futures.Future()
+                batch = [image_path]
+                while self._upcoming and len(batch) < self.batch_size:
+                    path = self._upcoming.popleft()
+                    if path != image_path and path not in self._claimed:
+                        batch.append(path)
+                self._claimed.update(batch)
+                self._batches.update(dict.fromkeys(batch, future))
+
+        if batch is not None:
+            try:
+                future.set_result(ImageRepository().retrieve_many(batch))
+            except Exception as error:
+                future.set_exception(error)
+
+        try:
+            images = future.result()
+        except Exception:
+            images = {}
+        with self._lock:
+            self._batches.pop(image_path, None)
+
+        if image_path in images:
+            return images.pop(image_path)
+        # Fetched on its own, which raises the error of this entry.
+        return ImageRepository().retrieve(image_path)
+
+
+def transform_entry(
+    image_ref: str,
+    transformations: Transformations,
+    prefetcher: Optional[Prefetcher] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> Any:
+    # A thread can't be interrupted, an entry which timed out keeps running until it
+    # finishes. It only checks whether it was cancelled before transforming the image.
+    try:
+        # Planned without metadata, so the images are only fetched when entries run.
+        transformations = transformations.plan({})
+        if prefetcher is not None and not _is_url(image_ref):
+            image, mimetype = prefetcher.retrieve(image_ref)
+            if cancelled is not None and cancelled.is_set():
+                return _timeout_result()
+            image_path, _ = transformations.apply(image, mimetype)
+        else:
+            image_path, _ = transformations.apply(image_ref)
+        return image_path.decode("utf-8")
+    except ValueError as error:
+        return {"error": str(error), "status": 400}
+    except FileNotFoundError as error:
+        return {"error": str(error), "status": 404}
+    except TOO_LARGE_ERRORS as error:
+        return {"error": str(error), "status": 413}
+    except DecodeBudgetExceeded as error:
+        return {"error": str(error), "status": 429}
+    except TransformationError as error:
+        return {"error": f"Transformation service error: {error}", "status": 502}
+    except Exception:
+        return {"error": "Transformation error.", "status": 500}
+
+
+def _timeout_result() -> dict:
+    return {"error": "Transformation timed out.", "status": 504}
+
+
+def _is_url(image_ref: str) -> bool:
+    return image_ref.startswith("http://") or image_ref.startswith("https://")
+
+
+async def _create_semaphore(value: int) -> asyncio.Semaphore:
+    # The semaphore has to be created within the running loop on Python < 3.10.
+    return asyncio.Semaphore(value)
+
+
+async def _run_entry(
+    semaphore: asyncio.Semaphore,
+    image_ref: str,
+    transformations: Transformations,
+    timeout: float,
+    prefetcher: Optional[Prefetcher],
+) -> Tuple[str, Any]:
+    loop = asyncio.get_event_loop()
+    cancelled = threading.Event()
+    bulk_entries.inc(state="queued")
+    is_queued = True
+    try:
+        async with semaphore:
+            bulk_entries.dec(state="queued")
+            is_queued = False
+            bulk_entries.inc(state="running")
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        executor,
+                        transform_entry,
+                        image_ref,
+                        transformations,
+                        prefetcher,
+                        cancelled,
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                # Entries still waiting for a thread are cancelled by wait_for.
+                cancelled.set()
+                result = _timeout_result()
+            finally:
+                bulk_entries.dec(state="running")
+    finally:
+        if is_queued:
+            bulk_entries.dec(state="queued")  # Cancelled while waiting.
+
+    return image_ref, result
+
+
+def run_bulk(
+    bulk_transformations: Dict[str, Transformations],
+    concurrency: int = BULK_CONCURRENCY,
+    timeout: float = BULK_ENTRY_TIMEOUT,
+) -> Iterator[Tuple[str, Any]]:
+    # Yields (image reference, result) pairs as soon as each entry completes. The event
+    # loop is private to the generator so it can be consumed by a streamed response.
+    # Local transformations need the image contents, which are fetched in batches.
+    # Remote transformation services fetch the images themselves.
+    prefetcher = None
+    if TRANSFORM_MODE == "local":
+        prefetcher = Prefetcher(
+            [image_ref for image_ref in bulk_transformations if not _is_url(image_ref)],
+            batch_size=concurrency,
+        )
+
+    loop = asyncio.new_event_loop()
+    pending = set()
+    try:
+        semaphore = loop.run_until_complete(_create_semaphore(concurrency))
+        pending = {
+            loop.create_task(
+                _run_entry(semaphore, image_ref, transformations, timeout, prefetcher)
+            )
+            for image_ref, transformations in bulk_transformations.items()
+        }
+
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        # The client went away or the generator was closed early.
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        loop.close()
@@ -0,0 +1,189 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl
+
+from .transformations import Transformations
+from .. import EAGER_WORKERS
+from ..cache import derivative_key
+from ..formats import (
+    get_extension_for_mimetype,
+    get_mimetype_for_path,
+    mimetype_formats,
+)
+from ..jobs import Job, JobQueue
+from ..limits import TOO_LARGE_ERRORS
+from ..repository import (
+    ImageRepository,
+    derivative_cache,
+    derivative_flights,
+    eager_queue,
+    parse_image_path,
+)
+
+# Idle workers check the queue for jobs of other processes at this interval.
+POLL_INTERVAL = 5  # Seconds.
+
+
+def _transform(
+    repository: ImageRepository,
+    image_path: str,
+    transformations: Transformations,
+    key: str,
+) -> Tuple[bytes, str]:
+    # Another process may have stored the derivative while this one waited for it.
+    cached = derivative_cache.get(key)
+    if cached:
+        return cached
+
+    # The original is transformed and encoded once in the requested format, instead of
+    # transforming a conversion of it.
+    image_id, requested_mimetype = parse_image_path(image_path)
+    extension = get_extension_for_mimetype(
+        repository.metadata(image_id)["Content-Type"]
+    )
+    contents, mimetype = repository.retrieve(
+        image_id + extension if extension else image_path
+    )
+    contents, mimetype = transformations.apply(
+        contents, mimetype, output_mimetype=requested_mimetype
+    )
+    derivative_cache.put(key, contents, mimetype)
+    return contents, mimetype
+
+
+def get_derivative(
+    repository: ImageRepository, image_path: str, transformations: Transformations
+) -> Tuple[bytes, str]:
+    image_id, requested_mimetype = parse_image_path(image_path)
+    key = derivative_key(
+        image_id, requested_mimetype, transformations.key, transformations.profile
+    )
+
+    cached = derivative_cache.get(key, use_storage=False)
+    if cached:
+        return cached
+
+    # Concurrent requests for the same derivative share one computation.
+    return derivative_flights.do(
+        key, _transform, repository, image_path, transformations, key
+    )
+
+
+def parse_preset(preset: str) -> Tuple[str, List[Tuple[str, str]]]:
+    # A preset is the part of a download URL after the image id: an optional extension
+    # and the query string, e.g. ".webp?thumbnail-size=200*200".
+    extension, _, query = preset.partition("?")
+    if extension:
+        mimetype = get_mimetype_for_path(f"image{extension}")
+        if mimetype not in mimetype_formats:
+            raise ValueError(f'Unknown extension in eager preset: "{preset}"')
+
+    params = parse_qsl(query, keep_blank_values=True, strict_parsing=bool(query))
+    # Validate the transformations.
+    Transformations.from_query_params(params).plan({})
+    return extension, params
+
+
+def validate_presets(presets: List[str]) -> List[str]:
+    for preset in presets:
+        parse_preset(preset)
+    return presets
+
+
+def generate(image_path: str, preset: str):
+    extension, params = parse_preset(preset)
+    if extension:
+        image_path = str(Path(image_path).with_suffix(extension))
+
+    repository = ImageRepository()
+    metadata = repository.metadata(image_path)
+    transformations = Transformations.from_query_params(params).plan(metadata)
+    if transformations.transformations:
+        get_derivative(repository, image_path, transformations)
+    elif parse_image_path(image_path)[1] != metadata["Content-Type"]:
+        # Conversions are cached by the repository, originals need nothing.
+        repository.retrieve(image_path, transformations.profile)
+
+
+# Background threads generating the eager derivatives of the queue. Workers of every
+# process on the host share the queue.
+class EagerWorkers:
+    def __init__(self, queue: JobQueue, threads: int):
+        self.queue = queue
+        self.threads = threads
+
+        self._started = False
+        self._wake_up = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(("generated", "failed"), 0)
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        for index in range(self.threads):
+            threading.Thread(
+                target=self._run, name=f"eager-{index}", daemon=True
+            ).start()
+
+    def notify(self):
+        self._wake_up.set()
+
+    def run_pending(self) -> int:
+        # Processes jobs until the queue is empty, returns how many were processed.
+        processed = 0
+        while self.run_once():
+            processed += 1
+        return processed
+
+    def run_once(self) -> bool:
+        job = self.queue.claim()
+        if job is None:
+            return False
+
+        self._process(job)
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        stats = self.queue.stats()
+        with self._lock:
+            return dict(stats, **self._counters)
+
+    def _run(self):
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logging.getLogger(__name__).exception("Eager queue is unavailable")
+
+            self._wake_up.wait(POLL_INTERVAL)
+            self._wake_up.clear()
+
+    def _process(self, job: Job):
+        try:
+            generate(job.payload["image"], job.payload["preset"])
+        except (FileNotFoundError, ValueError, *TOO_LARGE_ERRORS) as error:
+            # Deleted or too large images and invalid presets won't succeed when
+            # retried.
+            logging.getLogger(__name__).warning(f"Eager job {job.payload}: {error}")
+            self.queue.complete(job)
+            self._count("failed")
+        except Exception:
+            logging.getLogger(__name__).exception(f"Eager job {job.payload} failed")
+            if not self.queue.release(job):
+                self._count("failed")
+        else:
+            self.queue.complete(job)
+            self._count("generated")
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+
+eager_workers = EagerWorkers(eager_queue, threads=EAGER_WORKERS)
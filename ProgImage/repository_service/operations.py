@@ -0,0 +1,159 @@
+import math
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from .. import THUMBNAIL_REDUCING_GAP
+from ..formats import (
+    get_format_for_mimetype,
+    get_mimetype_for_path,
+    is_saveable,
+    mimetype_formats,
+)
+from ..limits import check_output_size
+from ..repository import EXIF_ORIENTATION
+
+# Transformations without a service of their own, they always run in-process.
+
+# EXIF orientations of images stored transposed, i.e. with width and height swapped.
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+GRAYSCALE_MODES = ("1", "L", "LA", "I", "F")
+RESIZE_MODES = ("fit", "cover", "stretch")
+
+
+def get_crop_box(params: Optional[dict] = None) -> Tuple[int, int, int, int]:
+    try:
+        left, top, width, height = (
+            int(value.strip()) for value in params["box"].split(",")
+        )
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(
+            '"box" must be "<left>,<top>,<width>,<height>", e.g. "0,0,200,100".'
+        )
+    if left < 0 or top < 0:
+        raise ValueError('"box" must not start outside of the image.')
+    if width < 1 or height < 1:
+        raise ValueError('"box" must have a positive size.')
+    check_output_size(width, height)
+    return left, top, width, height
+
+
+def _get_crop_bounds(
+    size: Tuple[int, int], params: Optional[dict]
+) -> Tuple[int, int, int, int]:
+    # Boxes reaching beyond the image are clipped to it.
+    left, top, width, height = get_crop_box(params)
+    right, bottom = min(left + width, size[0]), min(top + height, size[1])
+    if left >= right or top >= bottom:
+        raise ValueError("Crop box is outside of the image.")
+    return left, top, right, bottom
+
+
+def get_crop_size(
+    size: Tuple[int, int], params: Optional[dict] = None
+) -> Tuple[int, int]:
+    left, top, right, bottom = _get_crop_bounds(size, params)
+    return right - left, bottom - top
+
+
+def crop(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    bounds = _get_crop_bounds(image.size, params)
+    if bounds == (0, 0, *image.size):
+        return image
+    return image.crop(bounds)
+
+
+def get_resize_options(
+    params: Optional[dict] = None,
+) -> Tuple[Optional[int], Optional[int], str]:
+    params = params or {}
+    dimensions = []
+    for name in ("width", "height"):
+        if not params.get(name):
+            dimensions.append(None)
+            continue
+        try:
+            dimension = int(params[name])
+        except ValueError:
+            raise ValueError(f'"{name}" must be an integer number of pixels.')
+        if dimension < 1:
+            raise ValueError(f'"{name}" must be positive.')
+        dimensions.append(dimension)
+
+    width, height = dimensions
+    mode = params.get("mode") or "fit"
+    if mode not in RESIZE_MODES:
+        raise ValueError(f'"mode" must be one of: {", ".join(RESIZE_MODES)}')
+    if not width and not height:
+        raise ValueError('"width" or "height" is required.')
+    if mode != "fit" and not (width and height):
+        raise ValueError(f'Resizing with mode "{mode}" requires "width" and "height".')
+    check_output_size(width or 1, height or 1)
+    return width, height, mode
+
+
+def get_resize_size(
+    size: Tuple[int, int], params: Optional[dict] = None
+) -> Tuple[int, int]:
+    # "fit" keeps the aspect ratio within the given width and/or height (and may
+    # upscale, unlike thumbnails), "cover" and "stretch" result in exactly the size.
+    width, height, mode = get_resize_options(params)
+    if mode != "fit":
+        return width, height
+
+    scale = min(
+        width / size[0] if width else math.inf, height / size[1] if height else math.inf
+    )
+    width, height = max(round(size[0] * scale), 1), max(round(size[1] * scale), 1)
+    check_output_size(width, height)
+    return width, height
+
+
+def resize(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    _, _, mode = get_resize_options(params)
+    size = get_resize_size(image.size, params)
+    if size == image.size:
+        return image
+
+    if mode == "cover":
+        # Scaled to cover the size, then cropped to it around the center.
+        return ImageOps.fit(image, size)
+
+    # Like thumbnails, JPEGs are decoded at a reduced scale when downscaling (only if
+    # the image hasn't been loaded yet).
+    if THUMBNAIL_REDUCING_GAP and size[0] < image.width and size[1] < image.height:
+        image.draft(
+            None,
+            (size[0] * THUMBNAIL_REDUCING_GAP, size[1] * THUMBNAIL_REDUCING_GAP),
+        )
+    return image.resize(size, reducing_gap=THUMBNAIL_REDUCING_GAP)
+
+
+def get_orientation(image: Image.Image) -> Optional[int]:
+    return image.getexif().get(EXIF_ORIENTATION)
+
+
+def auto_orient(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    # Applies the EXIF orientation to the pixels and removes it from the EXIF data.
+    # Upright images are returned as they are, so they are still decoded lazily.
+    if get_orientation(image) in (None, 1):
+        return image
+    return ImageOps.exif_transpose(image)
+
+
+def grayscale(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    if image.mode in GRAYSCALE_MODES:
+        return image
+    has_alpha = image.mode in ("RGBA", "PA") or "transparency" in image.info
+    return image.convert("LA" if has_alpha else "L")
+
+
+def get_format_mimetype(params: Optional[dict] = None) -> str:
+    # Formats are given by their extension, e.g. "webp".
+    extension = (params or {}).get("type", "")
+    mimetype = get_mimetype_for_path(f"image.{extension.strip()}")
+    if not extension or mimetype not in mimetype_formats:
+        raise ValueError(f'Unknown image format: "{extension}"')
+    if not is_saveable(get_format_for_mimetype(mimetype)):
+        raise ValueError(f'Saving images as "{extension}" is not supported.')
+    return mimetype
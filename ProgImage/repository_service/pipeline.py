@@ -0,0 +1,308 @@
+from enum import Enum, auto
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from . import operations
+from ..rotation_service import transformation as rotation
+from ..thumbnail_service import transformation as thumbnail
+
+# Transformations are applied as an ordered list of steps. The planner rewrites the
+# steps into a cheaper equivalent, based on the metadata recorded at upload time (i.e.
+# without fetching or decoding the image). The same plan is executed in-process or by
+# the transformation services.
+
+# Transformation chains are limited to this many steps.
+MAX_STEPS = 16
+
+
+class ImageTransformation(Enum):
+    THUMBNAIL = auto()
+    ROTATE = auto()
+    CROP = auto()
+    RESIZE = auto()
+    AUTO_ORIENT = auto()
+    GRAYSCALE = auto()
+    FORMAT = auto()
+
+    @property
+    def param(self) -> str:
+        # Name in query parameters, e.g. "auto-orient".
+        return self.name.lower().replace("_", "-")
+
+
+class Step(NamedTuple):
+    transformation: ImageTransformation
+    options: Dict[str, str]
+
+
+# Options are given as "<transformation>-<option>" parameters, e.g. "thumbnail-size".
+transformation_options = {
+    ImageTransformation.THUMBNAIL: ("size",),
+    ImageTransformation.ROTATE: ("transpose", "angle"),
+    ImageTransformation.CROP: ("box",),
+    ImageTransformation.RESIZE: ("width", "height", "mode"),
+    ImageTransformation.AUTO_ORIENT: (),
+    ImageTransformation.GRAYSCALE: (),
+    ImageTransformation.FORMAT: ("type",),
+}
+
+# Transformations which can be given by their name alone, e.g. "grayscale", with the
+# value of the parameter as this option, e.g. "format=webp".
+shorthand_options = {
+    ImageTransformation.AUTO_ORIENT: None,
+    ImageTransformation.GRAYSCALE: None,
+    ImageTransformation.FORMAT: "type",
+}
+
+validators = {
+    ImageTransformation.THUMBNAIL: thumbnail.get_size,
+    ImageTransformation.ROTATE: rotation.get_rotation,
+    ImageTransformation.CROP: operations.get_crop_box,
+    ImageTransformation.RESIZE: operations.get_resize_options,
+    ImageTransformation.FORMAT: operations.get_format_mimetype,
+}
+
+output_sizes = {
+    ImageTransformation.THUMBNAIL: thumbnail.get_output_size,
+    ImageTransformation.ROTATE: rotation.get_output_size,
+    ImageTransformation.CROP: operations.get_crop_size,
+    ImageTransformation.RESIZE: operations.get_resize_size,
+}
+
+
+# What is known about the image before a step. None if it isn't known.
+class ImageState(NamedTuple):
+    size: Optional[Tuple[int, int]]
+    orientation: Optional[int]
+    mode: Optional[str]
+
+    @staticmethod
+    def from_metadata(metadata: dict) -> "ImageState":
+        width, height = metadata.get("Width"), metadata.get("Height")
+        orientation = None
+        if "Orientation" in metadata:
+            orientation = metadata["Orientation"] or 1
+        return ImageState(
+            size=(width, height) if width and height else None,
+            orientation=orientation,
+            mode=metadata.get("Mode"),
+        )
+
+    def advance(self, step: Step) -> "ImageState":
+        transformation, options = step
+        if transformation == ImageTransformation.GRAYSCALE:
+            return self._replace(mode="L")
+        if transformation == ImageTransformation.AUTO_ORIENT:
+            if self.orientation is None:
+                return self._replace(size=None, orientation=1)
+            swap = self.orientation in operations.TRANSPOSED_ORIENTATIONS
+            size = _swap(self.size) if swap else self.size
+            return self._replace(size=size, orientation=1)
+        if transformation not in output_sizes:
+            return self
+
+        if self.size:
+            return self._replace(size=output_sizes[transformation](self.size, options))
+        if transformation == ImageTransformation.RESIZE:
+            width, height, mode = operations.get_resize_options(options)
+            if mode != "fit":
+                return self._replace(size=(width, height))
+        return self
+
+
+def _swap(size: Optional[Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    return (size[1], size[0]) if size else None
+
+
+def _rotation_step(transpose: int, angle: int) -> Step:
+    options = {"transpose": str(transpose % 360), "angle": str(angle % 360)}
+    return Step(
+        ImageTransformation.ROTATE,
+        {name: value for name, value in options.items() if value != "0"},
+    )
+
+
+def _is_noop(step: Step, state: ImageState) -> bool:
+    transformation, options = step
+    if transformation == ImageTransformation.ROTATE:
+        return rotation.get_rotation(options) == (0, 0)
+    if transformation == ImageTransformation.AUTO_ORIENT:
+        return state.orientation == 1
+    if transformation == ImageTransformation.GRAYSCALE:
+        return state.mode in operations.GRAYSCALE_MODES
+    if transformation in output_sizes and state.size:
+        # A thumbnail larger than the image, a crop of the whole image, etc.
+        return output_sizes[transformation](state.size, options) == state.size
+    return False
+
+
+def _is_scale(step: Step) -> bool:
+    # Scales the whole image, i.e. without cropping it.
+    transformation, options = step
+    if transformation == ImageTransformation.RESIZE:
+        return operations.get_resize_options(options)[2] != "cover"
+    return transformation == ImageTransformation.THUMBNAIL
+
+
+def _is_uniform_scale(step: Step) -> bool:
+    # Keeps the aspect ratio, so it commutes with rotations by any angle.
+    transformation, options = step
+    if transformation == ImageTransformation.RESIZE:
+        return operations.get_resize_options(options)[2] == "fit"
+    return transformation == ImageTransformation.THUMBNAIL
+
+
+def _merge(first: Step, second: Step, state: ImageState) -> Optional[Step]:
+    # A single step equivalent to two consecutive ones.
+    transformation = first.transformation
+    if transformation == second.transformation == ImageTransformation.ROTATE:
+        first_transpose, first_angle = rotation.get_rotation(first.options)
+        second_transpose, second_angle = rotation.get_rotation(second.options)
+        if not first_angle:
+            return _rotation_step(first_transpose + second_transpose, second_angle)
+        if not second_transpose:
+            # The image is resampled once, and its corners are clipped once.
+            return _rotation_step(first_transpose, first_angle + second_angle)
+        return None
+
+    if transformation == second.transformation == ImageTransformation.THUMBNAIL:
+        first_width, first_height = thumbnail.get_size(first.options)
+        second_width, second_height = thumbnail.get_size(second.options)
+        size = f"{min(first_width, second_width)}*{min(first_height, second_height)}"
+        return Step(ImageTransformation.THUMBNAIL, {"size": size})
+
+    if transformation == second.transformation == ImageTransformation.CROP:
+        # The second box is relative to the first one, and clipped by it.
+        left, top, width, height = operations.get_crop_box(first.options)
+        second_left, second_top, second_width, second_height = (
+            operations.get_crop_box(second.options)
+        )
+        width = min(second_width, width - second_left)
+        height = min(second_height, height - second_top)
+        if width < 1 or height < 1:
+            return None  # Outside of the first box, fails when it's applied.
+        box = f"{left + second_left},{top + second_top},{width},{height}"
+        return Step(ImageTransformation.CROP, {"box": box})
+
+    if _is_scale(first) and _is_scale(second):
+        # Both scale the whole image, only the final size matters.
+        if state.size:
+            width, height = state.advance(first).advance(second).size
+        elif second.transformation == ImageTransformation.RESIZE and not (
+            _is_uniform_scale(second)
+        ):
+            width, height, _ = operations.get_resize_options(second.options)
+        else:
+            return None
+        options = {"width": str(width), "height": str(height), "mode": "stretch"}
+        return Step(ImageTransformation.RESIZE, options)
+
+    return None
+
+
+def _move_before(
+    step: Step,
+    previous: Step,
+    state: ImageState,
+    keeps_exif: Callable[[ImageTransformation], bool],
+) -> Optional[Step]:
+    # Downscaling first makes the previous step cheaper. Returns the step as it has
+    # to be applied before the previous one, if they commute.
+    if step.transformation not in (
+        ImageTransformation.THUMBNAIL,
+        ImageTransformation.RESIZE,
+    ):
+        return None
+    if step.transformation == ImageTransformation.RESIZE:
+        # Thumbnails never upscale, resizing only moves if it's known to downscale.
+        size = state.advance(previous).size
+        if not size:
+            return None
+        width, height = state.advance(previous).advance(step).size
+        if width * height >= size[0] * size[1]:
+            return None
+
+    if previous.transformation == ImageTransformation.GRAYSCALE:
+        swap = False
+    elif previous.transformation == ImageTransformation.ROTATE:
+        transpose, angle = rotation.get_rotation(previous.options)
+        if angle and not _is_uniform_scale(step):
+            return None
+        swap = transpose in (90, 270)
+    elif previous.transformation == ImageTransformation.AUTO_ORIENT:
+        # Auto-orientation needs the EXIF orientation the step leaves behind, which
+        # is lost if a service encodes its result with a profile stripping metadata.
+        if state.orientation is None or not keeps_exif(step.transformation):
+            return None
+        swap = state.orientation in operations.TRANSPOSED_ORIENTATIONS
+    else:
+        return None
+
+    if not swap:
+        return step
+    if step.transformation == ImageTransformation.THUMBNAIL:
+        width, height = thumbnail.get_size(step.options)
+        return Step(step.transformation, dict(step.options, size=f"{height}*{width}"))
+    options = dict(step.options)
+    for name, value in (
+        ("width", step.options.get("height")),
+        ("height", step.options.get("width")),
+    ):
+        options.pop(name, None)
+        if value:
+            options[name] = value
+    return Step(step.transformation, options)
+
+
+def _rewrite(
+    steps: List[Step],
+    state: ImageState,
+    keeps_exif: Callable[[ImageTransformation], bool],
+) -> Optional[List[Step]]:
+    # Applies the first applicable rewrite, None if there is none.
+    for index, step in enumerate(steps):
+        if _is_noop(step, state):
+            return steps[:index] + steps[index + 1 :]
+
+        if index + 1 < len(steps):
+            following = steps[index + 1]
+            merged = _merge(step, following, state)
+            if merged:
+                return steps[:index] + [merged] + steps[index + 2 :]
+            moved = _move_before(following, step, state, keeps_exif)
+            if moved:
+                return steps[:index] + [moved, step] + steps[index + 2 :]
+
+        state = state.advance(step)
+    return None
+
+
+def plan(
+    steps: List[Step],
+    metadata: dict,
+    keeps_exif: Callable[[ImageTransformation], bool] = lambda transformation: True,
+) -> List[Step]:
+    # Rules, applied until none applies:
+    # - Steps which wouldn't change the image are dropped, e.g. a thumbnail larger
+    #   than the image or a rotation by 0 degrees.
+    # - Consecutive rotations, thumbnails, crops and resizes are merged into one.
+    # - Downscaling moves before rotations, auto-orientation and grayscale conversion
+    #   (with width and height swapped where they are transposed). keeps_exif tells
+    #   whether the EXIF data of the image survives a step.
+    # - The output format is set by the last format step, which moves to the end.
+    formats, image_steps = [], []
+    for step in steps:
+        if step.transformation in validators:
+            validators[step.transformation](step.options)
+        if step.transformation == ImageTransformation.FORMAT:
+            formats.append(step)
+        else:
+            image_steps.append(step)
+
+    # The last pass also checks the options against the sizes, e.g. crops outside of
+    # the image.
+    state = ImageState.from_metadata(metadata)
+    while True:
+        rewritten = _rewrite(image_steps, state, keeps_exif)
+        if rewritten is None:
+            return image_steps + formats[-1:]
+        image_steps = rewritten
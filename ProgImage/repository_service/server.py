@@ -1,33 +1,159 @@
-import concurrent.futures
+import hashlib
+import json
 import os
-from urllib.parse import urljoin
+from datetime import datetime
+from functools import partial
+from typing import Callable, Iterator, List, Union, Optional, Tuple
+from urllib.parse import parse_qsl, urljoin
 
-from flask import request, Response, jsonify
-from werkzeug.exceptions import BadRequest, NotFound, NotAcceptable
+from flask import request, Response, jsonify, stream_with_context, url_for
+from werkzeug.exceptions import (
+    BadRequest,
+    NotFound,
+    NotAcceptable,
+    UnsupportedMediaType,
+)
+from werkzeug.wsgi import wrap_file
 
+from .batch import run_batch_upload, store_file, store_uri
+from .bulk import run_bulk
+from .derivatives import eager_workers, get_derivative, validate_presets
 from .transformations import Transformations
-from .. import MAX_UPLOAD_SIZE, TRANSFORM_WORKERS
-from ..repository import ImageRepository
-from ..server import app
+from .. import EAGER_PRESETS, MAX_BATCH_UPLOAD_ITEMS, MAX_UPLOAD_SIZE
+from ..formats import get_profile_name
+from ..repository import (
+    ImageRepository,
+    derivative_cache,
+    derivative_flights,
+    parse_image_path,
+    storage_engine,
+)
+from ..server import (
+    app,
+    get_last_modified,
+    make_conditional,
+    not_modified,
+    parse_uri_list,
+    set_validators,
+)
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+# Bounds the size of text/uri-list batches, per URI.
+MAX_URI_LENGTH = 8 * 1024  # Bytes.
+
+
+def _get_etag(
+    metadata: dict, mimetype: str, transformations: Transformations
+) -> Optional[str]:
+    # Strong validator derived from the stored content hash, so it never changes for
+    # the same image, format, transformations and effective encoding profile (and
+    # needs no image contents).
+    content_hash = metadata.get("Content-Hash")
+    if not content_hash:
+        return None
+
+    if mimetype == metadata["Content-Type"] and not transformations.transformations:
+        return content_hash
+
+    profile = get_profile_name(transformations.profile)
+    return hashlib.sha256(
+        f"{content_hash}\n{mimetype}\n{transformations.key}\n{profile}".encode("utf-8")
+    ).hexdigest()
+
+
+def _head_response(
+    metadata: dict,
+    requested_mimetype: str,
+    etag: Optional[str],
+    last_modified: Optional[datetime],
+) -> Response:
+    headers = {"Content-Type": requested_mimetype}
+    if requested_mimetype == metadata["Content-Type"]:
+        headers["Content-Length"] = metadata.get("Content-Length")
+
+    for name, header in (
+        ("Width", "X-Image-Width"),
+        ("Height", "X-Image-Height"),
+        ("Mode", "X-Image-Mode"),
+        ("Format", "X-Image-Format"),
+        ("Orientation", "X-Image-Orientation"),
+        ("Content-Hash", "X-Content-Hash"),
+    ):
+        headers[header] = metadata.get(name)
+
+    response = Response(status=200)
+    response.headers.update(
+        {name: str(value) for name, value in headers.items() if value is not None}
+    )
+    return set_validators(response, etag, last_modified)
 
 
 @app.route("/images/<image_path>", methods=["GET"])
 def download_image(image_path: str):
     repository = ImageRepository()
     try:
-        contents, mimetype = repository.retrieve(image_path)
+        _, requested_mimetype = parse_image_path(image_path)
+        metadata = repository.metadata(image_path)
 
+        transformations = Transformations([])
         if request.query_string:
-            transformations = Transformations.from_query_params(request.args)
-            contents, mimetype = transformations.apply(contents, mimetype)
+            # Parsed in order, the steps are applied in the order of the parameters.
+            params = parse_qsl(
+                request.query_string.decode("utf-8"), keep_blank_values=True
+            )
+            transformations = Transformations.from_query_params(params).plan(metadata)
+            requested_mimetype = transformations.output_mimetype or requested_mimetype
+
+        etag = _get_etag(metadata, requested_mimetype, transformations)
+        last_modified = get_last_modified(metadata)
 
-        return Response(mimetype=mimetype, response=contents)
+        if request.method == "HEAD":
+            return _head_response(metadata, requested_mimetype, etag, last_modified)
+
+        # Revalidation only needs the metadata, the image isn't fetched or decoded.
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        if transformations.transformations:
+            contents, mimetype = get_derivative(
+                repository, image_path, transformations
+            )
+            response = Response(mimetype=mimetype, response=contents)
+            complete_length = len(contents)
+        else:
+            contents, mimetype = repository.retrieve_stream(
+                image_path, transformations.profile
+            )
+            if isinstance(contents, bytes):
+                response = Response(mimetype=mimetype, response=contents)
+                complete_length = len(contents)
+            else:
+                # Stream the original straight from the storage engine.
+                response = Response(
+                    wrap_file(request.environ, contents),
+                    mimetype=mimetype,
+                    direct_passthrough=True,
+                )
+                complete_length = metadata.get("Content-Length")
+
+        return make_conditional(response, etag, last_modified, complete_length)
     except FileNotFoundError as error:
         raise NotFound(str(error))
     except ValueError as error:
         raise BadRequest(str(error))
 
 
+def _get_eager_presets() -> List[str]:
+    # Presets of derivatives to generate in the background, an empty "eager" parameter
+    # disables the configured ones.
+    if "eager" in request.args:
+        presets = [preset for preset in request.args.getlist("eager") if preset]
+    else:
+        presets = EAGER_PRESETS
+    return validate_presets(presets)
+
+
 @app.route("/images/", methods=["POST"])
 def upload_image() -> Response:
     if request.content_length == 0:
@@ -38,7 +164,8 @@ def upload_image() -> Response:
     repository = ImageRepository()
 
     try:
-        image_path = repository.store(request.get_data())
+        presets = _get_eager_presets()
+        image_path = repository.store_stream(request.stream, eager=presets)
     except ValueError as error:
         raise BadRequest(str(error))
 
@@ -46,9 +173,90 @@ def upload_image() -> Response:
     response = jsonify(id=image_path, location=location)
     response.headers.update({"Location": location})
     response.status_code = 201
+    if presets:
+        # The derivatives are generated once the response has been sent.
+        response.call_on_close(eager_workers.notify)
     return response
 
 
+def _get_batch_uploads(presets: List[str]) -> List[Tuple[str, Callable[[], str]]]:
+    # Files of a multipart/form-data request are referred to by their file name, URIs
+    # of a text/uri-list by themselves. The size of the request is checked before its
+    # body is parsed (into temporary files or memory).
+    max_size = MAX_BATCH_UPLOAD_ITEMS * (
+        MAX_UPLOAD_SIZE if request.mimetype == "multipart/form-data" else MAX_URI_LENGTH
+    )
+    if request.content_length and request.content_length > max_size:
+        raise BadRequest(f"Batches must not exceed {max_size:,} bytes.")
+
+    if request.mimetype == "multipart/form-data":
+        uploads = [
+            (file.filename or name, partial(store_file, file.stream, presets))
+            for name, file in request.files.items(multi=True)
+        ]
+        if not uploads:
+            raise BadRequest("At least one file must be sent.")
+    elif request.mimetype == "text/uri-list":
+        uploads = [
+            (uri, partial(store_uri, uri, presets))
+            for uri in parse_uri_list(request.get_data())
+        ]
+    else:
+        raise UnsupportedMediaType(
+            "Request must be multipart/form-data or text/uri-list."
+        )
+
+    if len(uploads) > MAX_BATCH_UPLOAD_ITEMS:
+        raise BadRequest(f"Batches are limited to {MAX_BATCH_UPLOAD_ITEMS} images.")
+    return uploads
+
+
+@app.route("/images/batch/", methods=["POST"])
+def upload_batch() -> Response:
+    try:
+        presets = _get_eager_presets()
+    except ValueError as error:
+        raise BadRequest(str(error))
+    uploads = _get_batch_uploads(presets)
+
+    def get_results() -> Iterator[Tuple[int, dict]]:
+        for index, result in run_batch_upload([store for _, store in uploads]):
+            if isinstance(result, str):
+                result = {
+                    "id": result,
+                    "location": url_for(
+                        "download_image", image_path=result, _external=True
+                    ),
+                }
+            yield index, dict(image=uploads[index][0], **result)
+
+    if (
+        request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+        == NDJSON_MIMETYPE
+    ):
+        # The uploaded files are only readable while the request context is alive.
+        response = Response(
+            stream_with_context(
+                json.dumps(result) + "\n" for _, result in get_results()
+            ),
+            mimetype=NDJSON_MIMETYPE,
+        )
+    else:
+        # Results in the order of the request, references may not be unique.
+        results = sorted(get_results(), key=lambda item: item[0])
+        response = jsonify(images=[result for _, result in results])
+
+    if presets:
+        response.call_on_close(eager_workers.notify)
+    return response
+
+
+def _ndjson_line(image_ref: str, result: Union[str, dict]) -> str:
+    if isinstance(result, str):
+        return json.dumps({"image": image_ref, "id": result}) + "\n"
+    return json.dumps(dict(image=image_ref, **result)) + "\n"
+
+
 @app.route("/bulk/", methods=["POST"])
 def bulk_transform() -> Response:
     if not request.is_json:
@@ -62,6 +270,15 @@ def bulk_transform() -> Response:
     for image_ref, params in request.json.items():
         if not params:
             continue
+        # Parameters are an object, or a list of [name, value] pairs to repeat them.
+        if not isinstance(params, dict) and not (
+            isinstance(params, list)
+            and all(isinstance(pair, list) and len(pair) == 2 for pair in params)
+        ):
+            raise BadRequest(
+                f'Entry "{image_ref}": parameters must be an object or a list of '
+                "[name, value] pairs."
+            )
 
         try:
             transformations = Transformations.from_query_params(
@@ -71,27 +288,39 @@ def bulk_transform() -> Response:
         except ValueError as error:
             raise BadRequest(f'Entry "{image_ref}": {error}')
 
-    # Run transformations concurrently via the transformations services.
-    transformation_results = {}
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=TRANSFORM_WORKERS
-    ) as executor:
-        transformation_futures = {}
-        for image_ref, transformations in bulk_transformations.items():
-            future = executor.submit(transformations.apply, image_ref)
-            transformation_futures[future] = image_ref
-
-        for future in concurrent.futures.as_completed(transformation_futures):
-            try:
-                image_url, b = future.result()
-                result = image_url.decode("utf-8")
-            except Exception:
-                # TODO: Expose errors like 400 and 404.
-                result = {"error": "Transformation error."}
-            finally:
-                transformation_results[transformation_futures[future]] = result
-
-    return jsonify(transformation_results)
+    results = run_bulk(bulk_transformations)
+
+    # Stream each result as soon as it is ready if the client accepts NDJSON.
+    if (
+        request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+        == NDJSON_MIMETYPE
+    ):
+        return Response(
+            (_ndjson_line(image_ref, result) for image_ref, result in results),
+            mimetype=NDJSON_MIMETYPE,
+        )
+
+    return jsonify(dict(results))
+
+
+@app.before_first_request
+def start_eager_workers():
+    # Also picks up the jobs left in the queue when the service was restarted.
+    eager_workers.start()
+
+
+@app.route("/stats/", methods=["GET"])
+def stats() -> Response:
+    stats = {
+        "derivative_cache": derivative_cache.stats(),
+        "derivative_flights": derivative_flights.stats(),
+        "eager": eager_workers.stats(),
+    }
+    # Storage engines with a cache tier report its stats.
+    if hasattr(storage_engine, "stats"):
+        stats["storage"] = storage_engine.stats()
+
+    return jsonify(stats)
 
 
 if __name__ == "__main__":
@@ -1,97 +1,312 @@
 import logging
 import os
-from enum import Enum, auto
-from typing import Any, Dict, Union, Tuple, Optional
+import threading
+from functools import partial
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Union, Tuple, Optional
 from urllib.parse import urljoin
 
 import requests
+from PIL import Image, UnidentifiedImageError
 from requests import HTTPError
 
-
-class ImageTransformation(Enum):
-    THUMBNAIL = auto()
-    ROTATE = auto()
-
+from . import operations, pipeline
+from .pipeline import (
+    MAX_STEPS,
+    ImageTransformation,
+    Step,
+    shorthand_options,
+    transformation_options,
+)
+from .. import TRANSFORM_MODE, SERVICE_CONCURRENCY
+from ..formats import encode_image, get_encoding_profile, get_format_for_mimetype
+from ..limits import DecodeBudgetExceeded, ImageTooLarge, admit
+from ..metrics import timed
+from ..repository import ImageRepository
+from ..sessions import HTTP_TIMEOUT, get_session
+from ..rotation_service import transformation as rotation
+from ..thumbnail_service import transformation as thumbnail
 
 transformation_urls = {
     ImageTransformation.THUMBNAIL: os.getenv("THUMBNAIL_TRANSFORMATION_URL"),
     ImageTransformation.ROTATE: os.getenv("ROTATE_TRANSFORMATION_URL"),
 }
 
+# Bounds the number of requests in flight to each transformation service.
+service_limits = {
+    transformation: threading.BoundedSemaphore(SERVICE_CONCURRENCY)
+    for transformation in ImageTransformation
+}
+
+# Transformations that can run in-process on a decoded image when TRANSFORM_MODE is
+# "local". Everything else is still sent to its service, transformations without a
+# service always run in-process.
+local_transformations = {
+    ImageTransformation.THUMBNAIL: thumbnail.transform,
+    ImageTransformation.ROTATE: rotation.transform,
+    ImageTransformation.CROP: operations.crop,
+    ImageTransformation.RESIZE: operations.resize,
+    ImageTransformation.AUTO_ORIENT: operations.auto_orient,
+    ImageTransformation.GRAYSCALE: operations.grayscale,
+}
+
+
+def _get_local_transformation(
+    transformation: ImageTransformation,
+) -> Optional[Callable[[Image.Image, dict], Image.Image]]:
+    if TRANSFORM_MODE == "local" or transformation not in transformation_urls:
+        return local_transformations.get(transformation)
+    return None
+
 
 class Transformations:
     def __init__(
         self,
-        transformations: Dict[ImageTransformation, Dict[str, Any]],
+        transformations: Iterable[Tuple[ImageTransformation, Dict[str, Any]]],
         store_result: bool = False,
+        profile: Optional[str] = None,
     ):
-        self.transformations = transformations
+        self.transformations = [Step(*step) for step in transformations]
         self.store_result = store_result
+        self.profile = profile
 
     @staticmethod
-    def from_query_params(params: dict, **kwargs) -> "Transformations":
-        transformations = {}
-        for param, option_value in params.items():
-            if param.count("-") != 1:
-                raise ValueError(f'Invalid transformation parameter: "{param}"')
-            command, option_name = param.split("-")
-            try:
-                t = ImageTransformation[command.upper()]
-                if t not in transformations:
-                    transformations[t] = {}
-                transformations[t][option_name] = option_value
-            except KeyError:
-                raise ValueError(f'Unknown transformation command: "{command}"')
-
-        return Transformations(transformations, **kwargs)
+    def from_query_params(
+        params: Union[Mapping[str, Any], Iterable[Tuple[str, Any]]], **kwargs
+    ) -> "Transformations":
+        # Steps are applied in the order of the parameters. A parameter adds its option
+        # to the previous step if that is the same transformation without the option,
+        # otherwise it starts a new step, e.g. "rotate-angle=90&rotate-transpose=180"
+        # is one step, "rotate-angle=90&thumbnail-size=200*200&rotate-angle=90" three.
+        if isinstance(params, Mapping):
+            params = params.items()
+        shorthands = {t.param: t for t in shorthand_options}
+
+        steps = []
+        for param, option_value in params:
+            option_value = str(option_value)
+            if param == "profile":
+                get_encoding_profile(option_value)  # Validate the profile name.
+                kwargs["profile"] = option_value
+                continue
+
+            if param in shorthands:
+                t = shorthands[param]
+                option_name = shorthand_options[t]
+                if option_name is None:
+                    if option_value.lower() not in ("0", "false"):
+                        steps.append(Step(t, {}))
+                    continue
+            else:
+                if param.count("-") != 1:
+                    raise ValueError(f'Invalid transformation parameter: "{param}"')
+                command, option_name = param.split("-")
+                try:
+                    t = ImageTransformation[command.upper()]
+                except KeyError:
+                    raise ValueError(f'Unknown transformation command: "{command}"')
+                if option_name not in transformation_options[t]:
+                    raise ValueError(f'Unknown transformation option: "{param}"')
+
+            if steps and steps[-1].transformation == t:
+                if option_name not in steps[-1].options:
+                    steps[-1].options[option_name] = option_value
+                    continue
+            steps.append(Step(t, {option_name: option_value}))
+
+        if len(steps) > MAX_STEPS:
+            raise ValueError(f"Transformations are limited to {MAX_STEPS} steps.")
+        return Transformations(steps, **kwargs)
+
+    def plan(self, metadata: dict) -> "Transformations":
+        # Validates the options and rewrites the steps into a cheaper equivalent, see
+        # pipeline.plan. Services encode their results with the profile, which may
+        # strip the EXIF data.
+        strips_metadata = get_encoding_profile(self.profile).strip_metadata
+
+        def keeps_exif(transformation: ImageTransformation) -> bool:
+            is_local = _get_local_transformation(transformation) is not None
+            return is_local or not strips_metadata
+
+        return Transformations(
+            pipeline.plan(self.transformations, metadata, keeps_exif),
+            store_result=self.store_result,
+            profile=self.profile,
+        )
+
+    @property
+    def output_mimetype(self) -> Optional[str]:
+        # Set by the last format step, otherwise the output keeps the input's format.
+        for transformation, options in reversed(self.transformations):
+            if transformation == ImageTransformation.FORMAT:
+                return operations.get_format_mimetype(options)
+        return None
+
+    @property
+    def key(self) -> str:
+        # Normalised representation of the chain, used to identify its results together
+        # with the effective encoding profile (see derivative_key).
+        return ";".join(
+            f"{transformation.name.lower()}("
+            + ",".join(
+                f"{name}={str(value).strip()}"
+                for name, value in sorted(options.items())
+                if name != "store_result"
+            )
+            + ")"
+            for transformation, options in self.transformations
+        )
 
     def apply(
-        self, image: Union[bytes, str], mimetype: Optional[str] = None
+        self,
+        image: Union[bytes, str],
+        mimetype: Optional[str] = None,
+        output_mimetype: Optional[str] = None,
     ) -> Tuple[bytes, str]:
-        session = requests.Session()
-        session.timeout = (3.05, 20)
+        # Consecutive local transformations share a single decoded image, it is only
+        # encoded again when a remote transformation follows or the chain ends. They
+        # are applied while encoding, to every frame of animated images. The output
+        # format is set by a format step, or by output_mimetype, and defaults to the
+        # format of the input.
+        output_mimetype = self.output_mimetype or output_mimetype
+        steps = [
+            step
+            for step in self.transformations
+            if step.transformation != ImageTransformation.FORMAT
+        ]
+        decoded_image = None
+        frame_transforms = []
 
-        for index, (transformation, options) in enumerate(self.transformations.items()):
-            url = transformation_urls[transformation]
-            if not url:
-                logging.getLogger(__name__).warning(f"No URL set for {transformation}")
+        for index, (transformation, options) in enumerate(steps):
+            is_last = index == len(steps) - 1
+            local_transformation = _get_local_transformation(transformation)
+
+            if local_transformation:
+                if decoded_image is None:
+                    image, mimetype = self._load(image, mimetype)
+                    decoded_image = self._decode(image)
+                frame_transforms.append(partial(local_transformation, params=options))
                 continue
 
-            url = urljoin(url, "transform/")
-            transform_mimetype = mimetype
+            if decoded_image is not None:
+                image = self._encode(decoded_image, mimetype, frame_transforms)
+                decoded_image, frame_transforms = None, []
 
-            if isinstance(image, bytes):
+            image, mimetype = self._apply_remote(
+                transformation=transformation,
+                options=options,
+                image=image,
+                mimetype=mimetype,
+                store_result=self.store_result and is_last and not output_mimetype,
+            )
+
+        if output_mimetype and decoded_image is None:
+            # Services keep the format, the result is converted in-process.
+            image, mimetype = self._load(image, mimetype)
+            if mimetype != output_mimetype:
+                decoded_image = self._decode(image)
+            elif self.store_result:
+                return self._store(image)
+
+        if decoded_image is not None:
+            mimetype = output_mimetype or mimetype
+            image = self._encode(decoded_image, mimetype, frame_transforms)
+            if self.store_result:
+                return self._store(image)
+
+        return image, mimetype
+
+    @staticmethod
+    def _store(image: bytes) -> Tuple[bytes, str]:
+        image_path = ImageRepository().store(image)
+        return image_path.encode("utf-8"), "text/plain"
+
+    @staticmethod
+    def _load(image: Union[bytes, str], mimetype: Optional[str]) -> Tuple[bytes, str]:
+        if isinstance(image, bytes):
+            if not mimetype:
+                raise ValueError("MIME type is required when source is raw image data")
+            return image, mimetype
+        elif isinstance(image, str):
+            if image.startswith("http://") or image.startswith("https://"):
+                try:
+                    response = get_session().get(image, timeout=HTTP_TIMEOUT)
+                    response.raise_for_status()
+                except requests.RequestException as error:
+                    raise ValueError(f"Unable to download image: {error}") from error
+                return response.content, response.headers.get("Content-Type")
+            return ImageRepository().retrieve(image)
+        else:
+            raise ValueError("Invalid data type passed as image")
+
+    def _encode(
+        self, image: Image.Image, mimetype: str, frame_transforms: List[Callable]
+    ) -> bytes:
+        def transform(frame: Image.Image) -> Image.Image:
+            for frame_transform in frame_transforms:
+                frame = frame_transform(frame)
+            return frame
+
+        with admit(image):
+            return encode_image(
+                image, get_format_for_mimetype(mimetype), self.profile, transform
+            )
+
+    @staticmethod
+    def _decode(contents: bytes) -> Image.Image:
+        try:
+            return Image.open(BytesIO(contents))
+        except UnidentifiedImageError as error:
+            raise ValueError("Image format is unknown.") from error
+
+    def _apply_remote(
+        self,
+        transformation: ImageTransformation,
+        options: Dict[str, Any],
+        image: Union[bytes, str],
+        mimetype: Optional[str],
+        store_result: bool,
+    ) -> Tuple[Union[bytes, str], Optional[str]]:
+        url = transformation_urls[transformation]
+        if not url:
+            logging.getLogger(__name__).warning(f"No URL set for {transformation}")
+            return image, mimetype
+
+        url = urljoin(url, "transform/")
+        transform_mimetype = mimetype
+
+        if isinstance(image, bytes):
+            method = "POST"
+            data = image
+            if not mimetype:
+                raise ValueError("MIME type is required when source is raw image data")
+        elif isinstance(image, str):
+            if image.startswith("http://") or image.startswith("https://"):
                 method = "POST"
-                data = image
-                if not mimetype:
-                    raise ValueError(
-                        "MIME type is required when source is raw image data"
-                    )
-            elif isinstance(image, str):
-                if image.startswith("http://") or image.startswith("https://"):
-                    method = "POST"
-                    transform_mimetype = "text/uri-list"
-                    data = image.encode("utf-8")
-                else:
-                    method = "GET"
-                    data = None
-                    url = urljoin(url, image)
+                transform_mimetype = "text/uri-list"
+                data = image.encode("utf-8")
             else:
-                raise ValueError("Invalid data type passed as image")
+                method = "GET"
+                data = None
+                url = urljoin(url, image)
+        else:
+            raise ValueError("Invalid data type passed as image")
 
-            image, mimetype = self._apply_transition(
-                session=session,
+        with service_limits[transformation], timed(
+            "remote_transform", transformation.name.lower()
+        ):
+            return self._apply_transition(
+                session=get_session(url),
                 method=method,
                 url=url,
-                params=options,
+                params=dict(options, profile=self.profile)
+                if self.profile
+                else dict(options),
                 data=data,
                 mimetype=transform_mimetype,
-                store_result=self.store_result
-                and index == len(self.transformations) - 1,
+                store_result=store_result,
             )
 
-        return image, mimetype
-
     @staticmethod
     def _apply_transition(
         session: requests.Session,
@@ -102,12 +317,15 @@ class Transformations:
         mimetype: Optional[str],
         store_result: bool = False,
     ) -> Tuple[bytes, str]:
-        # TODO: Use tenacity to retry on status codes where it makes sense (e.g., 503)
+        # Connection errors and 502, 503 and 504 responses are retried with backoff by
+        # the session, see ProgImage.sessions.
         if store_result:
             params["store_result"] = "1"
 
         try:
-            args = dict(method=method, url=url, params=params, data=data,)
+            args = dict(
+                method=method, url=url, params=params, data=data, timeout=HTTP_TIMEOUT,
+            )
             if mimetype:
                 args["headers"] = {"Content-Type": mimetype}
 
@@ -115,8 +333,16 @@ class Transformations:
             response.raise_for_status()
             return response.content, response.headers["Content-Type"]
         except HTTPError as error:
-            if error.response is not None and error.response.status_code == 400:
+            response = error.response
+            status_code = response.status_code if response is not None else None
+            if status_code == 400:
                 raise ValueError(f"Invalid transformation: {error}") from error
+            if status_code == 404:
+                raise FileNotFoundError("Image doesn't exist.") from error
+            if status_code == 413:
+                raise ImageTooLarge(f"Image is too large: {error}") from error
+            if status_code == 429:
+                raise DecodeBudgetExceeded(f"Service is busy: {error}") from error
             raise TransformationError(error) from error
         except Exception as error:
             raise TransformationError(error) from error
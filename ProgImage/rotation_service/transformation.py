@@ -1,9 +1,9 @@
 from io import BytesIO
-from typing import Optional
+from typing import Optional, Tuple
 
 from PIL import Image
 
-from ProgImage import get_format_for_mimetype
+from ProgImage.formats import encode_image, get_format_for_mimetype
 
 transpose_option_mapping = {
     90: Image.ROTATE_90,
@@ -12,27 +12,51 @@ transpose_option_mapping = {
 }
 
 
+def _get_degrees(params: Optional[dict], name: str) -> int:
+    if not params or not params.get(name):
+        return 0
+    try:
+        return int(params[name])
+    except ValueError:
+        raise ValueError(f'"{name}" must be an integer number of degrees.')
+
+
+def get_rotation(params: Optional[dict] = None) -> Tuple[int, int]:
+    # Lossless transposition first, then a rotation by an arbitrary angle, both
+    # counter-clockwise.
+    transpose = _get_degrees(params, "transpose")
+    if transpose and transpose not in transpose_option_mapping:
+        raise ValueError("Invalid transpose option. Must be one of: 90, 180, 270")
+    return transpose, _get_degrees(params, "angle") % 360
+
+
+def get_output_size(
+    size: Tuple[int, int], params: Optional[dict] = None
+) -> Tuple[int, int]:
+    # Rotated images keep their size, transposing by 90 or 270 degrees swaps it.
+    transpose, _ = get_rotation(params)
+    return (size[1], size[0]) if transpose in (90, 270) else size
+
+
+def transform(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    # TODO: Expose more options like "expand" and "center"
+    # Rotated images keep their size, so the output is never larger than the input.
+    transpose, angle = get_rotation(params)
+
+    if transpose:
+        image = image.transpose(transpose_option_mapping[transpose])
+    if angle:
+        image = image.rotate(angle)
+
+    return image
+
+
 def transform_image(
     contents: bytes, mimetype: str, params: Optional[dict] = None
 ) -> bytes:
-    # TODO: Validate image rotation and transposition angle
-    # TODO: Expose more options like "expand" and "center"
-    transpose = int(params["transpose"]) if params and params.get("transpose") else 0
-    angle = int(params["angle"]) if params and params.get("angle") else 0
-
-    transformed_contents = BytesIO()
     image_format = get_format_for_mimetype(mimetype)
     with Image.open(BytesIO(contents)) as image:
-        if transpose:
-            try:
-                image = image.transpose(transpose_option_mapping[transpose])
-            except KeyError:
-                raise ValueError(
-                    "Invalid transpose option. Must be one of: 90, 180, 270"
-                )
-        if angle:
-            image = image.rotate(angle)
-
-        image.save(transformed_contents, format=image_format)
-
-    return transformed_contents.getvalue()
+        profile = params.get("profile") if params else None
+        return encode_image(
+            image, image_format, profile, lambda frame: transform(frame, params)
+        )
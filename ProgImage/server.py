@@ -1,43 +1,154 @@
-from typing import Tuple, Optional
+import concurrent.futures
+import hashlib
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple
 
-import requests
 from flask import Request, Flask, jsonify, Blueprint, Response, request
 from requests import RequestException
-from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError, NotFound
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import (
+    BadRequest,
+    GatewayTimeout,
+    HTTPException,
+    InternalServerError,
+    NotFound,
+    RequestEntityTooLarge,
+    ServiceUnavailable,
+    TooManyRequests,
+)
 
-from ProgImage.repository import ImageRepository
+from ProgImage import (
+    TRANSFORM_PROCESSES,
+    TRANSFORM_QUEUE_SIZE,
+    TRANSFORM_RETRY_AFTER,
+    TRANSFORM_TIMEOUT,
+)
+
+from ProgImage import metrics
+from ProgImage.formats import get_profile_name
+from ProgImage.limits import TOO_LARGE_ERRORS, DecodeBudgetExceeded, admit_contents
+from ProgImage.metrics import timed
+from ProgImage.repository import ImageRepository, parse_image_path
+from ProgImage.sessions import HTTP_TIMEOUT, get_session
 
 app = Flask(__name__)
+metrics.init_app(app)
+
+# Image ids are never reused, so any response validated by the content hash of the
+# image can be cached forever.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 
 @app.errorhandler(HTTPException)
 def generic_error_response(error):
-    return jsonify({"error": f"{error.name}: {error.description}"}), error.code
+    metrics.errors.inc(type=type(error).__name__)
+    # Keep headers like Retry-After, the body is replaced with JSON.
+    headers = [
+        (name, value) for name, value in error.get_headers() if name != "Content-Type"
+    ]
+    return jsonify({"error": f"{error.name}: {error.description}"}), error.code, headers
 
 
 @app.errorhandler(InternalServerError)
 def internal_error_response(error):
+    metrics.errors.inc(
+        type=type(getattr(error, "original_exception", None) or error).__name__
+    )
     return jsonify({"error": error.description}), error.code
 
 
+class DecodeBudgetFull(TooManyRequests):
+    def get_headers(self, environ=None):
+        return super().get_headers(environ) + [
+            ("Retry-After", str(TRANSFORM_RETRY_AFTER))
+        ]
+
+
+def image_too_large_response(error):
+    return generic_error_response(RequestEntityTooLarge(str(error)))
+
+
+def decode_budget_response(error):
+    return generic_error_response(DecodeBudgetFull(str(error)))
+
+
+# Resource limits of ProgImage.limits are raised from deep within the image processing.
+for _error in TOO_LARGE_ERRORS:
+    app.register_error_handler(_error, image_too_large_response)
+app.register_error_handler(DecodeBudgetExceeded, decode_budget_response)
+
+
+def get_last_modified(metadata: dict) -> Optional[datetime]:
+    if not metadata.get("Last-Modified"):
+        return None
+    # Naive UTC datetimes, which is what werkzeug's date parsing returns.
+    return datetime.fromtimestamp(metadata["Last-Modified"], timezone.utc).replace(
+        tzinfo=None
+    )
+
+
+def set_validators(
+    response: Response, etag: Optional[str], last_modified: Optional[datetime]
+) -> Response:
+    if etag:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified(
+    etag: Optional[str], last_modified: Optional[datetime]
+) -> Optional[Response]:
+    # Answers If-None-Match and If-Modified-Since before anything is fetched.
+    if not etag and not last_modified:
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
+
+
+def make_conditional(
+    response: Response,
+    etag: Optional[str],
+    last_modified: Optional[datetime],
+    complete_length: Optional[int] = None,
+) -> Response:
+    set_validators(response, etag, last_modified)
+    if complete_length is not None:
+        response.headers["Accept-Ranges"] = "bytes"
+    # Handles Range and If-Range requests.
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=complete_length
+    )
+
+
+def parse_uri_list(data: bytes) -> List[str]:
+    # This will be a list of URLs with potential comments in lines beginning with #.
+    # TODO: Handle encodings other than utf-8 or validate it at least.
+    uri_list = [
+        line.decode("utf-8").strip()
+        for line in data.replace(b"\r\n", b"\n").split(b"\n")
+        if len(line) > 0 and line[0] != ord("#")
+    ]
+    if len(uri_list) < 1:
+        raise BadRequest("At lest one URI must be in the list.")
+    return uri_list
+
+
 def parse_uri_or_binary(flask_request: Request) -> Tuple[bytes, str]:
     if flask_request.content_type and flask_request.content_type.startswith(
         "text/uri-list"
     ):
-        # This will be a list of URLs with potential comments in lines beginning with #.
-        # TODO: Handle encodings other than utf-8 or validate it at least.
-        uri_list = [
-            line.decode("utf-8").strip()
-            for line in flask_request.data.replace(b"\r\n", b"\n").split(b"\n")
-            if len(line) > 0 and line[0] != ord("#")
-        ]
-        if len(uri_list) < 1:
-            raise BadRequest("At lest one URI must be in the list.")
+        uri_list = parse_uri_list(flask_request.data)
         if len(uri_list) > 1:
             raise BadRequest("Multiple URIs per request are not supported.")
 
         try:
-            image_response = requests.get(uri_list[0])
+            image_response = get_session().get(uri_list[0], timeout=HTTP_TIMEOUT)
             image_response.raise_for_status()
             original_image = image_response.content
             content_type = image_response.headers.get("Content-Type")
@@ -60,21 +171,114 @@ def zero_transform(
     return contents
 
 
+class TransformUnavailable(ServiceUnavailable):
+    def get_headers(self, environ=None):
+        return super().get_headers(environ) + [
+            ("Retry-After", str(TRANSFORM_RETRY_AFTER))
+        ]
+
+
+class TransformQueueFull(TransformUnavailable):
+    description = "Too many transformations in progress, retry later."
+
+
+class TransformPoolBroken(TransformUnavailable):
+    description = "A transformation worker process died, retry later."
+
+
+class TransformExecutor:
+    # Runs transformations in a pool of worker processes, so CPU bound image processing
+    # neither blocks the request thread nor contends for the GIL. Jobs beyond the pool
+    # size queue up to queue_size, after that new jobs are rejected.
+    def __init__(self, processes: int, queue_size: int, timeout: float):
+        self.processes = processes
+        self.timeout = timeout
+
+        self._slots = threading.BoundedSemaphore(processes + queue_size)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # Created on first use, i.e. after gunicorn forked its workers.
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes
+                )
+            return self._pool
+
+    def run(self, function: Callable, *args) -> bytes:
+        if not self.processes:
+            return function(*args)
+
+        pool = self._get_pool()
+        if not self._slots.acquire(blocking=False):
+            raise TransformQueueFull()
+
+        try:
+            future = pool.submit(function, *args)
+        except BaseException as error:
+            self._slots.release()
+            if isinstance(error, BrokenProcessPool):
+                self._replace_pool(pool)
+                raise TransformPoolBroken() from error
+            raise
+        # The slot is only freed once the job finishes, even if the request timed out.
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise GatewayTimeout("Transformation timed out.")
+        except BrokenProcessPool as error:
+            self._replace_pool(pool)
+            raise TransformPoolBroken() from error
+
+    def _replace_pool(self, pool: concurrent.futures.ProcessPoolExecutor):
+        # A worker died (e.g. killed when out of memory), which breaks the whole pool.
+        # The next job starts a new one, unless another request replaced it already.
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+
 transform_function = zero_transform
+transform_executor = TransformExecutor(
+    processes=TRANSFORM_PROCESSES,
+    queue_size=TRANSFORM_QUEUE_SIZE,
+    timeout=TRANSFORM_TIMEOUT,
+)
 transform_blueprint = Blueprint("transform_blueprint", __name__)
 
 
-@transform_blueprint.route("/transform/<image_path>", methods=["GET"])
-def transform_from_repository(image_path: str):
-    try:
-        original_image, content_type = ImageRepository().retrieve(image_path)
-    except FileNotFoundError as error:
-        raise NotFound(error)
+def transform_response(
+    original_image: bytes, content_type: str, metadata: Optional[dict] = None
+) -> Response:
+    etag, last_modified = None, None
+    if metadata and not request.args.get("store_result"):
+        etag = _get_transform_etag(metadata, content_type)
+        last_modified = get_last_modified(metadata)
 
     try:
-        transformed_image = transform_function(
-            original_image, content_type, request.args
-        )
+        # Decoding, transforming and encoding, possibly in a worker process. The
+        # image's share of the decode budget is held in the request's process.
+        with admit_contents(original_image), timed(
+            "transform_job", transform_function.__module__
+        ):
+            transformed_image = transform_executor.run(
+                transform_function,
+                original_image,
+                content_type,
+                request.args.to_dict(),
+            )
     except ValueError as error:
         raise BadRequest(error)
 
@@ -82,27 +286,57 @@ def transform_from_repository(image_path: str):
         transformed_image = ImageRepository().store(transformed_image)
         content_type = "text/plain"
 
-    return Response(
+    response = Response(
         response=transformed_image, status=200, headers={"Content-Type": content_type},
     )
+    return make_conditional(response, etag, last_modified, len(transformed_image))
 
 
-@transform_blueprint.route("/transform/", methods=["POST"])
-def transform_from_image():
-    original_image, content_type = parse_uri_or_binary(request)
+def _get_transform_etag(metadata: dict, mimetype: str) -> Optional[str]:
+    # The result depends on the requested format of the image and on the effective
+    # encoding profile, besides the image and the transformation.
+    if not metadata.get("Content-Hash"):
+        return None
+
+    params = sorted(request.args.items(multi=True))
+    return hashlib.sha256(
+        "\n".join(
+            [
+                metadata["Content-Hash"],
+                mimetype,
+                get_profile_name(request.args.get("profile")),
+                f"{transform_function.__module__}.{transform_function.__name__}",
+                *(f"{name}={value}" for name, value in params),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
 
-    # TODO: Refactor this to remove the duplicate code.
+
+@transform_blueprint.route("/transform/<image_path>", methods=["GET"])
+def transform_from_repository(image_path: str):
+    repository = ImageRepository()
     try:
-        transformed_image = transform_function(
-            original_image, content_type, request.args
+        _, requested_mimetype = parse_image_path(image_path)
+        metadata = repository.metadata(image_path)
+
+        response = not_modified(
+            _get_transform_etag(metadata, requested_mimetype),
+            get_last_modified(metadata),
         )
+        if response and not request.args.get("store_result"):
+            return response
+
+        original_image, content_type = repository.retrieve(image_path)
+    except FileNotFoundError as error:
+        raise NotFound(error)
     except ValueError as error:
         raise BadRequest(error)
 
-    if request.args.get("store_result"):
-        transformed_image = ImageRepository().store(transformed_image)
-        content_type = "text/plain"
+    return transform_response(original_image, content_type, metadata)
 
-    return Response(
-        response=transformed_image, status=200, headers={"Content-Type": content_type},
-    )
+
+@transform_blueprint.route("/transform/", methods=["POST"])
+def transform_from_image():
+    original_image, content_type = parse_uri_or_binary(request)
+
+    return transform_response(original_image, content_type)
@@ -0,0 +1,50 @@
+import threading
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import TRANSFORM_WORKERS, HTTP_RETRIES, HTTP_RETRY_BACKOFF
+
+# Connect and read timeouts in seconds. Requests ignores timeouts set on the session,
+# so these have to be passed to each request.
+HTTP_TIMEOUT = (3.05, 20)
+
+_sessions: Dict[Optional[str], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session() -> requests.Session:
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        # Connection resets surface as read errors, which are only retried for the
+        # methods listed here. Transformations are safe to repeat.
+        allowed_methods=frozenset({"GET", "HEAD", "POST"}),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=TRANSFORM_WORKERS, max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url: Optional[str] = None) -> requests.Session:
+    # One process-wide session (and connection pool) per service, keyed by the origin
+    # of the URL. Without a URL the shared session for arbitrary hosts is returned.
+    origin = None
+    if url:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+
+    with _sessions_lock:
+        if origin not in _sessions:
+            _sessions[origin] = _create_session()
+        return _sessions[origin]
@@ -0,0 +1,74 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+# Keys are mapped onto a fixed number of lock files, unrelated keys sharing a lock file
+# only wait for each other occasionally.
+LOCK_STRIPES = 256
+
+
+# Coalesces concurrent calls with the same key: the first caller runs the function and
+# every caller arriving while it's in flight waits for, and shares, its result (or
+# exception). Nothing is cached once the call completes.
+#
+# With a lock directory the calls are also serialised across processes on the same
+# host (e.g. gunicorn workers) via file locks. The function runs once the lock is held,
+# so it should first check whether another process already stored its result.
+class SingleFlight:
+    def __init__(self, lock_dir: Optional[Union[str, Path]] = None):
+        self.lock_dir = Path(lock_dir) if lock_dir else None
+
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(("calls", "shared"), 0)
+
+    def do(self, key: str, function: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = concurrent.futures.Future()
+                self._counters["calls"] += 1
+            else:
+                self._counters["shared"] += 1
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            with self._process_lock(key):
+                result = function(*args, **kwargs)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._calls))
+
+    @contextmanager
+    def _process_lock(self, key: str):
+        if self.lock_dir is None:
+            yield
+            return
+
+        import fcntl  # POSIX only, so imported only when used.
+
+        stripe = int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16) % LOCK_STRIPES
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(self.lock_dir / f"{stripe}.lock"), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # Releases the lock.
@@ -1,5 +1,85 @@
-from uuid import uuid4
+import hashlib
+from functools import lru_cache
+from importlib import import_module
+from types import ModuleType
+from typing import Dict, Any, Optional
+from uuid import UUID, uuid4
+
+from .. import STORAGE_DEDUPLICATE
+
+ENGINE_TYPES = ("file", "s3", "tiered")
+
+# Metadata recorded for every uploaded image, so it can be validated and planned for
+# without fetching or decoding the contents.
+metadata_fields = {
+    "Width": int,
+    "Height": int,
+    "Mode": str,
+    "Format": str,
+    "Content-Length": int,
+    "Orientation": int,
+    "Content-Hash": str,
+}
 
 
 def generate_id() -> str:
     return str(uuid4())
+
+
+def get_content_id(
+    metadata: Optional[dict], contents: Optional[bytes] = None
+) -> Optional[str]:
+    # In content-addressed mode the id is derived from the SHA-256 of the contents,
+    # shaped like the random ids so clients can't tell them apart.
+    if not STORAGE_DEDUPLICATE:
+        return None
+
+    content_hash = (metadata or {}).get("Content-Hash")
+    if not content_hash and contents is not None:
+        content_hash = hashlib.sha256(contents).hexdigest()
+    if not content_hash:
+        return None
+
+    return str(UUID(bytes=bytes.fromhex(content_hash)[:16]))
+
+
+def serialize_metadata(metadata: Dict[str, Any]) -> Dict[str, str]:
+    # For engines which only store string key-value pairs (e.g. S3 user metadata).
+    return {
+        name.lower(): str(value)
+        for name, value in metadata.items()
+        if name in metadata_fields and value is not None
+    }
+
+
+def deserialize_metadata(metadata: Dict[str, str]) -> Dict[str, Any]:
+    return {
+        name: field_type(metadata[name.lower()])
+        for name, field_type in metadata_fields.items()
+        if name.lower() in metadata
+    }
+
+
+@lru_cache(maxsize=None)
+def get_engine(engine_type: str) -> ModuleType:
+    # Engines are imported on first use, so e.g. boto3 is only loaded (and credentials
+    # resolved) by processes which actually access S3.
+    if engine_type not in ENGINE_TYPES:
+        raise ValueError(
+            f"Invalid storage engine type. Choose one from: {', '.join(ENGINE_TYPES)}"
+        )
+    return import_module(f".{engine_type}", package=__name__)
+
+
+class LazyEngine:
+    # Stands in for the engine module until one of its attributes is first used.
+    def __init__(self, engine_type: str):
+        if engine_type not in ENGINE_TYPES:
+            raise ValueError(
+                "Invalid storage engine type. "
+                f"Choose one from: {', '.join(ENGINE_TYPES)}"
+            )
+        self.engine_type = engine_type
+
+    def __getattr__(self, name: str):
+        return getattr(get_engine(self.engine_type), name)
@@ -1,51 +1,267 @@
+import hashlib
+import io
 import json
 import os
+import shutil
+import struct
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, BinaryIO, Callable, Dict, List
 
-from . import generate_id
+from . import generate_id, get_content_id
 
 storage_path = Path(os.getenv("FILE_PATH", "/var/ProgImage"))
 images_path = storage_path / "images"
+# Flat layout of earlier versions, read until migrated with migrate_legacy_files.
 metadata_path = storage_path / "metadata"
+chunk_size = 64 * 1024  # Bytes.
 
-for _path in (storage_path, images_path, metadata_path):
-    if not _path.exists():
-        os.makedirs(str(_path))
+# Every image is a single file: the header, the JSON metadata and the contents.
+HEADER = struct.Struct(">4sI")
+MAGIC = b"PIM1"
+# Directories are created by the first write, importing the engine has no side effects.
+
+
+class _ContentsReader(io.RawIOBase):
+    # Read-only file object over the contents of an image file, positions are relative
+    # to the start of the contents so seeking (e.g. for Range requests) works.
+    def __init__(self, fp: io.FileIO, offset: int):
+        super().__init__()
+        self._fp = fp
+        self._offset = offset
+        self._size = os.fstat(fp.fileno()).st_size - offset
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._size - self._position)
+        if size <= 0:
+            return 0
+
+        chunk = os.pread(self._fp.fileno(), size, self._offset + self._position)
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        self._fp.close()
+        super().close()
 
 
 def _get_file_path(image_id: str) -> Path:
-    return storage_path / image_id
+    # Sharded by the hash of the id so no directory holds more than a few files.
+    digest = hashlib.sha256(image_id.encode("utf-8")).hexdigest()
+    return images_path / digest[:2] / digest[2:4] / image_id
+
+
+def _get_legacy_paths(image_id: str) -> Tuple[Path, Path]:
+    return storage_path / image_id, metadata_path / image_id
 
 
-def _get_metadata_path(image_id: str) -> Path:
-    return metadata_path / image_id
+def _write_file(
+    image_id: str,
+    mimetype: str,
+    metadata: Optional[dict],
+    write_contents: Callable[[BinaryIO], None],
+) -> Path:
+    file_path = _get_file_path(image_id)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    header = json.dumps({**(metadata or {}), "Content-Type": mimetype}).encode("utf-8")
+
+    # Written next to the final path and renamed once complete, so readers never see
+    # partially written images (and aborted uploads leave nothing behind). The contents
+    # are synced first, otherwise a crash after the rename can leave an empty file.
+    temp_path = file_path.with_name(f".{image_id}.{generate_id()}.tmp")
+    try:
+        with open(str(temp_path), "xb") as fp:
+            fp.write(HEADER.pack(MAGIC, len(header)))
+            fp.write(header)
+            write_contents(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(str(temp_path), str(file_path))
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+
+    return file_path
+
+
+def _open_file(image_id: str) -> Tuple[io.FileIO, dict, int]:
+    # Returns the open file, the metadata and the offset of the contents.
+    try:
+        fp = open(str(_get_file_path(image_id)), "rb", buffering=0)
+    except FileNotFoundError:
+        return _open_legacy_file(image_id)
+
+    try:
+        magic, header_size = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC:
+            raise OSError(f"Invalid image file {fp.name}.")
+        metadata = json.loads(fp.read(header_size).decode("utf-8"))
+    except BaseException:
+        fp.close()
+        raise
 
+    return fp, metadata, HEADER.size + header_size
 
-def _get_file_metadata(image_id: str) -> dict:
-    with open(metadata_path / image_id, "r", encoding="utf-8") as fp:
-        return json.loads(fp.read())
 
+def _open_legacy_file(image_id: str) -> Tuple[io.FileIO, dict, int]:
+    file_path, legacy_metadata_path = _get_legacy_paths(image_id)
+    try:
+        with open(str(legacy_metadata_path), "r", encoding="utf-8") as fp:
+            metadata = json.loads(fp.read())
+        return open(str(file_path), "rb", buffering=0), metadata, 0
+    except FileNotFoundError as error:
+        raise FileNotFoundError("Image doesn't exist.") from error
 
-def store(contents: bytes, mimetype: str, image_id: Optional[str] = None) -> str:
+
+def exists(image_id: str) -> bool:
+    return (
+        _get_file_path(image_id).exists()
+        or _get_legacy_paths(image_id)[1].exists()
+    )
+
+
+def store(
+    contents: bytes,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
     if not image_id:
-        image_id = generate_id()
+        image_id = get_content_id(metadata, contents)
+        if image_id and exists(image_id):
+            return image_id  # Duplicate, the contents are stored under this id.
+        image_id = image_id or generate_id()
 
-    with open(str(_get_file_path(image_id)), "wb") as fp:
-        fp.write(contents)
+    _write_file(image_id, mimetype, metadata, lambda fp: fp.write(contents))
+
+    return image_id
 
-    with open(str(_get_metadata_path(image_id)), "w", encoding="utf-8") as fp:
-        fp.write(json.dumps({"Content-Type": mimetype}))
+
+def store_stream(
+    stream: BinaryIO,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
+    if not image_id:
+        image_id = get_content_id(metadata)
+        if image_id and exists(image_id):
+            return image_id  # Duplicate, the contents are stored under this id.
+        image_id = image_id or generate_id()
+
+    _write_file(
+        image_id,
+        mimetype,
+        metadata,
+        lambda fp: shutil.copyfileobj(stream, fp, chunk_size),
+    )
 
     return image_id
 
 
+def store_many(images: List[Tuple[bytes, str, Optional[dict]]]) -> List[str]:
+    return [
+        store(contents, mimetype, metadata=metadata)
+        for contents, mimetype, metadata in images
+    ]
+
+
 def retrieve(image_id: str) -> Tuple[bytes, str]:
-    file_path = _get_file_path(image_id)
-    if not file_path.exists():
-        raise FileNotFoundError("Image doesn't exist.")
+    # The file is unbuffered, readall reads the rest of it into a single buffer sized
+    # from the file's size.
+    fp, metadata, _ = _open_file(image_id)
+    with fp:
+        return fp.readall(), metadata["Content-Type"]
+
+
+def retrieve_many(image_ids: List[str]) -> Dict[str, Tuple[bytes, str]]:
+    # Images which don't exist are left out.
+    images = {}
+    for image_id in image_ids:
+        try:
+            images[image_id] = retrieve(image_id)
+        except FileNotFoundError:
+            pass
+
+    return images
+
+
+def retrieve_stream(image_id: str) -> Tuple[BinaryIO, str]:
+    fp, metadata, offset = _open_file(image_id)
+
+    return _ContentsReader(fp, offset), metadata["Content-Type"]
+
+
+def retrieve_metadata(image_id: str) -> dict:
+    fp, metadata, _ = _open_file(image_id)
+    with fp:
+        # Copies of images stored elsewhere (e.g. by the tiered engine) keep the date
+        # of the original.
+        return {
+            "Last-Modified": int(os.fstat(fp.fileno()).st_mtime),
+            **metadata,
+        }
+
+
+def delete(image_id: str):
+    try:
+        _get_file_path(image_id).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def migrate_legacy_files() -> int:
+    # Moves the images of the flat layout into the sharded one. Each image stays
+    # readable throughout, as the legacy files are removed only once it's moved.
+    migrated = 0
+    if not storage_path.is_dir():
+        return migrated  # Nothing was ever stored.
+
+    with os.scandir(str(storage_path)) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+
+            file_path, legacy_metadata_path = _get_legacy_paths(entry.name)
+            try:
+                with open(str(legacy_metadata_path), "r", encoding="utf-8") as fp:
+                    metadata = json.loads(fp.read())
+            except FileNotFoundError:
+                continue  # Not an image or not completely stored.
+
+            mimetype = metadata.pop("Content-Type")
+            with open(str(file_path), "rb") as fp:
+                new_path = _write_file(
+                    entry.name,
+                    mimetype,
+                    metadata,
+                    lambda target: shutil.copyfileobj(fp, target, chunk_size),
+                )
+            # Keeps the Last-Modified date of the image.
+            stat = entry.stat()
+            os.utime(str(new_path), (stat.st_atime, stat.st_mtime))
 
-    metadata = _get_file_metadata(image_id)
+            legacy_metadata_path.unlink()
+            file_path.unlink()
+            migrated += 1
 
-    with open(str(file_path), "rb") as fp:
-        return fp.read(), metadata["Content-Type"]
+    return migrated
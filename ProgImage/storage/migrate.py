@@ -0,0 +1,18 @@
+"""Move the images of the file storage engine from the flat layout of earlier versions
+into the sharded layout. Uses the same FILE_PATH environment variable as the services,
+which keep serving the images during the migration."""
+import argparse
+
+from .file import migrate_legacy_files, storage_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.parse_args()
+
+    migrated = migrate_legacy_files()
+    print(f"Migrated {migrated} images in {storage_path}.")
+
+
+if __name__ == "__main__":
+    main()
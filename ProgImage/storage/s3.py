@@ -1,37 +1,242 @@
+import concurrent.futures
 import os
-from typing import Optional, Tuple
+import threading
+from contextlib import closing
+from typing import Optional, Tuple, BinaryIO, Dict, List
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-from . import generate_id
+from . import (
+    generate_id,
+    get_content_id,
+    serialize_metadata,
+    deserialize_metadata,
+)
 
 bucket_name = os.getenv("S3_BUCKET", "matepager-progimage")
-s3_bucket = boto3.resource("s3").Bucket(bucket_name)
+# Concurrent requests of each transfer and of the batch operations.
+transfer_concurrency = int(os.getenv("S3_TRANSFER_CONCURRENCY", 10))
+# The connection pool is shared by every thread of the process (e.g. the bulk workers)
+# and the transfer threads, botocore's default of 10 connections throttles them.
+client_config = Config(
+    max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50)),
+    retries={
+        "mode": os.getenv("S3_RETRY_MODE", "standard"),
+        "max_attempts": int(os.getenv("S3_MAX_ATTEMPTS", 5)),
+    },
+)
+# Objects larger than the threshold are transferred in concurrent parts, uploads via
+# multipart upload and downloads via ranged GETs.
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=transfer_concurrency,
+)
+
+# Ranged GETs are run in their own pool, so they can't be starved by batch operations.
+part_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=transfer_concurrency, thread_name_prefix="s3-part"
+)
+batch_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=transfer_concurrency, thread_name_prefix="s3-batch"
+)
+
+# Clients, unlike resources, are thread-safe. It's created on first use, which resolves
+# the region and credentials.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client("s3", config=client_config)
+        return _client
 
 
 def _get_key(image_id: str) -> str:
     return f"images/{image_id}"
 
 
-def store(contents: bytes, mimetype: str, image_id: Optional[str] = None) -> str:
+def _is_not_found(error: ClientError) -> bool:
+    return error.response["Error"]["Code"] in ("404", "NoSuchKey")
+
+
+def exists(image_id: str) -> bool:
+    try:
+        get_client().head_object(Bucket=bucket_name, Key=_get_key(image_id))
+        return True
+    except ClientError as error:
+        if _is_not_found(error):
+            return False
+        raise
+
+
+def store(
+    contents: bytes,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
+    if not image_id:
+        image_id = get_content_id(metadata, contents)
+        if image_id and exists(image_id):
+            return image_id  # Duplicate, the PUT is skipped.
+        image_id = image_id or generate_id()
+
+    get_client().put_object(
+        Bucket=bucket_name,
+        Key=_get_key(image_id),
+        Body=contents,
+        ContentType=mimetype,
+        Metadata=serialize_metadata(metadata or {}),
+    )
+
+    return image_id
+
+
+def store_stream(
+    stream: BinaryIO,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
     if not image_id:
-        image_id = generate_id()
+        image_id = get_content_id(metadata)
+        if image_id and exists(image_id):
+            return image_id  # Duplicate, the upload is skipped.
+        image_id = image_id or generate_id()
 
-    s3_bucket.put_object(
-        Key=_get_key(image_id), Body=contents, ContentType=mimetype,
+    get_client().upload_fileobj(
+        Fileobj=stream,
+        Bucket=bucket_name,
+        Key=_get_key(image_id),
+        ExtraArgs={
+            "ContentType": mimetype,
+            "Metadata": serialize_metadata(metadata or {}),
+        },
+        Config=transfer_config,
     )
 
     return image_id
 
 
+def store_many(images: List[Tuple[bytes, str, Optional[dict]]]) -> List[str]:
+    # Stores (contents, MIME type, metadata) tuples concurrently, returns their ids.
+    return list(
+        batch_executor.map(
+            lambda image: store(image[0], image[1], metadata=image[2]), images
+        )
+    )
+
+
+def _get_range(
+    image_id: str, start: int, end: int, etag: Optional[str] = None
+) -> dict:
+    # With an ETag, the range is only returned if the object hasn't been replaced.
+    args = dict(
+        Bucket=bucket_name, Key=_get_key(image_id), Range=f"bytes={start}-{end}"
+    )
+    if etag:
+        args["IfMatch"] = etag
+    try:
+        return get_client().get_object(**args)
+    except ClientError as error:
+        if _is_not_found(error):
+            raise FileNotFoundError("Image doesn't exist.") from error
+        raise
+
+
+def _read_range(image_id: str, start: int, end: int, etag: str) -> bytes:
+    with closing(_get_range(image_id, start, end, etag)["Body"]) as body:
+        return body.read()
+
+
+def _get_metadata(response: dict, content_length: int) -> dict:
+    return {
+        **deserialize_metadata(response["Metadata"]),
+        "Content-Type": response["ContentType"],
+        "Content-Length": content_length,
+        "Last-Modified": int(response["LastModified"].timestamp()),
+    }
+
+
+def retrieve_with_metadata(image_id: str, retries: int = 1) -> Tuple[bytes, dict]:
+    # The first part is requested as a range, so small images take a single GET and
+    # the total size of larger ones is known to fetch the other parts concurrently.
+    # The other parts must match the ETag of the first one, if the object is replaced
+    # in the meantime it is read again.
+    part_size = transfer_config.multipart_chunksize
+    try:
+        response = _get_range(image_id, 0, part_size - 1)
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "InvalidRange":  # Empty object.
+            return b"", retrieve_metadata(image_id)
+        raise
+
+    with closing(response["Body"]) as body:
+        first_part = body.read()
+    size = int(response.get("ContentRange", "/0").rsplit("/", 1)[-1])
+    metadata = _get_metadata(response, max(size, len(first_part)))
+    if size <= len(first_part):
+        return first_part, metadata
+
+    parts = part_executor.map(
+        lambda start: _read_range(
+            image_id, start, start + part_size - 1, response["ETag"]
+        ),
+        range(part_size, size, part_size),
+    )
+    try:
+        return b"".join([first_part, *parts]), metadata
+    except ClientError as error:
+        is_replaced = error.response["Error"]["Code"] in ("412", "PreconditionFailed")
+        if is_replaced and retries:
+            return retrieve_with_metadata(image_id, retries - 1)
+        raise
+
+
 def retrieve(image_id: str) -> Tuple[bytes, str]:
+    contents, metadata = retrieve_with_metadata(image_id)
+    return contents, metadata["Content-Type"]
+
+
+def retrieve_many(image_ids: List[str]) -> Dict[str, Tuple[bytes, str]]:
+    # Retrieves the images concurrently, images which don't exist are left out.
+    def retrieve_or_none(image_id: str) -> Optional[Tuple[bytes, str]]:
+        try:
+            return retrieve(image_id)
+        except FileNotFoundError:
+            return None
+
+    images = zip(image_ids, batch_executor.map(retrieve_or_none, image_ids))
+    return {image_id: image for image_id, image in images if image is not None}
+
+
+def retrieve_stream(image_id: str) -> Tuple[BinaryIO, str]:
     try:
-        s3_object = s3_bucket.Object(_get_key(image_id))
-        response = s3_object.get()
-        return response["Body"].read(), response["ContentType"]
+        response = get_client().get_object(Bucket=bucket_name, Key=_get_key(image_id))
+        # The StreamingBody is passed through so the contents are read lazily.
+        return response["Body"], response["ContentType"]
     except ClientError as error:
-        if error.response["Error"]["Code"] == "NoSuchKey":
+        if _is_not_found(error):
             raise FileNotFoundError("Image doesn't exist.") from error
         else:
             raise
+
+
+def retrieve_metadata(image_id: str) -> dict:
+    try:
+        # HEAD request, the contents are not fetched.
+        response = get_client().head_object(Bucket=bucket_name, Key=_get_key(image_id))
+    except ClientError as error:
+        if _is_not_found(error):
+            raise FileNotFoundError("Image doesn't exist.") from error
+        else:
+            raise
+
+    return _get_metadata(response, response["ContentLength"])
@@ -0,0 +1,236 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional, Tuple, BinaryIO, Dict, List
+
+from . import file, s3
+from ..metrics import timed
+from ..singleflight import SingleFlight
+
+# The file engine (on a local disk, see FILE_PATH) is a read-through and write-through
+# cache in front of the S3 engine, which stays the source of truth. The size limit
+# applies to each process, see CacheIndex.
+cache_size = int(os.getenv("TIERED_CACHE_SIZE", 1_000_000_000))  # Bytes.
+cache_max_age = float(os.getenv("TIERED_CACHE_MAX_AGE", 7 * 24 * 3600))  # Seconds.
+
+
+# LRU index of the images in the cache tier, bounded by their total size. Every process
+# keeps its own index, built from the files in the cache on first use. Images cached by
+# other processes later on aren't in it, so processes sharing a disk can fill it up to
+# their number times max_size.
+class CacheIndex:
+    def __init__(self, max_size: int, max_age: float):
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self._items: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._size = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ("hits", "misses", "evictions", "bytes_saved"), 0
+        )
+
+    def get(self, image_id: str) -> bool:
+        # Returns whether the image is cached (and fresh), and counts the hit or miss.
+        with self._lock:
+            self._load()
+            item = self._items.get(image_id)
+            if item is not None and time.time() - item[1] > self.max_age:
+                self._remove(image_id)
+                self._counters["evictions"] += 1
+                item = None
+
+            if item is None:
+                self._counters["misses"] += 1
+                return False
+
+            self._items.move_to_end(image_id)
+            self._counters["hits"] += 1
+            self._counters["bytes_saved"] += item[0]
+            return True
+
+    def put(self, image_id: str, size: int):
+        with self._lock:
+            self._load()
+            if image_id in self._items:
+                self._size -= self._items[image_id][0]
+            self._items[image_id] = (size, time.time())
+            self._size += size
+
+            while self._size > self.max_size and self._items:
+                self._remove(next(iter(self._items)))
+                self._counters["evictions"] += 1
+
+    def discard(self, image_id: str):
+        with self._lock:
+            if image_id in self._items:
+                self._remove(image_id)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+            self._loaded = False
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            requests = self._counters["hits"] + self._counters["misses"]
+            return dict(
+                self._counters,
+                hit_ratio=self._counters["hits"] / requests if requests else 0.0,
+                items=len(self._items),
+                size=self._size,
+            )
+
+    def _remove(self, image_id: str):
+        size, _ = self._items.pop(image_id)
+        self._size -= size
+        file.delete(image_id)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+
+        cached = []
+        for directory, _, file_names in os.walk(str(file.images_path)):
+            for file_name in file_names:
+                if file_name.startswith("."):
+                    continue  # Temporary files of writes in progress.
+                try:
+                    stat = os.stat(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    continue
+                cached.append((stat.st_mtime, file_name, stat.st_size))
+
+        for mtime, image_id, size in sorted(cached):
+            self._items[image_id] = (size, mtime)
+            self._size += size
+
+
+cache_index = CacheIndex(max_size=cache_size, max_age=cache_max_age)
+# Concurrent misses for the same image are fetched from S3 only once.
+fills = SingleFlight()
+
+
+def _cache(
+    contents: bytes,
+    image_id: str,
+    metadata: Optional[dict],
+    mimetype: Optional[str] = None,
+):
+    # Written images keep their upload date, the same date as the copy in S3.
+    metadata = {"Last-Modified": int(time.time()), **(metadata or {})}
+    mimetype = mimetype or metadata.pop("Content-Type")
+    try:
+        file.store(contents, mimetype, image_id=image_id, metadata=metadata)
+    except OSError:
+        return  # The cache is only an optimisation (e.g. the disk is full).
+    cache_index.put(image_id, len(contents))
+
+
+def _fill(image_id: str) -> Tuple[bytes, dict]:
+    with timed("cache_fill", "s3"):
+        contents, metadata = s3.retrieve_with_metadata(image_id)
+    _cache(contents, image_id, metadata)
+    return contents, metadata
+
+
+def _retrieve_cached(image_id: str) -> Optional[Tuple[bytes, str]]:
+    if not cache_index.get(image_id):
+        return None
+    try:
+        return file.retrieve(image_id)
+    except FileNotFoundError:
+        cache_index.discard(image_id)  # Evicted by another process.
+        return None
+
+
+def exists(image_id: str) -> bool:
+    return file.exists(image_id) or s3.exists(image_id)
+
+
+def store(
+    contents: bytes,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
+    image_id = s3.store(contents, mimetype, image_id=image_id, metadata=metadata)
+    _cache(contents, image_id, metadata, mimetype)
+
+    return image_id
+
+
+def store_stream(
+    stream: BinaryIO,
+    mimetype: str,
+    image_id: Optional[str] = None,
+    metadata: Optional[dict] = None,
+) -> str:
+    image_id = s3.store_stream(stream, mimetype, image_id=image_id, metadata=metadata)
+
+    # Spooled uploads can be read again to populate the cache.
+    if getattr(stream, "seekable", lambda: False)():
+        stream.seek(0)
+        _cache(stream.read(), image_id, metadata, mimetype)
+
+    return image_id
+
+
+def store_many(images: List[Tuple[bytes, str, Optional[dict]]]) -> List[str]:
+    image_ids = s3.store_many(images)
+    for image_id, (contents, mimetype, metadata) in zip(image_ids, images):
+        _cache(contents, image_id, metadata, mimetype)
+
+    return image_ids
+
+
+def retrieve(image_id: str) -> Tuple[bytes, str]:
+    cached = _retrieve_cached(image_id)
+    if cached:
+        return cached
+
+    contents, metadata = fills.do(image_id, _fill, image_id)
+    return contents, metadata["Content-Type"]
+
+
+def retrieve_many(image_ids: List[str]) -> Dict[str, Tuple[bytes, str]]:
+    # Images which don't exist are left out.
+    def retrieve_or_none(image_id: str) -> Optional[Tuple[bytes, str]]:
+        try:
+            return retrieve(image_id)
+        except FileNotFoundError:
+            return None
+
+    images = zip(image_ids, s3.batch_executor.map(retrieve_or_none, image_ids))
+    return {image_id: image for image_id, image in images if image is not None}
+
+
+def retrieve_stream(image_id: str) -> Tuple[BinaryIO, str]:
+    if cache_index.get(image_id):
+        try:
+            return file.retrieve_stream(image_id)
+        except FileNotFoundError:
+            cache_index.discard(image_id)
+
+    contents, metadata = fills.do(image_id, _fill, image_id)
+    return BytesIO(contents), metadata["Content-Type"]
+
+
+def retrieve_metadata(image_id: str) -> dict:
+    # Only the cached copy is looked up, a miss doesn't fetch the contents.
+    try:
+        return file.retrieve_metadata(image_id)
+    except FileNotFoundError:
+        return s3.retrieve_metadata(image_id)
+
+
+def stats() -> Dict[str, float]:
+    return dict(
+        cache_index.stats(),
+        **{f"fills_{name}": value for name, value in fills.stats().items()},
+    )
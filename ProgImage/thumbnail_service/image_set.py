@@ -0,0 +1,57 @@
+from flask import Blueprint, Response, jsonify, request, url_for
+from werkzeug.exceptions import BadRequest, NotFound
+
+from .transformation import transform_image_set
+from .. import server
+from ..limits import admit_contents
+from ..metrics import timed
+from ..repository import ImageRepository
+
+image_set_blueprint = Blueprint("image_set_blueprint", __name__)
+
+
+@image_set_blueprint.route("/transform-set/<image_path>", methods=["POST"])
+def transform_set_from_repository(image_path: str) -> Response:
+    # Generates a responsive image set (e.g. for srcset) from a single decode of the
+    # original, stores every image in one batch and returns their ids. This app doesn't
+    # serve stored images as they are, their locations are transformations at their
+    # own size.
+    repository = ImageRepository()
+    try:
+        original_image, content_type = repository.retrieve(image_path)
+        with admit_contents(original_image), timed(
+            "transform_job", transform_image_set.__module__
+        ):
+            images = server.transform_executor.run(
+                transform_image_set,
+                original_image,
+                content_type,
+                request.args.to_dict(),
+            )
+    except FileNotFoundError as error:
+        raise NotFound(error)
+    except ValueError as error:
+        raise BadRequest(error)
+
+    stored_paths = repository.store_many([image.contents for image in images])
+
+    response = jsonify(
+        source=image_path,
+        images=[
+            {
+                "id": stored_path,
+                "location": url_for(
+                    "transform_blueprint.transform_from_repository",
+                    image_path=stored_path,
+                    size=f"{image.width}*{image.height}",
+                    _external=True,
+                ),
+                "width": image.width,
+                "height": image.height,
+                "mimetype": image.mimetype,
+            }
+            for stored_path, image in zip(stored_paths, images)
+        ],
+    )
+    response.status_code = 201
+    return response
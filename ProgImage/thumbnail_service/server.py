@@ -1,5 +1,6 @@
 import os
 
+from .image_set import image_set_blueprint
 from .transformation import transform_image
 from .. import server
 from ..server import app
@@ -7,6 +8,7 @@ from ..server import app
 server.transform_function = transform_image
 
 app.register_blueprint(server.transform_blueprint)
+app.register_blueprint(image_set_blueprint)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=os.environ.get("PORT"))
@@ -1,25 +1,246 @@
+import math
+import struct
 from io import BytesIO
-from typing import Optional
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 
-from ProgImage import get_format_for_mimetype
+from ProgImage import THUMBNAIL_REDUCING_GAP, THUMBNAIL_USE_EXIF, limits
+from ProgImage.formats import (
+    encode_image,
+    get_format_for_mimetype,
+    get_mimetype_for_path,
+    is_animated,
+)
+from ProgImage.limits import check_output_size
+
+EXIF_HEADER = b"Exif\x00\x00"
+EXIF_THUMBNAIL_OFFSET = 0x0201
+EXIF_THUMBNAIL_LENGTH = 0x0202
+EXIF_SHORT = 3
+# Maximum number of images (widths times formats) in a responsive image set.
+MAX_IMAGE_SET_SIZE = 24
+
+
+class SizedImage(NamedTuple):
+    width: int
+    height: int
+    mimetype: str
+    contents: bytes
+
+
+def get_size(params: Optional[dict] = None) -> Tuple[int, int]:
+    # TODO: Check args and return 400 for unknown ones
+    if not params or not params.get("size"):
+        return 200, 200
+
+    try:
+        width, height = (int(dim.strip()) for dim in params["size"].split("*"))
+    except ValueError:
+        raise ValueError('"size" must be "<width>*<height>", e.g. "200*200".')
+    if width < 1 or height < 1:
+        raise ValueError('"size" must be positive.')
+    check_output_size(width, height)
+    return width, height
+
+
+def _round_aspect(number: float, key: Callable[[int], float]) -> int:
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def get_output_size(
+    size: Tuple[int, int], params: Optional[dict] = None
+) -> Tuple[int, int]:
+    # Size of the thumbnail of an image of the given size, rounded like
+    # Image.thumbnail does. Images are only ever downscaled.
+    max_width, max_height = get_size(params)
+    width, height = size
+    if max_width >= width and max_height >= height:
+        return size
+
+    aspect = width / height
+    if max_width / max_height >= aspect:
+        width = _round_aspect(
+            max_height * aspect, key=lambda n: abs(aspect - n / max_height)
+        )
+        return width, max_height
+    height = _round_aspect(
+        max_width / aspect,
+        key=lambda n: 0 if n == 0 else abs(aspect - max_width / n),
+    )
+    return max_width, height
+
+
+def _get_exif_thumbnail(image: Image.Image) -> Optional[Image.Image]:
+    # Cameras embed a small JPEG preview in the EXIF data (IFD1). It can be read from
+    # the raw EXIF block without decoding the main image.
+    exif = image.info.get("exif")
+    if not exif or not exif.startswith(EXIF_HEADER):
+        return None
+
+    tiff = exif[len(EXIF_HEADER) :]
+    try:
+        byte_order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        (ifd0_offset,) = struct.unpack_from(byte_order + "L", tiff, 4)
+        (entry_count,) = struct.unpack_from(byte_order + "H", tiff, ifd0_offset)
+        (ifd1_offset,) = struct.unpack_from(
+            byte_order + "L", tiff, ifd0_offset + 2 + entry_count * 12
+        )
+        if not ifd1_offset:
+            return None
+
+        (entry_count,) = struct.unpack_from(byte_order + "H", tiff, ifd1_offset)
+        tags = {}
+        for index in range(entry_count):
+            entry_offset = ifd1_offset + 2 + index * 12
+            tag, tag_type = struct.unpack_from(byte_order + "HH", tiff, entry_offset)
+            value_format = "H" if tag_type == EXIF_SHORT else "L"
+            (tags[tag],) = struct.unpack_from(
+                byte_order + value_format, tiff, entry_offset + 8
+            )
+
+        offset = tags.get(EXIF_THUMBNAIL_OFFSET)
+        length = tags.get(EXIF_THUMBNAIL_LENGTH)
+        if not offset or not length or offset + length > len(tiff):
+            return None
+
+        exif_thumbnail = Image.open(BytesIO(tiff[offset : offset + length]))
+        exif_thumbnail.load()
+        return exif_thumbnail
+    except (KeyError, struct.error, UnidentifiedImageError, OSError):
+        return None
+
+
+def _is_usable_exif_thumbnail(
+    image: Image.Image, exif_thumbnail: Image.Image, size: Tuple[int, ...]
+) -> bool:
+    if exif_thumbnail.mode != image.mode:
+        return False
+
+    # Previews are often letterboxed to 4:3, those can't be used.
+    aspect = image.width / image.height
+    if abs(exif_thumbnail.width / exif_thumbnail.height - aspect) > aspect * 0.01:
+        return False
+
+    # The preview has to be at least as large as the requested thumbnail.
+    scale = min(size[0] / image.width, size[1] / image.height, 1)
+    return (
+        exif_thumbnail.width >= image.width * scale
+        and exif_thumbnail.height >= image.height * scale
+    )
+
+
+def transform(image: Image.Image, params: Optional[dict] = None) -> Image.Image:
+    size = get_size(params)
+
+    if THUMBNAIL_USE_EXIF:
+        exif_thumbnail = _get_exif_thumbnail(image)
+        if exif_thumbnail and _is_usable_exif_thumbnail(image, exif_thumbnail, size):
+            # The preview keeps the EXIF data of the image, e.g. its orientation.
+            exif_thumbnail.info["exif"] = image.info["exif"]
+            image = exif_thumbnail
+
+    # With a reducing gap, Image.thumbnail uses Image.draft to decode JPEGs at a
+    # reduced scale (only if the image hasn't been loaded yet) and reduces the image
+    # in integer steps before resampling.
+    image.thumbnail(size, reducing_gap=THUMBNAIL_REDUCING_GAP)
+    return image
 
 
 def transform_image(
     contents: bytes, mimetype: str, params: Optional[dict] = None
 ) -> bytes:
-    # TODO: Validate thumbnail size
-    # TODO: Check args and return 400 for unknown ones
-    if params and params.get("size"):
-        size = tuple(int(dim.strip()) for dim in params["size"].split("*"))
-    else:
-        size = (200, 200)
-
-    transformed_contents = BytesIO()
     image_format = get_format_for_mimetype(mimetype)
     with Image.open(BytesIO(contents)) as image:
-        image.thumbnail(size)
-        image.save(transformed_contents, format=image_format)
+        profile = params.get("profile") if params else None
+        return encode_image(
+            image, image_format, profile, lambda frame: transform(frame, params)
+        )
+
+
+def get_widths(params: Optional[dict] = None) -> List[int]:
+    # Largest first, each size of a set is derived from the previous one.
+    try:
+        widths = {int(width) for width in params["widths"].split(",")}
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('"widths" must be a comma separated list of integers.')
+    if min(widths) < 1:
+        raise ValueError('"widths" must be positive.')
+    check_output_size(max(widths), 1)
+    return sorted(widths, reverse=True)
+
+
+def get_mimetypes(mimetype: str, params: Optional[dict] = None) -> List[str]:
+    # Formats are given by their extension, e.g. "webp,jpg". Defaults to the source's.
+    if not params or not params.get("formats"):
+        return [mimetype]
+
+    mimetypes = []
+    for extension in params["formats"].split(","):
+        extension_mimetype = get_mimetype_for_path(f"image.{extension.strip()}")
+        if not extension_mimetype:
+            raise ValueError(f'Unknown image format: "{extension}"')
+        if extension_mimetype not in mimetypes:
+            mimetypes.append(extension_mimetype)
+    return mimetypes
+
+
+def _get_max_height(image: Image.Image) -> int:
+    # Only the widths of a set are requested, its heights follow from the image's
+    # aspect ratio within the output size limit.
+    return min(image.height, limits.MAX_OUTPUT_DIMENSION)
+
+
+def transform_image_set(
+    contents: bytes, mimetype: str, params: Optional[dict] = None
+) -> List[SizedImage]:
+    # Responsive image set: every width in every format, from a single decode of the
+    # original. Sizes are downscaled progressively, each one from the previous (larger)
+    # one instead of the original. Widths larger than the original aren't upscaled.
+    widths = get_widths(params)
+    mimetypes = get_mimetypes(mimetype, params)
+    if len(widths) * len(mimetypes) > MAX_IMAGE_SET_SIZE:
+        raise ValueError(f"Image sets are limited to {MAX_IMAGE_SET_SIZE} images.")
+    profile = params.get("profile") if params else None
+
+    images = []
+    with Image.open(BytesIO(contents)) as image:
+        if is_animated(image):
+            # Frames are transformed while encoding, each size decodes them again.
+            # Formats without animations get the first frame, which is the image
+            # itself and mustn't be resized in place.
+            for width in widths:
+                frame_params = {"size": f"{width}*{_get_max_height(image)}"}
+                for image_mimetype in mimetypes:
+                    sized_contents = encode_image(
+                        image,
+                        get_format_for_mimetype(image_mimetype),
+                        profile,
+                        lambda frame: transform(
+                            image.copy() if frame is image else frame, frame_params
+                        ),
+                    )
+                    with Image.open(BytesIO(sized_contents)) as sized_image:
+                        size = sized_image.size
+                    images.append(SizedImage(*size, image_mimetype, sized_contents))
+            return images
+
+        # The original is only decoded for the largest size (at a reduced scale for
+        # JPEGs), the smaller sizes are reduced from the previous one in place.
+        height = _get_max_height(image)
+        sized_image, previous_size = image, None
+        for width in widths:
+            sized_image = transform(sized_image, {"size": f"{width}*{height}"})
+            if sized_image.size == previous_size:
+                continue  # Widths beyond the original's all result in the original.
+            previous_size = sized_image.size
+
+            for image_mimetype in mimetypes:
+                sized_contents = encode_image(
+                    sized_image, get_format_for_mimetype(image_mimetype), profile
+                )
+                images.append(
+                    SizedImage(*sized_image.size, image_mimetype, sized_contents)
+                )
 
-    return transformed_contents.getvalue()
+    return images
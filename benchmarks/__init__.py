@@ -0,0 +1,123 @@
+import math
+import multiprocessing
+import resource
+import statistics
+import time
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+
+
+def create_image(
+    size: Tuple[int, int], image_format: str = "JPEG", quality: int = 90
+) -> bytes:
+    # Noise compresses badly, which makes the image as expensive to decode as a photo.
+    image = Image.merge(
+        "RGB", [Image.effect_noise(size, 64).convert("L") for _ in range(3)]
+    )
+    contents = BytesIO()
+    image.save(contents, format=image_format, quality=quality)
+    return contents.getvalue()
+
+
+def _run_isolated(function: Callable, repeat: int, results):
+    # Peak RSS is per process, so each case runs in its own process and only the
+    # increase over the RSS before the first run is reported.
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((timings, peak - baseline))
+
+
+def _measure_isolated(function: Callable, repeat: int) -> Tuple[List[float], int]:
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=_run_isolated, args=(function, repeat, results))
+    process.start()
+    timings, peak_rss = results.get()
+    process.join()
+    return timings, peak_rss
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    # Nearest-rank percentile, so it's always one of the measured values.
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(
+    timings: Sequence[float],
+    elapsed: Optional[float] = None,
+    peak_rss_mb: Optional[float] = None,
+) -> Dict[str, float]:
+    # Latency percentiles and throughput of a series of operations. Without the elapsed
+    # (wall clock) time they are assumed to have run one after another.
+    elapsed = elapsed if elapsed is not None else sum(timings)
+    return {
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "ops_per_s": len(timings) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb if peak_rss_mb is not None else float("nan"),
+    }
+
+
+def measure_distribution(function: Callable, repeat: int = 20) -> Dict[str, float]:
+    timings, peak_rss = _measure_isolated(function, repeat)
+    return summarize(timings, peak_rss_mb=peak_rss / 1024)
+
+
+def measure(function: Callable, repeat: int = 5) -> Dict[str, float]:
+    timings, peak_rss = _measure_isolated(function, repeat)
+
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "peak_rss_mb": peak_rss / 1024,  # ru_maxrss is in KiB on Linux.
+    }
+
+
+# Lower is better for every metric except the throughput.
+HIGHER_IS_BETTER = {"ops_per_s"}
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+    metrics: Sequence[str],
+) -> Tuple[Dict[str, Dict[str, float]], List[str]]:
+    # Relative change of every metric in percent, positive is worse.
+    changes, regressions = {}, []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes[name] = {}
+        for metric in metrics:
+            before, after = baseline[name].get(metric), result.get(metric)
+            if not before or after is None or after != after:  # Missing or NaN.
+                changes[name][metric] = float("nan")
+                continue
+            change = (after - before) / before * 100
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            changes[name][metric] = change
+            if change > threshold:
+                regressions.append(f"{name} {metric}: {change:+.1f}%")
+    return changes, regressions
+
+
+def print_table(results: Dict[str, Dict[str, float]]):
+    columns = list(next(iter(results.values())))
+    width = max(len(name) for name in results) + 2
+    print("".ljust(width) + "".join(column.rjust(14) for column in columns))
+    for name, result in results.items():
+        print(
+            name.ljust(width)
+            + "".join(f"{result[column]:14.1f}" for column in columns)
+        )
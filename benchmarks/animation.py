@@ -0,0 +1,78 @@
+"""
+Thumbnails and conversion of large animated GIFs: materialized vs. streamed frames.
+
+    python -m benchmarks.animation [--width 1600] [--height 1200] [--frames 60]
+"""
+import argparse
+from io import BytesIO
+
+from PIL import Image, ImageSequence
+
+from ProgImage.formats import encode_image
+from ProgImage.thumbnail_service.transformation import transform_image
+from . import measure, print_table
+
+
+def create_animation(size, frame_count: int) -> bytes:
+    frames = [
+        Image.effect_noise(size, 16 + index % 48).convert("L")
+        for index in range(frame_count)
+    ]
+    contents = BytesIO()
+    frames[0].save(
+        contents, format="GIF", save_all=True, append_images=frames[1:], duration=40
+    )
+    return contents.getvalue()
+
+
+def materialized_thumbnail(contents: bytes, size: int):
+    # Every frame is decoded up front and held until the animation is encoded.
+    with Image.open(BytesIO(contents)) as image:
+        frames = [frame.copy() for frame in ImageSequence.Iterator(image)]
+        for frame in frames:
+            frame.thumbnail((size, size))
+        frames[0].save(
+            BytesIO(), format="GIF", save_all=True, append_images=frames[1:]
+        )
+
+
+def streamed_thumbnail(contents: bytes, size: int):
+    transform_image(contents, "image/gif", {"size": f"{size}*{size}"})
+
+
+def streamed_conversion(contents: bytes):
+    with Image.open(BytesIO(contents)) as image:
+        encode_image(image, "WEBP", "fast")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    contents = create_animation((args.width, args.height), args.frames)
+    print(
+        f"{args.width}x{args.height} GIF with {args.frames} frames "
+        f"({len(contents) / 1e6:.1f} MB)"
+    )
+    print_table(
+        {
+            "materialized thumbnail": measure(
+                lambda: materialized_thumbnail(contents, args.size), args.repeat
+            ),
+            "streamed thumbnail": measure(
+                lambda: streamed_thumbnail(contents, args.size), args.repeat
+            ),
+            "streamed WebP conversion": measure(
+                lambda: streamed_conversion(contents), args.repeat
+            ),
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Encoding time against output size of every encoding profile.
+
+    python -m benchmarks.encoding [--image tests/fixtures/test1.jpg] [--size 1000]
+"""
+import argparse
+from pathlib import Path
+
+from PIL import Image
+
+from ProgImage.formats import encode_image, encoding_profiles, is_saveable
+from . import measure, print_table
+
+DEFAULT_IMAGE = Path(__file__).parent.parent / "tests" / "fixtures" / "test1.jpg"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image", type=Path, default=DEFAULT_IMAGE)
+    parser.add_argument(
+        "--size", type=int, default=1000, help="Downscale the image to fit this size."
+    )
+    parser.add_argument("--formats", default="JPEG,PNG,WEBP,AVIF")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with Image.open(args.image) as image:
+        image.thumbnail((args.size, args.size))
+        print(f"{args.image.name} at {image.width}x{image.height}")
+
+        results = {}
+        for image_format in args.formats.split(","):
+            if not is_saveable(image_format):
+                print(f"Skipping {image_format}, this PIL build can't save it.")
+                continue
+
+            for profile in encoding_profiles:
+                size = len(encode_image(image, image_format, profile))
+                result = measure(
+                    lambda: encode_image(image, image_format, profile), args.repeat
+                )
+                results[f"{image_format} {profile}"] = {
+                    "median_ms": result["median_ms"],
+                    "size_kb": size / 1024,
+                }
+
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
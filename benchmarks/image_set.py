@@ -0,0 +1,51 @@
+"""
+Responsive image sets: one thumbnail request per size vs. a single decode.
+
+    python -m benchmarks.image_set [--width 6000] [--height 4000] [--widths 1600,...]
+"""
+import argparse
+
+from ProgImage.thumbnail_service.transformation import (
+    transform_image,
+    transform_image_set,
+)
+from . import create_image, measure, print_table
+
+
+def separate_thumbnails(contents: bytes, widths: str):
+    # One request per width, each decodes the original again.
+    for width in widths.split(","):
+        transform_image(
+            contents, "image/jpeg", {"size": f"{width}*{width}", "profile": "fast"}
+        )
+
+
+def image_set(contents: bytes, widths: str):
+    transform_image_set(contents, "image/jpeg", {"widths": widths, "profile": "fast"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--widths", default="1600,1280,960,640,320")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    contents = create_image((args.width, args.height))
+    print(
+        f"{args.width}x{args.height} JPEG ({len(contents) / 1e6:.1f} MB) "
+        f"-> widths {args.widths}"
+    )
+    print_table(
+        {
+            "separate thumbnails": measure(
+                lambda: separate_thumbnails(contents, args.widths), args.repeat
+            ),
+            "image set": measure(lambda: image_set(contents, args.widths), args.repeat),
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Startup time of the service entry points, measured with python -X importtime.
+
+    python -m benchmarks.startup [--storage file,s3] [--repeat 5] [--top 10]
+        [--output startup.json] [--baseline startup.json] [--threshold 20]
+
+Each entry point is imported in a fresh interpreter, as on a cold start of a container.
+The report lists the import time of the entry point, the wall clock time of the whole
+process, the number of imported modules and the slowest packages each entry point
+imports. Saved results can be compared with a later run to catch regressions.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from . import compare, print_table
+
+ENTRY_POINTS = (
+    "ProgImage.repository_service.server",
+    "ProgImage.thumbnail_service.server",
+    "ProgImage.rotation_service.server",
+)
+COMPARED_METRICS = ("import_ms", "wall_ms", "modules")
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| \s*(\S+)$")
+
+
+class ImportTime(NamedTuple):
+    module: str
+    cumulative_ms: float
+
+
+def parse_import_times(report: str) -> List[ImportTime]:
+    # Lines look like "import time: <self us> | <cumulative us> | <indented module>".
+    import_times = []
+    for line in report.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            cumulative, module = match.groups()
+            import_times.append(ImportTime(module, int(cumulative) / 1000))
+    return import_times
+
+
+def get_packages(import_times: List[ImportTime]) -> List[ImportTime]:
+    # Top-level packages (e.g. flask, PIL, boto3), slowest first. Their cumulative time
+    # includes their submodules, but not the modules imported from other packages.
+    packages = [item for item in import_times if "." not in item.module]
+    return sorted(packages, key=lambda item: -item.cumulative_ms)
+
+
+def measure_startup(
+    module: str, environment: Dict[str, str], repeat: int
+) -> Dict[str, object]:
+    import_ms, wall_ms = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            env=environment,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        wall_ms.append((time.perf_counter() - start) * 1000)
+        import_times = parse_import_times(process.stderr)
+        import_ms.append(
+            next(item for item in import_times if item.module == module).cumulative_ms
+        )
+
+    # Which modules are imported doesn't change between runs, the last one is used.
+    return {
+        "import_ms": statistics.median(import_ms),
+        "wall_ms": statistics.median(wall_ms),
+        "modules": len(import_times),
+        "packages": get_packages(import_times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--storage", default="file,s3", help="Storage engine types.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Slowest packages to list.")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON.")
+    parser.add_argument("--baseline", type=Path, help="Compare with saved results.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="Percentage a metric may get worse before it's reported as regression.",
+    )
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="progimage-startup-")
+    results, slowest_packages = {}, {}
+    try:
+        for storage in args.storage.split(","):
+            environment = dict(
+                os.environ,
+                STORAGE=storage,
+                FILE_PATH=os.path.join(work_dir, "images"),
+                EAGER_QUEUE_PATH=os.path.join(work_dir, "eager.sqlite3"),
+            )
+            for module in ENTRY_POINTS:
+                name = f"{module.split('.')[1]} ({storage})"
+                result = measure_startup(module, environment, args.repeat)
+                slowest_packages[name] = result.pop("packages")[: args.top]
+                results[name] = result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    for name, packages in slowest_packages.items():
+        print(f"\nSlowest packages of {name}:")
+        for item in packages:
+            print(f"  {item.cumulative_ms:8.1f} ms  {item.module}")
+
+    if args.output:
+        args.output.write_text(
+            json.dumps({"python": sys.version, "results": results}, indent=2)
+        )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        changes, regressions = compare(
+            results, baseline, args.threshold, COMPARED_METRICS
+        )
+        if changes:
+            print(f"\nChange against {args.baseline} in percent, positive is worse:")
+            print_table(changes)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Micro-benchmarks and load scenarios of the image pipeline, with JSON output and a
+comparison against a saved baseline.
+
+    python -m benchmarks.suite [--micro] [--load] [--output results.json]
+        [--baseline baseline.json] [--threshold 10]
+
+Micro-benchmarks cover ImageRepository.store/retrieve on the file and the S3 engine
+(mocked with moto), the transformations of each service and format conversions across
+a corpus of sizes and formats. Load scenarios start the repository, thumbnail and
+rotation services locally (file storage, derivative cache disabled so every request is
+transformed) and send single GETs, chained transformations and bulk requests.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from io import BytesIO
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# The storage engines read their settings on import, the benchmarks must never touch
+# real images.
+WORK_DIR = Path(tempfile.mkdtemp(prefix="progimage-benchmarks-"))
+os.environ["FILE_PATH"] = str(WORK_DIR / "micro")
+os.environ["S3_BUCKET"] = "progimage-benchmarks"
+os.environ["EAGER_QUEUE_PATH"] = str(WORK_DIR / "eager.sqlite3")
+
+import PIL
+import requests
+from PIL import Image
+
+from ProgImage.formats import encode_image
+from ProgImage.repository import ImageRepository
+from ProgImage.rotation_service.transformation import transform_image as rotate
+from ProgImage.storage import file as file_storage
+from ProgImage.thumbnail_service.transformation import (
+    transform_image as thumbnail,
+    transform_image_set,
+)
+from . import compare, create_image, measure_distribution, print_table, summarize
+
+SERVICES = ("repository_service", "thumbnail_service", "rotation_service")
+COMPARED_METRICS = ("p50_ms", "p95_ms", "p99_ms", "ops_per_s", "peak_rss_mb")
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def convert(contents: bytes, image_format: str) -> bytes:
+    with Image.open(BytesIO(contents)) as image:
+        return encode_image(image, image_format)
+
+
+@contextmanager
+def mocked_s3() -> Iterator[Optional[object]]:
+    # moto is a test dependency, without it the S3 engine is skipped.
+    try:
+        from moto import mock_s3
+    except ImportError:
+        print("Skipping the S3 engine, moto isn't installed.")
+        yield None
+        return
+
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "testing")
+    with mock_s3():
+        from ProgImage.storage import s3
+
+        client = s3.get_client()
+        region = client.meta.region_name
+        if region and region != "us-east-1":
+            client.create_bucket(
+                Bucket=s3.bucket_name,
+                CreateBucketConfiguration={"LocationConstraint": region},
+            )
+        else:
+            client.create_bucket(Bucket=s3.bucket_name)
+        yield s3
+
+
+def run_micro(args) -> Dict[str, Dict[str, float]]:
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    formats = args.formats.split(",")
+    corpus = {
+        (size, image_format): create_image(size, image_format)
+        for size in sizes
+        for image_format in formats
+    }
+
+    cases: Dict[str, Callable] = {}
+    with ExitStack() as stack:
+        engines = {"file": file_storage, "s3": stack.enter_context(mocked_s3())}
+        contents = corpus[(sizes[0], "JPEG")]
+        for name, engine in engines.items():
+            if engine is None:
+                continue
+            repository = ImageRepository()
+            repository.storage = engine
+            image_path = repository.store(contents)
+            cases[f"store {name}"] = lambda r=repository: r.store(contents)
+            cases[f"retrieve {name}"] = lambda r=repository, p=image_path: r.retrieve(p)
+
+        for size in sizes:
+            label = "{}x{}".format(*size)
+            jpeg = corpus[(size, "JPEG")]
+            cases[f"thumbnail {label}"] = lambda c=jpeg: thumbnail(
+                c, "image/jpeg", {"size": "200*200"}
+            )
+            cases[f"rotate {label}"] = lambda c=jpeg: rotate(
+                c, "image/jpeg", {"angle": "90"}
+            )
+            cases[f"image set {label}"] = lambda c=jpeg: transform_image_set(
+                c, "image/jpeg", {"widths": "1280,640,320"}
+            )
+
+        for (size, source_format), source in corpus.items():
+            for target_format in formats:
+                if target_format != source_format:
+                    name = "convert {}->{} {}x{}".format(
+                        source_format, target_format, *size
+                    )
+                    cases[name] = lambda c=source, f=target_format: convert(c, f)
+
+        results = {}
+        for name, case in cases.items():
+            results[name] = measure_distribution(case, args.repeat)
+            print(f"{name}: p50 {results[name]['p50_ms']:.1f} ms", file=sys.stderr)
+        return results
+
+
+def _get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url + "metrics", timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def _read_peak_rss(pid: int) -> float:
+    # VmHWM is the peak RSS of the process, in KiB (Linux only).
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def _reset_peak_rss(pid: int):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def run_services() -> Iterator[Tuple[str, List[int]]]:
+    ports = {service: _get_free_port() for service in SERVICES}
+    urls = {service: f"http://127.0.0.1:{port}/" for service, port in ports.items()}
+    environment = dict(
+        os.environ,
+        STORAGE="file",
+        FILE_PATH=str(WORK_DIR / "services"),
+        TRANSFORM_MODE="remote",
+        THUMBNAIL_TRANSFORMATION_URL=urls["thumbnail_service"],
+        ROTATE_TRANSFORMATION_URL=urls["rotation_service"],
+        DERIVATIVE_CACHE_SIZE="0",
+        DERIVATIVE_CACHE_STORAGE="0",
+    )
+
+    processes = []
+    try:
+        for service in SERVICES:
+            processes.append(
+                subprocess.Popen(
+                    [sys.executable, "-m", f"ProgImage.{service}.server"],
+                    env=dict(environment, PORT=str(ports[service])),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+        for url in urls.values():
+            _wait_until_ready(url)
+        yield urls["repository_service"], [process.pid for process in processes]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def run_scenario(
+    send: Callable[[requests.Session, int], requests.Response],
+    count: int,
+    concurrency: int,
+    pids: List[int],
+) -> Dict[str, float]:
+    sessions = threading.local()
+
+    def timed_request(index: int) -> float:
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        send(sessions.session, index).raise_for_status()
+        return time.perf_counter() - start
+
+    for pid in pids:
+        _reset_peak_rss(pid)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        timings = list(pool.map(timed_request, range(count)))
+        elapsed = time.perf_counter() - start
+
+    return summarize(
+        timings, elapsed, peak_rss_mb=sum(_read_peak_rss(pid) for pid in pids)
+    )
+
+
+def run_load(args) -> Dict[str, Dict[str, float]]:
+    contents = create_image(parse_size(args.sizes.split(",")[-1]), "JPEG")
+
+    with run_services() as (url, pids):
+        image_paths = [
+            requests.post(url + "images/", data=contents).json()["id"]
+            for _ in range(args.bulk_entries)
+        ]
+        bulk = {image_path: {"thumbnail-size": "200*200"} for image_path in image_paths}
+
+        scenarios = {
+            "load GET original": (
+                lambda session, index: session.get(url + f"images/{image_paths[0]}"),
+                args.requests,
+            ),
+            "load GET thumbnail+rotate": (
+                lambda session, index: session.get(
+                    url + f"images/{image_paths[0]}",
+                    params={"thumbnail-size": "200*200", "rotate-angle": "90"},
+                ),
+                args.requests,
+            ),
+            f"load bulk {args.bulk_entries} entries": (
+                lambda session, index: session.post(url + "bulk/", json=bulk),
+                max(args.requests // args.bulk_entries, 1),
+            ),
+        }
+
+        results = {}
+        for name, (send, count) in scenarios.items():
+            results[name] = run_scenario(send, count, args.concurrency, pids)
+            print(f"{name}: p50 {results[name]['p50_ms']:.1f} ms", file=sys.stderr)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--micro", action="store_true", help="Run micro-benchmarks.")
+    parser.add_argument("--load", action="store_true", help="Run load scenarios.")
+    parser.add_argument("--sizes", default="640x480,1920x1080")
+    parser.add_argument("--formats", default="JPEG,PNG,WEBP")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--bulk-entries", type=int, default=10)
+    parser.add_argument("--output", type=Path, help="Write the results as JSON.")
+    parser.add_argument("--baseline", type=Path, help="Compare with saved results.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Percentage a metric may get worse before it's reported as regression.",
+    )
+    args = parser.parse_args()
+    if not args.micro and not args.load:
+        args.micro = args.load = True
+
+    results = {}
+    try:
+        if args.micro:
+            results.update(run_micro(args))
+        if args.load:
+            results.update(run_load(args))
+    finally:
+        shutil.rmtree(str(WORK_DIR), ignore_errors=True)
+    print_table(results)
+
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "environment": {
+                        "python": platform.python_version(),
+                        "pillow": PIL.__version__,
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                    },
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        changes, regressions = compare(
+            results, baseline, args.threshold, COMPARED_METRICS
+        )
+        if changes:
+            print(f"\nChange against {args.baseline} in percent, positive is worse:")
+            print_table(changes)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Thumbnail latency and peak memory: Image.thumbnail vs. the thumbnail service.
+
+    python -m benchmarks.thumbnail [--width 6000] [--height 4000] [--size 200]
+"""
+import argparse
+import struct
+from io import BytesIO
+
+from PIL import Image
+
+from ProgImage.thumbnail_service.transformation import transform
+from . import create_image, measure, print_table
+
+# Width of the preview embedded in the EXIF data, like the previews of cameras.
+PREVIEW_WIDTH = 320
+
+
+def add_exif_preview(contents: bytes) -> bytes:
+    # Little-endian TIFF header, an empty IFD0 and IFD1 pointing to a JPEG preview with
+    # the aspect ratio of the image.
+    with Image.open(BytesIO(contents)) as image:
+        preview_height = round(PREVIEW_WIDTH * image.height / image.width)
+        preview = BytesIO()
+        image.resize((PREVIEW_WIDTH, preview_height)).save(preview, format="JPEG")
+        preview = preview.getvalue()
+
+        ifd1_offset = 8 + 2 + 4
+        preview_offset = ifd1_offset + 2 + 2 * 12 + 4
+        exif = (
+            b"Exif\x00\x00II*\x00"
+            + struct.pack("<L", 8)
+            + struct.pack("<HL", 0, ifd1_offset)
+            + struct.pack("<H", 2)
+            + struct.pack("<HHLL", 0x0201, 4, 1, preview_offset)
+            + struct.pack("<HHLL", 0x0202, 4, 1, len(preview))
+            + struct.pack("<L", 0)
+            + preview
+        )
+        result = BytesIO()
+        image.save(result, format="JPEG", quality=90, exif=exif)
+        return result.getvalue()
+
+
+def pillow_thumbnail(contents: bytes, size: int):
+    # The baseline: Image.thumbnail with its defaults, which already decodes JPEGs at
+    # a reduced scale (reducing_gap=2.0).
+    with Image.open(BytesIO(contents)) as image:
+        image.thumbnail((size, size))
+
+
+def service_thumbnail(contents: bytes, size: int):
+    with Image.open(BytesIO(contents)) as image:
+        transform(image, {"size": f"{size}*{size}"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=6000)
+    parser.add_argument("--height", type=int, default=4000)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    contents = create_image((args.width, args.height))
+    with_preview = add_exif_preview(contents)
+    print(
+        f"{args.width}x{args.height} JPEG ({len(contents) / 1e6:.1f} MB) "
+        f"-> {args.size}x{args.size} thumbnail"
+    )
+    print_table(
+        {
+            "Image.thumbnail": measure(
+                lambda: pillow_thumbnail(contents, args.size), args.repeat
+            ),
+            "service": measure(
+                lambda: service_thumbnail(contents, args.size), args.repeat
+            ),
+            "service, EXIF preview": measure(
+                lambda: service_thumbnail(with_preview, args.size), args.repeat
+            ),
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 FIXTURE_DIR = Path(__file__).parent / "fixtures"
@@ -6,6 +7,10 @@ FIXTURE_DIR = Path(__file__).parent / "fixtures"
 os.environ["STORAGE"] = "s3"
 os.environ["S3_BUCKET"] = "test-bucket"
 
+# Eager derivatives are generated by the tests themselves, not by background threads.
+os.environ["EAGER_WORKERS"] = "0"
+os.environ["EAGER_QUEUE_PATH"] = os.path.join(tempfile.mkdtemp(), "eager.sqlite3")
+
 os.environ["FLASK_DEBUG"] = "1"
 os.environ["IS_OFFLINE"] = "1"
 
@@ -31,3 +31,29 @@ def s3_jpeg_fixture_1(jpeg_fixture_1, mock_s3_storage):
         Key="images/test-file-1",
         Body=jpeg_fixture_1,
     )
+
+
+@pytest.fixture
+def local_mode(monkeypatch):
+    from ProgImage.repository_service import bulk, transformations
+
+    monkeypatch.setattr(transformations, "TRANSFORM_MODE", "local")
+    monkeypatch.setattr(bulk, "TRANSFORM_MODE", "local")
+
+
+@pytest.fixture(autouse=True)
+def empty_derivative_cache():
+    from ProgImage.repository import derivative_cache
+
+    derivative_cache.clear()
+    yield derivative_cache
+    derivative_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def empty_metadata_index():
+    from ProgImage.repository import metadata_index
+
+    metadata_index.clear()
+    yield metadata_index
+    metadata_index.clear()
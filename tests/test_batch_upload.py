@@ -0,0 +1,149 @@
+import json
+from io import BytesIO
+
+import pytest
+from flask import Request
+
+from ProgImage.repository_service import server
+
+
+@pytest.mark.usefixtures("mock_s3_storage")
+class TestBatchUpload:
+    def test_files_are_stored_with_results_in_request_order(
+        self, mock_s3_storage, jpeg_fixture_1
+    ):
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data={
+                    "images": [
+                        (BytesIO(jpeg_fixture_1), "first.jpg"),
+                        (BytesIO(b"I'm a text file"), "notes.txt"),
+                        (BytesIO(jpeg_fixture_1), "second.jpg"),
+                    ]
+                },
+                content_type="multipart/form-data",
+            )
+            assert response.status_code == 200, response.data
+            results = json.loads(response.data)["images"]
+
+        assert [result["image"] for result in results] == [
+            "first.jpg",
+            "notes.txt",
+            "second.jpg",
+        ]
+        assert results[0]["id"].endswith(".jpg")
+        assert results[0]["location"].endswith(f"/images/{results[0]['id']}")
+        assert results[1]["status"] == 400
+        assert results[2]["id"] != results[0]["id"]
+
+        objects = mock_s3_storage.list_objects(Bucket="test-bucket")["Contents"]
+        assert len(objects) == 2
+
+    def test_results_are_streamed_as_ndjson(self, jpeg_fixture_1):
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data={
+                    "first": (BytesIO(jpeg_fixture_1), "first.jpg"),
+                    "second": (BytesIO(jpeg_fixture_1), "second.jpg"),
+                },
+                content_type="multipart/form-data",
+                headers={"Accept": "application/x-ndjson"},
+            )
+            assert response.status_code == 200, response.data
+            assert response.headers["Content-Type"] == "application/x-ndjson"
+            lines = [json.loads(line) for line in response.data.splitlines()]
+
+        assert {line["image"] for line in lines} == {"first.jpg", "second.jpg"}
+        assert all(line["id"].endswith(".jpg") for line in lines)
+
+    def test_uris_are_downloaded(self, requests_mock, jpeg_fixture_1):
+        requests_mock.get(
+            "http://images.example/photo.jpg",
+            content=jpeg_fixture_1,
+            headers={"Content-Type": "image/jpeg"},
+        )
+        requests_mock.get("http://images.example/missing.jpg", status_code=404)
+
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data=b"# Photos\r\n"
+                b"http://images.example/photo.jpg\r\n"
+                b"http://images.example/missing.jpg\r\n",
+                content_type="text/uri-list",
+            )
+            assert response.status_code == 200, response.data
+            photo, missing = json.loads(response.data)["images"]
+
+        assert photo["image"] == "http://images.example/photo.jpg"
+        assert photo["id"].endswith(".jpg")
+        assert missing["status"] == 400
+        assert "Unable to download image" in missing["error"]
+
+    def test_uris_share_one_session(self, requests_mock, jpeg_fixture_1, monkeypatch):
+        from ProgImage import sessions
+
+        monkeypatch.setattr(sessions, "_sessions", {})
+        for host in ("a.example", "b.example"):
+            requests_mock.get(
+                f"http://{host}/photo.jpg",
+                content=jpeg_fixture_1,
+                headers={"Content-Type": "image/jpeg"},
+            )
+
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data=b"http://a.example/photo.jpg\nhttp://b.example/photo.jpg",
+                content_type="text/uri-list",
+            )
+            assert response.status_code == 200, response.data
+
+        assert list(sessions._sessions) == [None]
+
+    def test_too_many_images_result_in_400(self, monkeypatch):
+        monkeypatch.setattr(server, "MAX_BATCH_UPLOAD_ITEMS", 1)
+
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data=b"http://images.example/1.jpg\nhttp://images.example/2.jpg",
+                content_type="text/uri-list",
+            )
+            assert response.status_code == 400, response.data
+            assert b"limited to 1 images" in response.data
+
+    def test_oversized_batch_is_rejected_before_parsing(self, monkeypatch):
+        monkeypatch.setattr(server, "MAX_BATCH_UPLOAD_ITEMS", 2)
+        monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 10)
+
+        def fail(request):
+            raise AssertionError("The body shouldn't be parsed.")
+
+        monkeypatch.setattr(Request, "files", property(fail))
+        monkeypatch.setattr(Request, "get_data", fail)
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/",
+                data={"image": (BytesIO(b"x" * 21), "image.jpg")},
+                content_type="multipart/form-data",
+            )
+            assert response.status_code == 400, response.data
+            assert b"must not exceed" in response.data
+
+            response = client.post(
+                "/images/batch/",
+                data=b"http://images.example/" + b"x" * 2 * server.MAX_URI_LENGTH,
+                content_type="text/uri-list",
+            )
+            assert response.status_code == 400, response.data
+            assert b"must not exceed" in response.data
+
+    def test_other_content_types_result_in_415(self, jpeg_fixture_1):
+        with server.app.test_client() as client:
+            response = client.post(
+                "/images/batch/", data=jpeg_fixture_1, content_type="image/jpeg"
+            )
+            assert response.status_code == 415, response.data
@@ -0,0 +1,131 @@
+import json
+import time
+
+import pytest
+
+from ProgImage.repository_service import bulk, transformations
+from ProgImage.repository_service.transformations import ImageTransformation
+
+
+@pytest.mark.usefixtures("local_mode", "s3_jpeg_fixture_1")
+class TestBulk:
+    def test_results_are_streamed_as_ndjson(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post(
+                "/bulk/",
+                json={
+                    "test-file-1.jpg": {"thumbnail-size": "10*10"},
+                    "test-file-1.png": {"rotate-transpose": "45"},
+                    "unknown.jpg": {"thumbnail-size": "10*10"},
+                },
+                headers={"Accept": "application/x-ndjson"},
+            )
+            assert response.status_code == 200, response.data
+            assert response.headers["Content-Type"] == "application/x-ndjson"
+
+            lines = [json.loads(line) for line in response.data.splitlines()]
+            results = {line.pop("image"): line for line in lines}
+
+        assert set(results) == {"test-file-1.jpg", "test-file-1.png", "unknown.jpg"}
+        assert results["test-file-1.jpg"]["id"].endswith(".jpg")
+        assert results["test-file-1.png"]["status"] == 400
+        assert "transpose" in results["test-file-1.png"]["error"]
+        assert results["unknown.jpg"]["status"] == 404
+
+    def test_json_response_contains_real_errors(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post(
+                "/bulk/",
+                json={
+                    "test-file-1.jpg": {"thumbnail-size": "10*10"},
+                    "unknown.jpg": {"thumbnail-size": "10*10"},
+                },
+            )
+            assert response.status_code == 200, response.data
+            results = json.loads(response.data)
+
+        assert results["test-file-1.jpg"].endswith(".jpg")
+        assert results["unknown.jpg"] == {
+            "error": "Image doesn't exist.",
+            "status": 404,
+        }
+
+    def test_slow_entries_time_out(self, monkeypatch):
+        def slow_thumbnail(image, params=None):
+            time.sleep(1)
+            return image
+
+        monkeypatch.setitem(
+            transformations.local_transformations,
+            ImageTransformation.THUMBNAIL,
+            slow_thumbnail,
+        )
+
+        chain = transformations.Transformations.from_query_params(
+            {"thumbnail-size": "10*10"}
+        )
+        results = dict(bulk.run_bulk({"test-file-1.jpg": chain}, timeout=0.1))
+        assert results["test-file-1.jpg"]["status"] == 504
+
+    def test_entries_timed_out_while_fetching_are_not_transformed(
+        self, monkeypatch
+    ):
+        from ProgImage.repository import storage_engine
+
+        retrieve_many = storage_engine.retrieve_many
+        transformed = []
+
+        def slow_retrieve_many(image_ids):
+            time.sleep(0.3)
+            return retrieve_many(image_ids)
+
+        def record_thumbnail(image, params=None):
+            transformed.append(image)
+            return image
+
+        monkeypatch.setattr(storage_engine, "retrieve_many", slow_retrieve_many)
+        monkeypatch.setitem(
+            transformations.local_transformations,
+            ImageTransformation.THUMBNAIL,
+            record_thumbnail,
+        )
+
+        chain = transformations.Transformations.from_query_params(
+            {"thumbnail-size": "10*10"}
+        )
+        results = dict(bulk.run_bulk({"test-file-1.jpg": chain}, timeout=0.1))
+        assert results["test-file-1.jpg"]["status"] == 504
+
+        time.sleep(0.5)  # The entry's thread finishes fetching the image.
+        assert transformed == []
+
+    def test_images_are_fetched_in_batches(self, monkeypatch, jpeg_fixture_1):
+        from ProgImage.repository import ImageRepository, storage_engine
+
+        image_paths = [ImageRepository().store(jpeg_fixture_1) for _ in range(4)]
+        batches = []
+        retrieve_many = storage_engine.retrieve_many
+
+        def record_batch(image_ids):
+            batches.append(image_ids)
+            return retrieve_many(image_ids)
+
+        monkeypatch.setattr(storage_engine, "retrieve_many", record_batch)
+
+        chain = transformations.Transformations.from_query_params(
+            {"thumbnail-size": "10*10"}, store_result=True
+        )
+        results = dict(
+            bulk.run_bulk(
+                {image_path: chain for image_path in [*image_paths, "unknown.jpg"]},
+                concurrency=2,
+            )
+        )
+
+        assert all(results[image_path].endswith(".jpg") for image_path in image_paths)
+        assert results["unknown.jpg"]["status"] == 404
+        assert sorted(len(batch) for batch in batches) == [1, 2, 2]
@@ -0,0 +1,80 @@
+from ProgImage.cache import DerivativeCache, derivative_key
+
+
+class FakeStorage:
+    def __init__(self):
+        self.objects = {}
+
+    def store(self, contents, mimetype, image_id=None):
+        self.objects[image_id] = (contents, mimetype)
+        return image_id
+
+    def retrieve(self, image_id):
+        try:
+            return self.objects[image_id]
+        except KeyError:
+            raise FileNotFoundError("Image doesn't exist.")
+
+
+class TestDerivativeKey:
+    def test_key_is_prefixed_with_image_id(self):
+        assert derivative_key("abc", "image/png").startswith("abc--")
+
+    def test_key_depends_on_mimetype_and_transformations(self):
+        keys = {
+            derivative_key("abc", "image/png"),
+            derivative_key("abc", "image/jpeg"),
+            derivative_key("abc", "image/png", "thumbnail(size=10*10)"),
+        }
+        assert len(keys) == 3
+
+    def test_key_depends_on_effective_profile(self, monkeypatch):
+        from ProgImage import formats
+
+        key = derivative_key("abc", "image/webp")
+        assert derivative_key("abc", "image/webp", profile="balanced") == key
+        assert derivative_key("abc", "image/webp", profile="fast") != key
+
+        monkeypatch.setattr(formats, "ENCODING_PROFILE", "fast")
+        assert derivative_key("abc", "image/webp") != key
+
+
+class TestDerivativeCache:
+    def test_lru_eviction_is_size_bounded(self):
+        cache = DerivativeCache(max_size=10)
+        cache.put("a", b"12345", "image/png")
+        cache.put("b", b"12345", "image/png")
+        assert cache.get("a") is not None  # "b" is now the least recently used.
+        cache.put("c", b"12345", "image/png")
+
+        assert cache.get("b") is None
+        assert cache.get("a") == (b"12345", "image/png")
+        assert cache.get("c") == (b"12345", "image/png")
+        assert cache.stats() == {
+            "hits": 3,
+            "storage_hits": 0,
+            "misses": 1,
+            "evictions": 1,
+            "items": 2,
+            "size": 10,
+        }
+
+    def test_large_items_are_not_kept_in_memory(self):
+        storage = FakeStorage()
+        cache = DerivativeCache(max_size=10, max_item_size=4, storage=storage)
+        cache.put("a", b"12345", "image/png")
+
+        assert cache.stats()["items"] == 0
+        assert storage.objects["a"] == (b"12345", "image/png")
+
+    def test_storage_tier_is_used_on_memory_miss(self):
+        storage = FakeStorage()
+        storage.store(b"123", "image/png", image_id="a")
+        cache = DerivativeCache(max_size=10, storage=storage)
+
+        assert cache.get("a", use_storage=False) is None
+        assert cache.get("a") == (b"123", "image/png")
+        assert cache.get("a") == (b"123", "image/png")
+        assert cache.get("b") is None
+        stats = cache.stats()
+        assert (stats["hits"], stats["storage_hits"], stats["misses"]) == (1, 1, 1)
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+from ProgImage.jobs import JobQueue
+
+
+@pytest.fixture
+def eager_queue(tmp_path, monkeypatch):
+    from ProgImage import repository
+    from ProgImage.repository_service import transformations
+    from ProgImage.repository_service.derivatives import eager_workers
+
+    queue = JobQueue(tmp_path / "eager.sqlite3")
+    monkeypatch.setattr(repository, "eager_queue", queue)
+    monkeypatch.setattr(eager_workers, "queue", queue)
+    monkeypatch.setattr(transformations, "TRANSFORM_MODE", "local")
+    yield queue
+
+
+class TestJobQueue:
+    def test_jobs_survive_restarts(self, tmp_path):
+        queue = JobQueue(tmp_path / "queue.sqlite3")
+        assert queue.put([{"image": "a.jpg"}, {"image": "b.jpg"}]) == 2
+
+        job = queue.claim()
+        assert (job.payload, job.attempts) == ({"image": "a.jpg"}, 1)
+
+        restarted_queue = JobQueue(tmp_path / "queue.sqlite3")
+        assert restarted_queue.claim().payload == {"image": "b.jpg"}
+        assert restarted_queue.claim() is None
+
+        restarted_queue.complete(job)
+        stats = restarted_queue.stats()
+        assert (stats["depth"], stats["in_progress"]) == (1, 1)
+        assert 0 <= stats["lag"] < 60
+
+    def test_expired_claims_are_retried(self, tmp_path):
+        queue = JobQueue(tmp_path / "queue.sqlite3", lease=0.1, max_attempts=2)
+        queue.put(["job"])
+
+        job = queue.claim()
+        assert queue.claim() is None
+        time.sleep(0.2)
+        assert queue.claim().attempts == 2  # The lease of the first claim expired.
+
+        assert queue.release(job._replace(attempts=1))
+        assert not queue.release(queue.claim())
+        assert queue.stats()["depth"] == 0
+
+    def test_expired_claims_run_out_of_attempts(self, tmp_path):
+        queue = JobQueue(tmp_path / "queue.sqlite3", lease=0.1, max_attempts=2)
+        queue.put(["job"])
+
+        assert queue.claim().attempts == 1
+        time.sleep(0.2)
+        assert queue.claim().attempts == 2
+        assert queue.stats()["in_progress"] == 1
+
+        time.sleep(0.2)
+        assert queue.stats()["in_progress"] == 0
+        assert queue.claim() is None
+        stats = queue.stats()
+        assert (stats["depth"], stats["dropped"]) == (0, 1)
+
+
+class TestEagerDerivatives:
+    def test_presets_are_generated_after_upload(
+        self, eager_queue, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository import derivative_cache
+        from ProgImage.repository_service.derivatives import eager_workers
+        from ProgImage.repository_service.server import app
+        from ProgImage.repository_service.transformations import Transformations
+
+        with app.test_client() as client:
+            response = client.post(
+                "/images/?eager=?thumbnail-size=100*100&eager=.webp",
+                data=jpeg_fixture_1,
+            )
+            assert response.status_code == 201, response.data
+            image_path = response.json["id"]
+
+            assert client.get("/stats/").json["eager"]["depth"] == 2
+            assert eager_workers.run_pending() == 2
+            assert client.get("/stats/").json["eager"]["depth"] == 0
+
+            # Later requests are served from the storage engine.
+            derivative_cache.clear()
+
+            def fail(*args, **kwargs):
+                raise AssertionError("The derivative should have been stored.")
+
+            monkeypatch.setattr(Transformations, "apply", fail)
+            response = client.get(f"/images/{image_path}?thumbnail-size=100*100")
+            assert response.status_code == 200, response.data
+            response = client.get(f"/images/{image_path[:-4]}.webp")
+            assert response.status_code == 200, response.data
+            assert derivative_cache.stats()["storage_hits"] == 2
+
+    def test_configured_presets_can_be_disabled(
+        self, eager_queue, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository_service import server
+        from ProgImage.repository_service.server import app
+
+        monkeypatch.setattr(server, "EAGER_PRESETS", ["?thumbnail-size=100*100"])
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=jpeg_fixture_1)
+            assert response.status_code == 201, response.data
+            response = client.post("/images/?eager=", data=jpeg_fixture_1)
+            assert response.status_code == 201, response.data
+
+        assert eager_queue.stats()["depth"] == 1
+
+    @pytest.mark.parametrize("preset", [".abc", "?unknown-size=1", "?thumbnail"])
+    def test_invalid_presets_are_rejected(
+        self, eager_queue, mock_s3_storage, jpeg_fixture_1, preset
+    ):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post(
+                "/images/", query_string={"eager": preset}, data=jpeg_fixture_1
+            )
+            assert response.status_code == 400, response.data
+
+        assert not mock_s3_storage.list_objects(Bucket="test-bucket").get("Contents")
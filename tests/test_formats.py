@@ -0,0 +1,208 @@
+import pytest
+
+from ProgImage import formats
+
+
+class TestFormatRegistry:
+    @pytest.mark.parametrize(
+        "mimetype,image_format",
+        [("image/jpeg", "JPEG"), ("image/png", "PNG"), ("image/bmp", "BMP")],
+    )
+    def test_format_for_mimetype(self, mimetype, image_format):
+        assert formats.get_format_for_mimetype(mimetype) == image_format
+        assert formats.get_mimetype_for_format(image_format) == mimetype
+
+    def test_unknown_mimetype_is_not_supported(self):
+        with pytest.raises(ValueError, match='"text/plain" is not supported'):
+            formats.get_format_for_mimetype("text/plain")
+
+    @pytest.mark.parametrize(
+        "path,mimetype",
+        [
+            ("abc.jpg", "image/jpeg"),
+            ("abc.JPEG", "image/jpeg"),
+            ("abc.webp", "image/webp"),
+            ("abc.txt", "text/plain"),
+            ("abc", None),
+            ("abc.asdasd", None),
+        ],
+    )
+    def test_mimetype_for_path(self, path, mimetype):
+        assert formats.get_mimetype_for_path(path) == mimetype
+
+    def test_extension_for_mimetype(self):
+        assert formats.get_extension_for_mimetype("image/jpeg") == ".jpg"
+        assert formats.get_extension_for_mimetype("image/x-icon") == ".ico"
+        assert formats.get_extension_for_mimetype("text/plain") == ""
+
+    def test_read_only_formats_are_not_saveable(self):
+        assert formats.is_saveable("JPEG")
+        assert not formats.is_saveable("PSD")
+
+
+class TestConversion:
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1")
+    def test_read_only_target_is_rejected_before_fetch(self, monkeypatch):
+        from ProgImage.repository import storage_engine
+        from ProgImage.repository_service.server import app
+
+        def retrieve_stream(image_id):
+            raise AssertionError("The image contents must not be fetched.")
+
+        monkeypatch.setattr(storage_engine, "retrieve_stream", retrieve_stream)
+
+        with app.test_client() as client:
+            response = client.get("/images/test-file-1.psd")
+            assert response.status_code == 400, response.data
+            assert b"not supported" in response.data
+
+
+class TestEncodingProfiles:
+    @pytest.fixture
+    def photo(self, jpeg_fixture_1):
+        from io import BytesIO
+        from PIL import Image
+
+        with Image.open(BytesIO(jpeg_fixture_1)) as image:
+            image.thumbnail((500, 500))
+            yield image
+
+    def test_small_profile_produces_smaller_output(self, photo):
+        sizes = {
+            profile: len(formats.encode_image(photo, "JPEG", profile))
+            for profile in ("fast", "balanced", "small")
+        }
+        assert sizes["small"] < sizes["balanced"] < sizes["fast"]
+
+    @pytest.mark.parametrize("image_format", ["JPEG", "PNG", "WEBP", "TIFF"])
+    def test_metadata_is_stripped(self, photo, image_format):
+        from io import BytesIO
+        from PIL import Image
+
+        photo.info["icc_profile"] = photo.info.get("icc_profile") or b""
+        kept = Image.open(
+            BytesIO(formats.encode_image(photo, image_format, "balanced"))
+        )
+        stripped = Image.open(
+            BytesIO(formats.encode_image(photo, image_format, "small"))
+        )
+
+        if image_format == "JPEG":
+            assert kept.info.get("exif")
+        assert not stripped.info.get("exif")
+        assert not stripped.info.get("icc_profile")
+
+    @pytest.mark.parametrize("image_format", ["JPEG", "WEBP"])
+    def test_orientation_is_kept_when_stripping(self, image_format):
+        from io import BytesIO
+        from PIL import Image
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation, rotated by 90 degrees.
+        exif[0x010F] = "Camera"  # Make.
+        contents = BytesIO()
+        Image.new("RGB", (40, 20)).save(contents, format="JPEG", exif=exif.tobytes())
+
+        with Image.open(contents) as image:
+            stripped = Image.open(
+                BytesIO(formats.encode_image(image, image_format, "small"))
+            )
+        assert stripped.size == (40, 20)
+        assert dict(stripped.getexif()) == {0x0112: 6}
+
+    def test_unknown_profile_is_rejected(self, photo):
+        with pytest.raises(ValueError, match="Unknown encoding profile"):
+            formats.encode_image(photo, "JPEG", "tiny")
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1")
+    def test_profile_can_be_requested(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            fast = client.get("/images/test-file-1.webp?profile=fast")
+            assert fast.status_code == 200, fast.data
+            small = client.get("/images/test-file-1.webp?profile=small")
+            assert small.status_code == 200, small.data
+            assert len(small.data) < len(fast.data)
+
+            response = client.get("/images/test-file-1.webp?profile=tiny")
+            assert response.status_code == 400, response.data
+
+
+def create_animation(frame_count=3, size=(64, 48), image_format="GIF") -> bytes:
+    from io import BytesIO
+    from PIL import Image
+
+    frames = [
+        Image.new("RGB", size, color) for color in ("red", "green", "blue")
+    ][:frame_count]
+    contents = BytesIO()
+    frames[0].save(
+        contents,
+        format=image_format,
+        save_all=True,
+        append_images=frames[1:],
+        duration=[100, 200, 300][:frame_count],
+        loop=0,
+    )
+    return contents.getvalue()
+
+
+class TestAnimation:
+    @pytest.mark.parametrize("image_format", ["GIF", "WEBP", "PNG"])
+    def test_animation_is_kept(self, image_format):
+        from io import BytesIO
+        from PIL import Image
+
+        with Image.open(BytesIO(create_animation())) as image:
+            contents = formats.encode_image(image, image_format)
+
+        with Image.open(BytesIO(contents)) as encoded:
+            assert encoded.format == image_format
+            assert encoded.n_frames == 3
+            encoded.seek(1)
+            encoded.load()
+            assert encoded.info["duration"] == 200
+            assert encoded.convert("RGB").getpixel((0, 0))[1] > 100
+
+    def test_first_frame_is_kept_by_still_formats(self):
+        from io import BytesIO
+        from PIL import Image
+
+        with Image.open(BytesIO(create_animation())) as image:
+            contents = formats.encode_image(image, "BMP")
+
+        with Image.open(BytesIO(contents)) as encoded:
+            assert not getattr(encoded, "is_animated", False)
+
+    def test_frames_are_transformed(self):
+        from io import BytesIO
+        from PIL import Image
+
+        transformed = []
+
+        def transform(frame):
+            transformed.append(frame.size)
+            return frame.rotate(90, expand=True)
+
+        with Image.open(BytesIO(create_animation())) as image:
+            contents = formats.encode_image(image, "GIF", transform=transform)
+
+        assert transformed == [(64, 48)] * 3
+        with Image.open(BytesIO(contents)) as encoded:
+            assert (encoded.size, encoded.n_frames) == ((48, 64), 3)
+
+    def test_large_animations_are_rejected(self, monkeypatch):
+        from io import BytesIO
+        from PIL import Image
+
+        monkeypatch.setattr(formats, "MAX_ANIMATION_FRAMES", 2)
+        with Image.open(BytesIO(create_animation())) as image:
+            with pytest.raises(ValueError, match="Animations are limited"):
+                formats.encode_image(image, "WEBP")
+
+        monkeypatch.setattr(formats, "MAX_ANIMATION_FRAMES", 3)
+        monkeypatch.setattr(formats, "MAX_ANIMATION_PIXELS", 64 * 48 * 3 - 1)
+        with Image.open(BytesIO(create_animation())) as image:
+            with pytest.raises(ValueError, match="Animations are limited"):
+                formats.encode_image(image, "WEBP")
@@ -0,0 +1,121 @@
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from ProgImage import limits
+from ProgImage.limits import DecodeBudgetExceeded, PixelBudget
+from ProgImage.rotation_service import transformation as rotation
+from ProgImage.thumbnail_service import transformation as thumbnail
+
+
+@pytest.fixture
+def exhausted_budget(monkeypatch):
+    budget = PixelBudget(max_pixels=100, timeout=0)
+    monkeypatch.setattr(limits, "pixel_budget", budget)
+    with budget.reserve(100):
+        yield budget
+
+
+class TestPixelBudget:
+    def test_reservation_waits_for_released_pixels(self):
+        budget = PixelBudget(max_pixels=100, timeout=5)
+        reserved = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with budget.reserve(80):
+                reserved.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        reserved.wait()
+        threading.Timer(0.1, release.set).start()
+
+        with budget.reserve(50):
+            assert budget.stats() == {"in_use": 50, "max": 100}
+        thread.join()
+        assert budget.stats()["in_use"] == 0
+
+    def test_reservation_times_out(self):
+        budget = PixelBudget(max_pixels=100, timeout=0.01)
+        with budget.reserve(60):
+            with pytest.raises(DecodeBudgetExceeded):
+                with budget.reserve(60):
+                    pass
+        assert budget.stats()["in_use"] == 0
+
+    def test_image_larger_than_budget_runs_alone(self):
+        budget = PixelBudget(max_pixels=100, timeout=0)
+        with budget.reserve(1000):
+            assert budget.stats()["in_use"] == 100
+
+    def test_animations_reserve_every_frame(self, monkeypatch):
+        budget = PixelBudget(max_pixels=1000, timeout=0)
+        monkeypatch.setattr(limits, "pixel_budget", budget)
+        frames = [Image.new("RGB", (10, 10), color) for color in ("red", "blue")]
+        contents = BytesIO()
+        frames[0].save(
+            contents, format="GIF", save_all=True, append_images=frames[1:]
+        )
+
+        with Image.open(contents) as image, limits.admit(image):
+            assert budget.stats()["in_use"] == 200
+
+
+class TestAdmission:
+    def test_upload_of_too_many_pixels_results_in_413(
+        self, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository_service.server import app
+
+        monkeypatch.setattr(limits, "MAX_IMAGE_PIXELS", 1000)
+        with app.test_client() as client:
+            response = client.post("/images/", data=jpeg_fixture_1)
+            assert response.status_code == 413, response.data
+            assert b"limited to 1,000 pixels" in response.data
+
+        assert "Contents" not in mock_s3_storage.list_objects(Bucket="test-bucket")
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1")
+    def test_conversion_of_too_many_pixels_results_in_413(self, monkeypatch):
+        from ProgImage.repository_service.server import app
+
+        # Stored before the limit was lowered, the original can still be downloaded.
+        monkeypatch.setattr(limits, "MAX_IMAGE_PIXELS", 1000)
+        with app.test_client() as client:
+            assert client.get("/images/test-file-1.jpg").status_code == 200
+
+            response = client.get("/images/test-file-1.png")
+            assert response.status_code == 413, response.data
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1", "exhausted_budget")
+    def test_exhausted_decode_budget_results_in_429(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get("/images/test-file-1.png")
+            assert response.status_code == 429, response.data
+            assert response.headers["Retry-After"] == "1"
+
+
+class TestParameters:
+    @pytest.mark.parametrize("size", ["100", "a*b", "0*100", "100*100*100"])
+    def test_invalid_thumbnail_size_is_rejected(self, size):
+        with pytest.raises(ValueError, match="size"):
+            thumbnail.get_size({"size": size})
+
+    def test_thumbnail_size_is_capped(self, monkeypatch):
+        monkeypatch.setattr(limits, "MAX_OUTPUT_DIMENSION", 1000)
+        assert thumbnail.get_size({"size": "1000*10"}) == (1000, 10)
+        with pytest.raises(ValueError, match="must not exceed 1000 pixels"):
+            thumbnail.get_size({"size": "1001*10"})
+        with pytest.raises(ValueError, match="must not exceed 1000 pixels"):
+            thumbnail.get_widths({"widths": "500,1001"})
+
+    @pytest.mark.parametrize("params", [{"angle": "ninety"}, {"transpose": "1.5"}])
+    def test_invalid_rotation_is_rejected(self, params):
+        with pytest.raises(ValueError, match="integer number of degrees"):
+            rotation.transform(None, params)
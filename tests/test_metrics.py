@@ -0,0 +1,82 @@
+import re
+
+import pytest
+
+from ProgImage import metrics
+from ProgImage.metrics import Counter, Histogram, timed
+
+
+def get_sample(text: str, sample: str) -> float:
+    match = re.search(rf"^{re.escape(sample)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+@pytest.fixture
+def isolated_registry(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", {})
+    yield metrics.registry
+
+
+class TestMetrics:
+    def test_histogram_is_rendered_cumulatively(self, isolated_registry):
+        histogram = Histogram("test_seconds", "Test.", ("stage",), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.7, 3):
+            histogram.observe(value, stage='decode "x"')
+
+        assert histogram.render() == [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="decode \\"x\\"",le="0.1"} 1',
+            'test_seconds_bucket{stage="decode \\"x\\"",le="1"} 3',
+            'test_seconds_bucket{stage="decode \\"x\\"",le="+Inf"} 4',
+            'test_seconds_sum{stage="decode \\"x\\""} 4.25',
+            'test_seconds_count{stage="decode \\"x\\""} 4',
+        ]
+
+    def test_metrics_can_be_disabled(self, isolated_registry, monkeypatch):
+        monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+        counter = Counter("test_total", "Test.")
+        histogram = Histogram("test_seconds", "Test.", ("stage", "target"))
+        monkeypatch.setattr(metrics, "stage_duration", histogram)
+
+        counter.inc()
+        with timed("decode"):
+            pass
+
+        assert metrics.render() == (
+            "# HELP test_total Test.\n# TYPE test_total counter\n"
+            "# HELP test_seconds Test.\n# TYPE test_seconds histogram\n"
+        )
+
+    def test_stages_and_requests_are_exposed(self, s3_jpeg_fixture_1, monkeypatch):
+        from ProgImage.repository_service.server import app
+
+        monkeypatch.setattr(metrics, "SERVER_TIMING", True)
+        stage = 'progimage_stage_duration_seconds_count{stage="encode",target="PNG"}'
+        request = (
+            "progimage_request_duration_seconds_count"
+            '{endpoint="/images/<image_path>",method="GET",status="200"}'
+        )
+        error = 'progimage_errors_total{type="NotFound"}'
+
+        with app.test_client() as client:
+            before = client.get("/metrics").data.decode("utf-8")
+
+            response = client.get("/images/test-file-1.png")
+            assert response.status_code == 200, response.data
+            timings = response.headers["Server-Timing"]
+            assert re.match(r"storage_metadata;dur=[\d.]+, ", timings)
+            assert "storage_retrieve;dur=" in timings
+            assert "decode;dur=" in timings and "encode;dur=" in timings
+            assert re.search(r"total;dur=[\d.]+$", timings)
+            response.close()  # The request is recorded once the response is written.
+
+            assert client.get("/images/unknown.png").status_code == 404
+
+            response = client.get("/metrics")
+            assert response.content_type.startswith("text/plain; version=0.0.4")
+            after = response.data.decode("utf-8")
+
+        assert get_sample(after, stage) == get_sample(before, stage) + 1
+        assert get_sample(after, request) == get_sample(before, request) + 1
+        assert get_sample(after, error) == get_sample(before, error) + 1
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 from io import BytesIO
@@ -68,6 +69,10 @@ class TestUpload:
             response = client.post("/images/", data=b"I'm a text file")
             assert response.status_code == 400, response.data
 
+            # Not identified from the header, nor from the whole upload.
+            response = client.post("/images/", data=b"\xff\xd8" * 1024 * 1024)
+            assert response.status_code == 400, response.data
+
 
 class TestDownload:
     @pytest.mark.usefixtures("s3_jpeg_fixture_1")
@@ -124,3 +129,275 @@ class TestFormatConversion:
             response = client.get(f"/images/{image_path}")
             assert response.status_code == 400, response.data
             assert b"is unknown" in response.data
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1")
+    def test_converted_image_is_cached(self, mock_s3_storage, empty_derivative_cache):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            first_response = client.get("/images/test-file-1.png")
+            assert first_response.status_code == 200, first_response.data
+
+            mock_s3_storage.delete_object(
+                Bucket="test-bucket", Key="images/test-file-1"
+            )
+            second_response = client.get("/images/test-file-1.png")
+            assert second_response.status_code == 200, second_response.data
+            assert second_response.data == first_response.data
+
+            stats = json.loads(client.get("/stats/").data)["derivative_cache"]
+            assert stats["hits"] == 1
+            assert stats["items"] == 1
+
+        # The derivative is persisted next to the original via the storage engine.
+        keys = [
+            o["Key"]
+            for o in mock_s3_storage.list_objects(Bucket="test-bucket")["Contents"]
+        ]
+        assert len(keys) == 1
+        assert keys[0].startswith("images/test-file-1--")
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1", "empty_derivative_cache")
+    def test_original_format_skips_the_cache(self):
+        from ProgImage.repository_service.server import app
+
+        def get_counts(client):
+            stats = json.loads(client.get("/stats/").data)["derivative_cache"]
+            return stats["hits"], stats["misses"]
+
+        with app.test_client() as client:
+            counts = get_counts(client)
+            response = client.get("/images/test-file-1.jpg")
+            assert response.status_code == 200, response.data
+            assert get_counts(client) == counts
+
+            # A conversion is looked up once.
+            response = client.get("/images/test-file-1.png")
+            assert response.status_code == 200, response.data
+            assert get_counts(client) == (counts[0], counts[1] + 1)
+
+
+class TestStreaming:
+    def test_upload_is_aborted_when_stream_exceeds_limit(
+        self, mock_s3_storage, monkeypatch, jpeg_fixture_1
+    ):
+        from ProgImage import repository
+        from ProgImage.repository import ImageRepository
+
+        monkeypatch.setattr(repository, "MAX_UPLOAD_SIZE", len(jpeg_fixture_1) - 1)
+
+        with pytest.raises(ValueError, match="must not exceed"):
+            ImageRepository().store_stream(BytesIO(jpeg_fixture_1))
+
+        assert "Contents" not in mock_s3_storage.list_objects(Bucket="test-bucket")
+
+    def test_large_png_without_exif_is_uploaded(self, mock_s3_storage):
+        from ProgImage.repository import SNIFF_SIZE
+        from ProgImage.repository_service.server import app
+
+        contents = BytesIO()
+        Image.effect_noise((400, 400), 64).convert("RGB").save(contents, format="PNG")
+        assert len(contents.getvalue()) > SNIFF_SIZE
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=contents.getvalue())
+            assert response.status_code == 201, response.data
+            image_path = json.loads(response.data)["id"]
+            response = client.head(f"/images/{image_path}")
+            assert response.headers["X-Image-Format"] == "PNG"
+            assert "X-Image-Orientation" not in response.headers
+
+    @pytest.mark.parametrize(
+        "image_format, options",
+        [
+            ("WEBP", {"lossless": True}),
+            # Larger than MAX_SNIFF_SIZE, it's read from the whole upload.
+            ("JPEG", {"icc_profile": os.urandom(1536 * 1024)}),
+        ],
+    )
+    def test_image_with_large_header_is_uploaded(
+        self, mock_s3_storage, image_format, options
+    ):
+        from ProgImage.repository import SNIFF_SIZE
+        from ProgImage.repository_service.server import app
+
+        contents = BytesIO()
+        image = Image.effect_noise((400, 400), 64).convert("RGB")
+        image.save(contents, format=image_format, **options)
+        assert len(contents.getvalue()) > SNIFF_SIZE
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=contents.getvalue())
+            assert response.status_code == 201, response.data
+            image_path = json.loads(response.data)["id"]
+            response = client.head(f"/images/{image_path}")
+            assert response.headers["X-Image-Format"] == image_format
+            assert response.headers["X-Image-Width"] == "400"
+
+    def test_upload_is_validated_from_header(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.repository import UploadStream, ImageRepository
+
+        upload = UploadStream(BytesIO(jpeg_fixture_1), len(jpeg_fixture_1))
+        assert ImageRepository._sniff_metadata(upload)["Format"] == "JPEG"
+        assert upload.size < len(jpeg_fixture_1)
+        assert upload.read() == jpeg_fixture_1
+
+
+class TestMetadata:
+    def test_metadata_is_recorded_on_upload(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=jpeg_fixture_1)
+            assert response.status_code == 201, response.data
+            image_path = json.loads(response.data)["id"]
+
+        key = "images/" + os.path.splitext(image_path)[0]
+        s3_object = mock_s3_storage.head_object(Bucket="test-bucket", Key=key)
+        assert s3_object["Metadata"] == {
+            "format": "JPEG",
+            "width": "2000",
+            "height": "2000",
+            "mode": "RGB",
+            "orientation": "1",
+            "content-length": "619148",
+            "content-hash": hashlib.sha256(jpeg_fixture_1).hexdigest(),
+        }
+
+    def test_head_returns_metadata(
+        self, mock_s3_storage, jpeg_fixture_1, empty_metadata_index
+    ):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=jpeg_fixture_1)
+            image_path = json.loads(response.data)["id"]
+            empty_metadata_index.clear()  # Force a lookup in the storage engine.
+
+            response = client.head(f"/images/{image_path}")
+            assert response.status_code == 200
+            assert response.data == b""
+            assert response.headers["Content-Type"] == "image/jpeg"
+            assert response.headers["Content-Length"] == "619148"
+            assert response.headers["X-Image-Width"] == "2000"
+            assert response.headers["X-Image-Height"] == "2000"
+            assert response.headers["X-Image-Mode"] == "RGB"
+            assert response.headers["X-Content-Hash"] == (
+                hashlib.sha256(jpeg_fixture_1).hexdigest()
+            )
+
+            response = client.head("/images/unknown.jpg")
+            assert response.status_code == 404
+
+    def test_thumbnail_larger_than_image_is_skipped(
+        self, mock_s3_storage, requests_mock, monkeypatch
+    ):
+        from ProgImage.repository_service import transformations
+        from ProgImage.repository_service.server import app
+        from ProgImage.repository_service.transformations import ImageTransformation
+
+        # Any request to the thumbnail service would fail as it's not mocked.
+        monkeypatch.setitem(
+            transformations.transformation_urls,
+            ImageTransformation.THUMBNAIL,
+            "http://thumbnail/",
+        )
+        small_image = BytesIO()
+        Image.new("RGB", (100, 50)).save(small_image, format="PNG")
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=small_image.getvalue())
+            image_path = json.loads(response.data)["id"]
+
+            response = client.get(f"/images/{image_path}?thumbnail-size=200*200")
+
+            assert response.status_code == 200, response.data
+            assert response.data == small_image.getvalue()
+            assert requests_mock.call_count == 0
+
+
+class TestConditionalRequests:
+    @pytest.fixture
+    def uploaded_image(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post("/images/", data=jpeg_fixture_1)
+            return json.loads(response.data)["id"]
+
+    def test_validators_are_returned(self, uploaded_image, jpeg_fixture_1):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get(f"/images/{uploaded_image}")
+
+            assert response.status_code == 200
+            assert response.headers["ETag"] == (
+                '"%s"' % hashlib.sha256(jpeg_fixture_1).hexdigest()
+            )
+            assert response.headers["Last-Modified"]
+            assert response.headers["Accept-Ranges"] == "bytes"
+            assert "immutable" in response.headers["Cache-Control"]
+
+            png_response = client.head(f"/images/{uploaded_image[:-4]}.png")
+            assert png_response.headers["ETag"] not in (response.headers["ETag"], None)
+
+    def test_default_profile_is_part_of_the_etag(self, uploaded_image, monkeypatch):
+        from ProgImage import formats
+        from ProgImage.repository_service.server import app
+
+        webp_path = f"/images/{uploaded_image[:-4]}.webp"
+        with app.test_client() as client:
+            balanced = client.get(f"{webp_path}?profile=balanced")
+            assert balanced.status_code == 200, balanced.data
+            etag = balanced.headers["ETag"]
+            assert client.get(webp_path).headers["ETag"] == etag
+
+            monkeypatch.setattr(formats, "ENCODING_PROFILE", "small")
+            small = client.get(webp_path)
+            assert small.status_code == 200, small.data
+            assert small.headers["ETag"] != etag
+            assert small.data != balanced.data  # Not served from the cache.
+
+    def test_not_modified_is_returned_without_fetching(
+        self, uploaded_image, monkeypatch
+    ):
+        from ProgImage.repository import ImageRepository
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get(f"/images/{uploaded_image[:-4]}.png")
+            etag = response.headers["ETag"]
+            last_modified = response.headers["Last-Modified"]
+
+            def fail(*args, **kwargs):
+                raise AssertionError("The image shouldn't be fetched.")
+
+            monkeypatch.setattr(ImageRepository, "retrieve_stream", fail)
+
+            response = client.get(
+                f"/images/{uploaded_image[:-4]}.png", headers={"If-None-Match": etag}
+            )
+            assert response.status_code == 304
+            assert response.data == b""
+            assert response.headers["ETag"] == etag
+
+            response = client.get(
+                f"/images/{uploaded_image}",
+                headers={"If-Modified-Since": last_modified},
+            )
+            assert response.status_code == 304
+
+    def test_range_request(self, uploaded_image, jpeg_fixture_1):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get(
+                f"/images/{uploaded_image}", headers={"Range": "bytes=100-199"}
+            )
+
+            assert response.status_code == 206
+            assert response.data == jpeg_fixture_1[100:200]
+            assert response.headers["Content-Range"] == (
+                f"bytes 100-199/{len(jpeg_fixture_1)}"
+            )
@@ -0,0 +1,90 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from ProgImage import sessions
+from ProgImage.repository_service.transformations import (
+    Transformations,
+    TransformationError,
+)
+
+
+@pytest.fixture
+def flaky_server(monkeypatch):
+    monkeypatch.setattr(sessions, "HTTP_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(sessions, "_sessions", {})
+    statuses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status = statuses.pop(0) if statuses else 200
+            self.send_response(status)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", "11")
+            self.end_headers()
+            self.wfile.write(b"transformed")
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/", statuses
+    server.shutdown()
+
+
+class TestSessions:
+    def test_session_is_shared_per_origin(self):
+        session = sessions.get_session("http://thumbnail_service:80/transform/")
+        assert sessions.get_session("http://thumbnail_service:80/") is session
+        assert sessions.get_session("http://rotation_service:80/") is not session
+        assert sessions.get_session() is not session
+
+    def test_unavailable_service_is_retried(self, flaky_server):
+        url, statuses = flaky_server
+        statuses.extend([503, 502])
+
+        response = Transformations._apply_transition(
+            session=sessions.get_session(url),
+            method="POST",
+            url=url,
+            params={},
+            data=b"original",
+            mimetype="image/jpeg",
+        )
+        assert response == (b"transformed", "image/jpeg")
+        assert statuses == []
+
+    def test_retries_are_bounded(self, flaky_server):
+        url, statuses = flaky_server
+        statuses.extend([503] * (sessions.HTTP_RETRIES + 1))
+
+        with pytest.raises(TransformationError):
+            Transformations._apply_transition(
+                session=sessions.get_session(url),
+                method="POST",
+                url=url,
+                params={},
+                data=b"original",
+                mimetype="image/jpeg",
+            )
+
+    def test_timeout_is_passed_to_requests(self, requests_mock):
+        requests_mock.post(
+            "http://rotation/transform/",
+            content=b"rotated",
+            headers={"Content-Type": "image/jpeg"},
+        )
+
+        Transformations._apply_transition(
+            session=sessions.get_session("http://rotation/"),
+            method="POST",
+            url="http://rotation/transform/",
+            params={},
+            data=b"original",
+            mimetype="image/jpeg",
+        )
+        assert requests_mock.last_request.timeout == sessions.HTTP_TIMEOUT
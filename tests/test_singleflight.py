@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from ProgImage.singleflight import SingleFlight
+
+
+def run_concurrently(function, count=5):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(function()))
+        for _ in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_result(self):
+        flights = SingleFlight()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return object()
+
+        results = run_concurrently(lambda: flights.do("key", compute))
+
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flights.stats() == {"calls": 1, "shared": 4, "in_flight": 0}
+
+        flights.do("key", compute)  # Results aren't cached.
+        assert len(calls) == 2
+
+    def test_exception_is_shared(self):
+        flights = SingleFlight()
+
+        def fail():
+            time.sleep(0.2)
+            raise FileNotFoundError("Image doesn't exist.")
+
+        def call():
+            try:
+                flights.do("key", fail)
+            except FileNotFoundError as error:
+                return error
+
+        results = run_concurrently(call, count=3)
+        assert all(isinstance(result, FileNotFoundError) for result in results)
+
+    def test_processes_are_serialised_by_lock_file(self, tmp_path):
+        # Separate instances behave like the flights of separate worker processes.
+        running = []
+        overlaps = []
+
+        def compute():
+            running.append(1)
+            overlaps.append(len(running))
+            time.sleep(0.1)
+            running.pop()
+
+        run_concurrently(
+            lambda: SingleFlight(lock_dir=tmp_path).do("key", compute), count=3
+        )
+
+        assert overlaps == [1, 1, 1]
+        assert list(tmp_path.glob("*.lock"))
+
+
+@pytest.mark.usefixtures("s3_jpeg_fixture_1")
+def test_identical_transformations_are_coalesced(monkeypatch):
+    from ProgImage.repository_service import transformations
+    from ProgImage.repository_service.server import app
+    from ProgImage.repository_service.transformations import ImageTransformation
+
+    calls = []
+
+    def slow_thumbnail(image, params=None):
+        calls.append(1)
+        time.sleep(0.2)
+        return image
+
+    monkeypatch.setattr(transformations, "TRANSFORM_MODE", "local")
+    monkeypatch.setitem(
+        transformations.local_transformations,
+        ImageTransformation.THUMBNAIL,
+        slow_thumbnail,
+    )
+
+    def download():
+        with app.test_client() as client:
+            return client.get("/images/test-file-1.jpg?thumbnail-size=10*10")
+
+    responses = run_concurrently(download)
+
+    assert [response.status_code for response in responses] == [200] * 5
+    assert len(calls) == 1
@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ProgImage.storage import LazyEngine, get_engine
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_entry_point(module: str, **environment) -> str:
+    # Entry points are imported in a fresh interpreter, the test process has imported
+    # everything already.
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(','.join(sorted(sys.modules)))",
+        ],
+        env=dict(os.environ, **environment),
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    return process.stdout.strip().split(",")
+
+
+class TestStartup:
+    @pytest.mark.parametrize(
+        "module",
+        [
+            "ProgImage.thumbnail_service.server",
+            "ProgImage.rotation_service.server",
+            "ProgImage.repository_service.server",
+        ],
+    )
+    def test_boto3_is_not_imported_at_startup(self, module):
+        assert "boto3" not in import_entry_point(module, STORAGE="s3")
+
+    def test_file_storage_is_not_created_at_startup(self, tmp_path):
+        storage_path = tmp_path / "images"
+        modules = import_entry_point(
+            "ProgImage.repository_service.server",
+            STORAGE="file",
+            FILE_PATH=str(storage_path),
+        )
+
+        assert "ProgImage.storage.file" not in modules
+        assert not storage_path.exists()
+
+
+class TestLazyEngine:
+    def test_engine_is_imported_on_first_use(self):
+        engine = LazyEngine("s3")
+        assert engine.store_many is get_engine("s3").store_many
+
+    def test_unknown_engine_type_is_rejected(self):
+        with pytest.raises(ValueError, match="Choose one from: file, s3, tiered"):
+            LazyEngine("ftp")
@@ -0,0 +1,301 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+from io import BytesIO
+
+import pytest
+
+from ProgImage.storage import file as file_storage
+
+
+@pytest.fixture
+def file_storage_path(tmp_path, monkeypatch):
+    (tmp_path / "metadata").mkdir()
+    monkeypatch.setattr(file_storage, "storage_path", tmp_path)
+    monkeypatch.setattr(file_storage, "images_path", tmp_path / "images")
+    monkeypatch.setattr(file_storage, "metadata_path", tmp_path / "metadata")
+    monkeypatch.setattr(file_storage, "chunk_size", 1024)
+    yield tmp_path
+
+
+class ExplodingStream:
+    def __init__(self, contents: bytes):
+        self.stream = BytesIO(contents)
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        if not chunk:
+            raise ValueError("Upload aborted.")
+        return chunk
+
+
+class TestFileStorage:
+    def test_stream_round_trip(self, file_storage_path, jpeg_fixture_1):
+        image_id = file_storage.store_stream(BytesIO(jpeg_fixture_1), "image/jpeg")
+
+        stream, mimetype = file_storage.retrieve_stream(image_id)
+        with stream:
+            assert stream.read() == jpeg_fixture_1
+        assert mimetype == "image/jpeg"
+        assert file_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+
+    def test_aborted_stream_leaves_nothing_behind(self, file_storage_path):
+        with pytest.raises(ValueError):
+            file_storage.store_stream(ExplodingStream(b"1" * 4096), "image/jpeg", "a")
+
+        with pytest.raises(FileNotFoundError):
+            file_storage.retrieve_stream("a")
+
+    def test_unknown_image_results_in_file_not_found(self, file_storage_path):
+        with pytest.raises(FileNotFoundError):
+            file_storage.retrieve_stream("unknown")
+
+    def test_images_are_sharded(self, file_storage_path, jpeg_fixture_1):
+        image_id = file_storage.store(jpeg_fixture_1, "image/jpeg")
+
+        (file_path,) = (file_storage_path / "images").glob("*/*/*")
+        assert file_path.name == image_id
+        assert len(file_path.parent.name) == len(file_path.parent.parent.name) == 2
+        assert not list(file_path.parent.glob(".*"))  # No temporary files are left.
+
+    def test_stream_is_seekable(self, file_storage_path, jpeg_fixture_1):
+        image_id = file_storage.store(jpeg_fixture_1, "image/jpeg")
+
+        stream, _ = file_storage.retrieve_stream(image_id)
+        with stream:
+            stream.seek(100)
+            assert stream.read(100) == jpeg_fixture_1[100:200]
+            stream.seek(-10, io.SEEK_END)
+            assert stream.read() == jpeg_fixture_1[-10:]
+
+    def test_contents_are_synced_before_rename(
+        self, file_storage_path, jpeg_fixture_1, monkeypatch
+    ):
+        calls = []
+        fsync, replace = os.fsync, os.replace
+        monkeypatch.setattr(os, "fsync", lambda fd: calls.append("fsync") or fsync(fd))
+        monkeypatch.setattr(
+            os, "replace", lambda *args: calls.append("replace") or replace(*args)
+        )
+
+        image_id = file_storage.store(jpeg_fixture_1, "image/jpeg")
+        assert calls == ["fsync", "replace"]
+        assert file_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+
+    def test_nothing_is_migrated_without_storage(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(file_storage, "storage_path", tmp_path / "missing")
+        assert file_storage.migrate_legacy_files() == 0
+
+    def test_legacy_images_are_migrated(self, file_storage_path, jpeg_fixture_1):
+        (file_storage_path / "legacy").write_bytes(jpeg_fixture_1)
+        (file_storage_path / "metadata" / "legacy").write_text(
+            json.dumps({"Content-Type": "image/jpeg", "Width": 2000})
+        )
+        os.utime(str(file_storage_path / "legacy"), (1_000_000, 1_000_000))
+
+        assert file_storage.retrieve("legacy") == (jpeg_fixture_1, "image/jpeg")
+        assert file_storage.migrate_legacy_files() == 1
+        assert not (file_storage_path / "legacy").exists()
+
+        assert file_storage.retrieve("legacy") == (jpeg_fixture_1, "image/jpeg")
+        assert file_storage.retrieve_metadata("legacy") == {
+            "Content-Type": "image/jpeg",
+            "Width": 2000,
+            "Last-Modified": 1_000_000,
+        }
+        assert file_storage.migrate_legacy_files() == 0
+
+
+class TestS3Storage:
+    def test_stream_round_trip(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.storage import s3
+
+        image_id = s3.store_stream(BytesIO(jpeg_fixture_1), "image/jpeg")
+
+        body, mimetype = s3.retrieve_stream(image_id)
+        assert body.read() == jpeg_fixture_1
+        assert mimetype == "image/jpeg"
+
+    def test_large_stream_is_uploaded_in_parts(
+        self, mock_s3_storage, monkeypatch, jpeg_fixture_1
+    ):
+        from boto3.s3.transfer import TransferConfig
+        from ProgImage.storage import s3
+
+        monkeypatch.setattr(
+            s3,
+            "transfer_config",
+            TransferConfig(
+                multipart_threshold=5 * 1024 * 1024,
+                multipart_chunksize=5 * 1024 * 1024,
+            ),
+        )
+        contents = jpeg_fixture_1 * 10
+        image_id = s3.store_stream(BytesIO(contents), "image/jpeg")
+
+        s3_object = mock_s3_storage.head_object(
+            Bucket="test-bucket", Key=f"images/{image_id}"
+        )
+        assert s3_object["ETag"].endswith('-2"')  # Multipart upload ETag.
+        assert s3.retrieve(image_id) == (contents, "image/jpeg")
+
+    def test_large_object_is_retrieved_in_parts(
+        self, mock_s3_storage, monkeypatch, jpeg_fixture_1
+    ):
+        from boto3.s3.transfer import TransferConfig
+        from ProgImage.storage import s3
+
+        monkeypatch.setattr(
+            s3, "transfer_config", TransferConfig(multipart_chunksize=100_000)
+        )
+        image_id = s3.store(jpeg_fixture_1, "image/jpeg")
+        ranges = []
+        get_object = s3.get_client().get_object
+
+        def record_range(**kwargs):
+            ranges.append(kwargs["Range"])
+            return get_object(**kwargs)
+
+        monkeypatch.setattr(s3.get_client(), "get_object", record_range)
+
+        assert s3.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+        assert len(ranges) == 7  # The fixture is 619148 bytes.
+        assert "bytes=600000-699999" in ranges
+
+    def test_replaced_object_is_retrieved_again(
+        self, mock_s3_storage, monkeypatch, jpeg_fixture_1
+    ):
+        from boto3.s3.transfer import TransferConfig
+        from ProgImage.storage import s3
+
+        monkeypatch.setattr(
+            s3, "transfer_config", TransferConfig(multipart_chunksize=100_000)
+        )
+        image_id = s3.store(jpeg_fixture_1, "image/jpeg")
+        replaced = jpeg_fixture_1[::-1]
+        get_object = s3.get_client().get_object
+
+        def replace_after_first_range(**kwargs):
+            response = get_object(**kwargs)
+            if not replacements:
+                replacements.append(image_id)
+                s3.store(replaced, "image/jpeg", image_id=image_id)
+            return response
+
+        replacements = []
+        monkeypatch.setattr(s3.get_client(), "get_object", replace_after_first_range)
+
+        assert s3.retrieve(image_id) == (replaced, "image/jpeg")
+
+    def test_batch_operations(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.storage import s3
+
+        image_ids = s3.store_many(
+            [(jpeg_fixture_1, "image/jpeg", None), (b"GIF89a", "image/gif", None)]
+        )
+
+        assert s3.retrieve_many([*image_ids, "unknown"]) == {
+            image_ids[0]: (jpeg_fixture_1, "image/jpeg"),
+            image_ids[1]: (b"GIF89a", "image/gif"),
+        }
+
+    def test_unknown_image_results_in_file_not_found(self, mock_s3_storage):
+        from ProgImage.storage import s3
+
+        with pytest.raises(FileNotFoundError):
+            s3.retrieve_stream("unknown")
+
+
+class TestMetadata:
+    metadata = {
+        "Format": "JPEG",
+        "Width": 2000,
+        "Height": 1000,
+        "Mode": "RGB",
+        "Orientation": 1,
+        "Content-Length": 619148,
+        "Content-Hash": "abc",
+    }
+
+    def test_file_metadata_round_trip(self, file_storage_path, jpeg_fixture_1):
+        image_id = file_storage.store_stream(
+            BytesIO(jpeg_fixture_1), "image/jpeg", metadata=self.metadata
+        )
+
+        metadata = file_storage.retrieve_metadata(image_id)
+        assert abs(metadata.pop("Last-Modified") - time.time()) < 60
+        assert metadata == dict(self.metadata, **{"Content-Type": "image/jpeg"})
+        with pytest.raises(FileNotFoundError):
+            file_storage.retrieve_metadata("unknown")
+
+    def test_file_metadata_is_stored_in_batches(
+        self, file_storage_path, jpeg_fixture_1
+    ):
+        (image_id,) = file_storage.store_many(
+            [(jpeg_fixture_1, "image/jpeg", self.metadata)]
+        )
+
+        metadata = file_storage.retrieve_metadata(image_id)
+        assert metadata["Content-Hash"] == self.metadata["Content-Hash"]
+
+    def test_s3_metadata_round_trip(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.storage import s3
+
+        image_id = s3.store(jpeg_fixture_1, "image/jpeg", metadata=self.metadata)
+
+        metadata = s3.retrieve_metadata(image_id)
+        assert abs(metadata.pop("Last-Modified") - time.time()) < 60
+        assert metadata == dict(self.metadata, **{"Content-Type": "image/jpeg"})
+        with pytest.raises(FileNotFoundError):
+            s3.retrieve_metadata("unknown")
+
+    def test_s3_metadata_is_stored_in_batches(self, mock_s3_storage, jpeg_fixture_1):
+        from ProgImage.storage import s3
+
+        (image_id,) = s3.store_many([(jpeg_fixture_1, "image/jpeg", self.metadata)])
+
+        metadata = s3.retrieve_metadata(image_id)
+        assert metadata["Content-Hash"] == self.metadata["Content-Hash"]
+
+
+class TestDeduplication:
+    @pytest.fixture(autouse=True)
+    def deduplicate(self, monkeypatch):
+        from ProgImage import storage
+
+        monkeypatch.setattr(storage, "STORAGE_DEDUPLICATE", True)
+
+    def test_file_duplicate_is_stored_once(
+        self, file_storage_path, jpeg_fixture_1, monkeypatch
+    ):
+        image_id = file_storage.store(jpeg_fixture_1, "image/jpeg")
+        assert image_id == file_storage.store(jpeg_fixture_1, "image/jpeg")
+        assert file_storage.store(b"other", "image/jpeg") != image_id
+
+        monkeypatch.setattr(shutil, "copyfileobj", None)  # Nothing is written.
+        metadata = {"Content-Hash": hashlib.sha256(jpeg_fixture_1).hexdigest()}
+        assert image_id == file_storage.store_stream(
+            BytesIO(jpeg_fixture_1), "image/jpeg", metadata=metadata
+        )
+        assert file_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+
+    def test_s3_duplicate_skips_upload(
+        self, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.storage import s3
+
+        metadata = {"Content-Hash": hashlib.sha256(jpeg_fixture_1).hexdigest()}
+        image_id = s3.store_stream(
+            BytesIO(jpeg_fixture_1), "image/jpeg", metadata=metadata
+        )
+
+        monkeypatch.setattr(s3.get_client(), "upload_fileobj", None)
+        monkeypatch.setattr(s3.get_client(), "put_object", None)
+        assert image_id == s3.store_stream(
+            BytesIO(jpeg_fixture_1), "image/jpeg", metadata=metadata
+        )
+        assert image_id == s3.store(jpeg_fixture_1, "image/jpeg")
+        assert s3.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
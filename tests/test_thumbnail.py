@@ -0,0 +1,173 @@
+import struct
+from io import BytesIO
+
+import pytest
+from PIL import Image, JpegImagePlugin
+
+from ProgImage import limits
+from ProgImage.thumbnail_service import transformation
+from ProgImage.thumbnail_service.transformation import transform, transform_image
+
+
+def create_jpeg(size, color, exif_thumbnail=None) -> bytes:
+    exif = b""
+    if exif_thumbnail:
+        preview = BytesIO()
+        exif_thumbnail.save(preview, format="JPEG")
+        preview = preview.getvalue()
+
+        # Little-endian TIFF header, an empty IFD0 and IFD1 pointing to the preview.
+        ifd1_offset = 8 + 2 + 4
+        preview_offset = ifd1_offset + 2 + 2 * 12 + 4
+        exif = (
+            b"Exif\x00\x00II*\x00"
+            + struct.pack("<L", 8)
+            + struct.pack("<HL", 0, ifd1_offset)
+            + struct.pack("<H", 2)
+            + struct.pack("<HHLL", 0x0201, 4, 1, preview_offset)
+            + struct.pack("<HHLL", 0x0202, 4, 1, len(preview))
+            + struct.pack("<L", 0)
+            + preview
+        )
+
+    contents = BytesIO()
+    Image.new("RGB", size, color).save(contents, format="JPEG", exif=exif)
+    return contents.getvalue()
+
+
+def open_thumbnail(contents: bytes) -> Image.Image:
+    thumbnail = transform_image(contents, "image/jpeg", {"size": "200*200"})
+    return Image.open(BytesIO(thumbnail))
+
+
+class TestThumbnail:
+    def test_jpeg_is_decoded_at_reduced_scale(self, jpeg_fixture_1, monkeypatch):
+        decoded_sizes = []
+        original_draft = JpegImagePlugin.JpegImageFile.draft
+
+        def draft(self, mode, size):
+            result = original_draft(self, mode, size)
+            decoded_sizes.append(self.size)
+            return result
+
+        monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "draft", draft)
+        with Image.open(BytesIO(jpeg_fixture_1)) as image:
+            thumbnail = transform(image, {"size": "100*100"})
+            assert thumbnail.size == (100, 100)
+
+        # The 2000x2000 image was decoded at 1/8 scale.
+        assert decoded_sizes == [(250, 250)]
+
+    def test_exif_thumbnail_is_used_when_large_enough(self):
+        preview = Image.new("RGB", (400, 300), "blue")
+        contents = create_jpeg((800, 600), "red", preview)
+
+        thumbnail = open_thumbnail(contents)
+        assert thumbnail.size == (200, 150)
+        red, green, blue = thumbnail.getpixel((100, 75))
+        assert blue > 200 and red < 50
+
+    @pytest.mark.parametrize(
+        "preview_size", [(100, 75), (400, 400)], ids=["too-small", "letterboxed"]
+    )
+    def test_unsuitable_exif_thumbnail_is_ignored(self, preview_size):
+        preview = Image.new("RGB", preview_size, "blue")
+        contents = create_jpeg((800, 600), "red", preview)
+
+        thumbnail = open_thumbnail(contents)
+        assert thumbnail.size == (200, 150)
+        red, green, blue = thumbnail.getpixel((100, 75))
+        assert red > 200 and blue < 50
+
+    def test_exif_thumbnail_can_be_disabled(self, monkeypatch):
+        monkeypatch.setattr(transformation, "THUMBNAIL_USE_EXIF", False)
+        preview = Image.new("RGB", (400, 300), "blue")
+        contents = create_jpeg((800, 600), "red", preview)
+
+        red, green, blue = open_thumbnail(contents).getpixel((100, 75))
+        assert red > 200 and blue < 50
+
+    def test_animation_is_resized_frame_by_frame(self):
+        frames = [Image.new("RGB", (400, 300), color) for color in ("red", "blue")]
+        contents = BytesIO()
+        frames[0].save(
+            contents, format="GIF", save_all=True, append_images=frames[1:]
+        )
+
+        thumbnail = transform_image(contents.getvalue(), "image/gif", {"size": "40*40"})
+        with Image.open(BytesIO(thumbnail)) as image:
+            assert (image.size, image.n_frames) == ((40, 30), 2)
+
+
+class TestImageSet:
+    def test_sizes_are_downscaled_progressively(self, jpeg_fixture_1, monkeypatch):
+        source_sizes = []
+        original_transform = transformation.transform
+
+        def record_transform(image, params=None):
+            source_sizes.append(image.size)
+            return original_transform(image, params)
+
+        monkeypatch.setattr(transformation, "transform", record_transform)
+        images = transformation.transform_image_set(
+            jpeg_fixture_1,
+            "image/jpeg",
+            {"widths": "100,400,3000,200", "formats": "webp,jpg"},
+        )
+
+        # The original is decoded once, every other size is reduced from the last one.
+        assert source_sizes == [(2000, 2000), (2000, 2000), (400, 400), (200, 200)]
+        assert [(image.width, image.mimetype) for image in images] == [
+            (2000, "image/webp"),
+            (2000, "image/jpeg"),
+            (400, "image/webp"),
+            (400, "image/jpeg"),
+            (200, "image/webp"),
+            (200, "image/jpeg"),
+            (100, "image/webp"),
+            (100, "image/jpeg"),
+        ]
+        for image in images:
+            with Image.open(BytesIO(image.contents)) as decoded:
+                assert decoded.size == (image.width, image.height)
+                assert Image.MIME[decoded.format] == image.mimetype
+
+    @pytest.mark.parametrize(
+        "params",
+        [{}, {"widths": "a,100"}, {"widths": "0"}, {"widths": "100", "formats": "abc"}],
+    )
+    def test_invalid_params_are_rejected(self, jpeg_fixture_1, params):
+        with pytest.raises(ValueError):
+            transformation.transform_image_set(jpeg_fixture_1, "image/jpeg", params)
+
+    def test_images_taller_than_the_output_limit_are_accepted(self, monkeypatch):
+        monkeypatch.setattr(limits, "MAX_OUTPUT_DIMENSION", 1000)
+        contents = BytesIO()
+        Image.new("RGB", (200, 3000)).save(contents, format="JPEG")
+
+        images = transformation.transform_image_set(
+            contents.getvalue(), "image/jpeg", {"widths": "200,20"}
+        )
+        assert [(image.width, image.height) for image in images] == [
+            (67, 1000),
+            (20, 299),
+        ]
+
+    def test_animations_keep_their_frames(self):
+        frames = [Image.new("RGB", (400, 300), color) for color in ("red", "blue")]
+        contents = BytesIO()
+        frames[0].save(
+            contents, format="GIF", save_all=True, append_images=frames[1:]
+        )
+
+        images = transformation.transform_image_set(
+            contents.getvalue(), "image/gif", {"widths": "200,40", "formats": "gif,png"}
+        )
+        assert [(image.width, image.height) for image in images] == [
+            (200, 150),
+            (200, 150),
+            (40, 30),
+            (40, 30),
+        ]
+        with Image.open(BytesIO(images[2].contents)) as image:
+            assert image.n_frames == 2
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+from ProgImage.storage import file as file_storage, tiered
+
+
+@pytest.fixture
+def tiered_storage(tmp_path, monkeypatch, mock_s3_storage):
+    monkeypatch.setattr(file_storage, "storage_path", tmp_path)
+    monkeypatch.setattr(file_storage, "images_path", tmp_path / "images")
+    monkeypatch.setattr(file_storage, "metadata_path", tmp_path / "metadata")
+    monkeypatch.setattr(
+        tiered, "cache_index", tiered.CacheIndex(max_size=10_000_000, max_age=3600)
+    )
+    yield tiered
+
+
+class TestTieredStorage:
+    def test_stored_images_are_cached(self, tiered_storage, jpeg_fixture_1):
+        image_id = tiered_storage.store(jpeg_fixture_1, "image/jpeg")
+
+        assert file_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+        assert tiered_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+        assert tiered_storage.stats()["hits"] == 1
+        assert tiered_storage.stats()["bytes_saved"] == len(jpeg_fixture_1)
+
+    def test_misses_are_read_through(
+        self, tiered_storage, mock_s3_storage, jpeg_fixture_1
+    ):
+        mock_s3_storage.put_object(
+            Bucket="test-bucket",
+            Key="images/original",
+            Body=jpeg_fixture_1,
+            ContentType="image/jpeg",
+            Metadata={"width": "2000"},
+        )
+
+        stream, mimetype = tiered_storage.retrieve_stream("original")
+        assert (stream.read(), mimetype) == (jpeg_fixture_1, "image/jpeg")
+        assert tiered_storage.retrieve("original") == (jpeg_fixture_1, "image/jpeg")
+
+        metadata = tiered_storage.retrieve_metadata("original")
+        assert metadata["Width"] == 2000
+        assert metadata["Last-Modified"] == (
+            tiered.s3.retrieve_metadata("original")["Last-Modified"]
+        )
+
+        stats = tiered_storage.stats()
+        assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+        with pytest.raises(FileNotFoundError):
+            tiered_storage.retrieve("unknown")
+
+    def test_concurrent_misses_are_fetched_once(
+        self, tiered_storage, monkeypatch, jpeg_fixture_1
+    ):
+        image_id = tiered.s3.store(jpeg_fixture_1, "image/jpeg")
+        fetches = []
+        retrieve_with_metadata = tiered.s3.retrieve_with_metadata
+
+        def slow_retrieve(image_id):
+            fetches.append(image_id)
+            time.sleep(0.2)
+            return retrieve_with_metadata(image_id)
+
+        monkeypatch.setattr(tiered.s3, "retrieve_with_metadata", slow_retrieve)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(tiered_storage.retrieve(image_id))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert fetches == [image_id]
+        assert results == [(jpeg_fixture_1, "image/jpeg")] * 5
+
+    def test_cache_is_bounded_by_size_and_age(self, tiered_storage, monkeypatch):
+        monkeypatch.setattr(
+            tiered, "cache_index", tiered.CacheIndex(max_size=10, max_age=3600)
+        )
+        first_id = tiered_storage.store(b"123456", "image/gif")
+        second_id = tiered_storage.store(b"123456", "image/gif")
+
+        assert not file_storage.exists(first_id)
+        assert file_storage.exists(second_id)
+        assert tiered_storage.retrieve(first_id) == (b"123456", "image/gif")
+        assert not file_storage.exists(second_id)
+
+        tiered.cache_index.max_age = 0
+        assert tiered_storage.retrieve(first_id) == (b"123456", "image/gif")
+        assert tiered_storage.stats()["evictions"] == 3
+
+    def test_index_is_loaded_from_cache(self, tiered_storage, jpeg_fixture_1):
+        image_id = tiered_storage.store(jpeg_fixture_1, "image/jpeg")
+        tiered.cache_index.clear()
+
+        assert tiered_storage.retrieve(image_id) == (jpeg_fixture_1, "image/jpeg")
+        assert tiered_storage.stats()["hits"] == 1
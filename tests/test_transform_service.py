@@ -0,0 +1,217 @@
+import os
+import time
+from io import BytesIO
+
+import pytest
+from flask import Flask
+from PIL import Image
+from werkzeug.exceptions import HTTPException
+
+from ProgImage import formats, server
+from ProgImage.server import TransformExecutor
+from ProgImage.thumbnail_service.transformation import transform_image
+
+
+def slow_transform(contents, mimetype, params=None):
+    time.sleep(float(params.get("sleep", 1)))
+    return contents
+
+
+def crashing_transform(contents, mimetype, params=None):
+    os._exit(1)
+
+
+@pytest.fixture
+def transform_app(monkeypatch):
+    # The services share the app of ProgImage.server, use a separate one in tests.
+    app = Flask(__name__)
+    app.register_blueprint(server.transform_blueprint)
+    app.register_error_handler(HTTPException, server.generic_error_response)
+    monkeypatch.setattr(server, "transform_function", transform_image)
+    yield app
+
+
+@pytest.fixture
+def process_pool(monkeypatch):
+    executor = TransformExecutor(processes=1, queue_size=0, timeout=5)
+    monkeypatch.setattr(server, "transform_executor", executor)
+    yield executor
+    executor.shutdown()
+
+
+class TestTransformService:
+    def test_transform_in_request_thread(self, transform_app, jpeg_fixture_1):
+        with transform_app.test_client() as client:
+            response = client.post(
+                "/transform/?size=100*100",
+                data=jpeg_fixture_1,
+                content_type="image/jpeg",
+            )
+            assert response.status_code == 200, response.data
+            assert Image.open(BytesIO(response.data)).size == (100, 100)
+
+    @pytest.mark.usefixtures("process_pool")
+    def test_transform_in_process_pool(self, transform_app, jpeg_fixture_1):
+        with transform_app.test_client() as client:
+            response = client.post(
+                "/transform/?size=100*100",
+                data=jpeg_fixture_1,
+                content_type="image/jpeg",
+            )
+            assert response.status_code == 200, response.data
+            assert Image.open(BytesIO(response.data)).size == (100, 100)
+
+            response = client.post(
+                "/transform/?size=a*b", data=jpeg_fixture_1, content_type="image/jpeg"
+            )
+            assert response.status_code == 400, response.data
+
+    def test_saturated_pool_results_in_503(
+        self, transform_app, process_pool, monkeypatch
+    ):
+        monkeypatch.setattr(server, "transform_function", slow_transform)
+        future = process_pool._get_pool().submit(time.sleep, 0)
+        future.result()  # Make sure the worker process is running.
+
+        assert process_pool._slots.acquire(blocking=False)
+        try:
+            with transform_app.test_client() as client:
+                response = client.post(
+                    "/transform/", data=b"image", content_type="image/jpeg"
+                )
+                assert response.status_code == 503, response.data
+                assert response.headers["Retry-After"] == "1"
+                assert response.is_json
+        finally:
+            process_pool._slots.release()
+
+    def test_dead_worker_results_in_503(self, transform_app, process_pool, monkeypatch):
+        monkeypatch.setattr(server, "transform_function", crashing_transform)
+        with transform_app.test_client() as client:
+            response = client.post(
+                "/transform/", data=b"image", content_type="image/jpeg"
+            )
+            assert response.status_code == 503, response.data
+            assert response.headers["Retry-After"] == "1"
+
+            # The broken pool is replaced by a new one.
+            monkeypatch.setattr(server, "transform_function", slow_transform)
+            response = client.post(
+                "/transform/?sleep=0", data=b"image", content_type="image/jpeg"
+            )
+            assert response.status_code == 200, response.data
+            assert response.data == b"image"
+
+    def test_slow_transformation_times_out(
+        self, transform_app, process_pool, monkeypatch
+    ):
+        monkeypatch.setattr(server, "transform_function", slow_transform)
+        process_pool.timeout = 0.1
+
+        with transform_app.test_client() as client:
+            response = client.post(
+                "/transform/?sleep=1", data=b"image", content_type="image/jpeg"
+            )
+            assert response.status_code == 504, response.data
+
+    def test_repository_transform_is_revalidated(
+        self, transform_app, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository import ImageRepository
+
+        image_path = ImageRepository().store(jpeg_fixture_1)
+
+        with transform_app.test_client() as client:
+            response = client.get(f"/transform/{image_path}?size=100*100")
+            assert response.status_code == 200, response.data
+            etag = response.headers["ETag"]
+
+            response = client.get(f"/transform/{image_path}?size=50*50")
+            assert response.headers["ETag"] != etag
+
+            def fail(*args, **kwargs):
+                raise AssertionError("The image shouldn't be fetched.")
+
+            monkeypatch.setattr(ImageRepository, "retrieve", fail)
+
+            response = client.get(
+                f"/transform/{image_path}?size=100*100",
+                headers={"If-None-Match": etag},
+            )
+            assert response.status_code == 304
+            assert response.headers["ETag"] == etag
+
+    def test_repository_transform_etag_depends_on_format_and_profile(
+        self, transform_app, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository import ImageRepository
+
+        image_path = ImageRepository().store(jpeg_fixture_1)
+        webp_path = image_path.replace(".jpg", ".webp")
+
+        with transform_app.test_client() as client:
+            etags = [
+                client.get(f"/transform/{path}?size=100*100").headers["ETag"]
+                for path in (image_path, webp_path)
+            ]
+            monkeypatch.setattr(formats, "ENCODING_PROFILE", "small")
+            etags.append(
+                client.get(f"/transform/{image_path}?size=100*100").headers["ETag"]
+            )
+
+        assert len(set(etags)) == 3
+
+    def test_image_set_is_stored_in_one_batch(
+        self, transform_app, mock_s3_storage, jpeg_fixture_1, monkeypatch
+    ):
+        from ProgImage.repository import ImageRepository, metadata_index, storage_engine
+        from ProgImage.thumbnail_service.image_set import image_set_blueprint
+
+        transform_app.register_blueprint(image_set_blueprint)
+        image_path = ImageRepository().store(jpeg_fixture_1)
+
+        batches = []
+        store_many = storage_engine.store_many
+
+        def record_batch(images):
+            batches.append(len(images))
+            return store_many(images)
+
+        monkeypatch.setattr(storage_engine, "store_many", record_batch)
+
+        with transform_app.test_client() as client:
+            response = client.post(
+                f"/transform-set/{image_path}?widths=100,50&formats=webp,png"
+            )
+            assert response.status_code == 201, response.data
+            assert batches == [4]
+
+            manifest = response.json
+            assert manifest["source"] == image_path
+            assert [
+                (image["width"], image["height"], image["mimetype"])
+                for image in manifest["images"]
+            ] == [
+                (100, 100, "image/webp"),
+                (100, 100, "image/png"),
+                (50, 50, "image/webp"),
+                (50, 50, "image/png"),
+            ]
+
+            location = manifest["images"][1]["location"]
+            assert location.startswith("http://localhost/transform/")
+            response = client.get(location)
+            assert response.status_code == 200, response.data
+            assert response.headers["Content-Type"] == "image/png"
+            assert Image.open(BytesIO(response.data)).size == (100, 100)
+
+            metadata_index.clear()
+            stored_path = manifest["images"][1]["id"]
+            assert stored_path.endswith(".png")
+            metadata = ImageRepository().metadata(stored_path)
+            assert (metadata["Width"], metadata["Content-Type"]) == (100, "image/png")
+
+            response = client.post(f"/transform-set/{image_path}?widths=a")
+            assert response.status_code == 400
+            response = client.post("/transform-set/unknown.jpg?widths=100")
+            assert response.status_code == 404
@@ -0,0 +1,223 @@
+import json
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+import pytest
+from PIL import Image
+
+from ProgImage.repository import EXIF_ORIENTATION
+from ProgImage.repository_service import transformations
+from ProgImage.repository_service.transformations import (
+    ImageTransformation,
+    Transformations,
+)
+from ProgImage.thumbnail_service import transformation as thumbnail
+
+
+class TestLocalTransformations:
+    @pytest.mark.usefixtures("local_mode", "s3_jpeg_fixture_1")
+    def test_chain_is_applied_in_process(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get(
+                "/images/test-file-1.png?thumbnail-size=100*50&rotate-transpose=90"
+            )
+            assert response.status_code == 200, response.data
+            assert response.headers["Content-Type"] == "image/png"
+
+            image = Image.open(BytesIO(response.data))
+            assert image.format == "PNG"
+            assert image.size == (50, 50)
+
+    @pytest.mark.usefixtures("local_mode", "s3_jpeg_fixture_1")
+    def test_invalid_options_result_in_400(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get("/images/test-file-1.jpg?rotate-transpose=45")
+            assert response.status_code == 400, response.data
+
+    @pytest.mark.usefixtures("local_mode", "s3_jpeg_fixture_1")
+    def test_bulk_stores_result(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post(
+                "/bulk/", json={"test-file-1.jpg": {"thumbnail-size": "10*10"}}
+            )
+            assert response.status_code == 200, response.data
+            image_path = json.loads(response.data)["test-file-1.jpg"]
+
+            response = client.get(f"/images/{image_path}")
+            assert response.status_code == 200, response.data
+            assert Image.open(BytesIO(response.data)).size == (10, 10)
+
+    @pytest.mark.usefixtures("local_mode")
+    def test_falls_back_to_remote_service(
+        self, monkeypatch, requests_mock, jpeg_fixture_1
+    ):
+        monkeypatch.delitem(
+            transformations.local_transformations, ImageTransformation.ROTATE
+        )
+        monkeypatch.setitem(
+            transformations.transformation_urls,
+            ImageTransformation.ROTATE,
+            "http://rotation/",
+        )
+        requests_mock.post(
+            "http://rotation/transform/",
+            content=b"rotated",
+            headers={"Content-Type": "image/jpeg"},
+        )
+
+        chain = Transformations.from_query_params(
+            {"thumbnail-size": "10*10", "rotate-angle": "90"}
+        )
+        assert chain.apply(jpeg_fixture_1, "image/jpeg") == (b"rotated", "image/jpeg")
+
+        thumbnail = Image.open(BytesIO(requests_mock.last_request.body))
+        assert thumbnail.size == (10, 10)
+        assert requests_mock.last_request.qs == {"angle": ["90"]}
+
+
+def oriented_jpeg() -> BytesIO:
+    # 400x200 with a blue top left corner, shown rotated by 90 degrees clockwise.
+    image = Image.new("RGB", (400, 200), "red")
+    image.paste((0, 0, 255), (0, 0, 100, 100))
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    contents = BytesIO()
+    image.save(contents, "JPEG", exif=exif.tobytes())
+    return contents
+
+
+def parse(query: str) -> Transformations:
+    return Transformations.from_query_params(parse_qsl(query, keep_blank_values=True))
+
+
+class TestPipeline:
+    def test_steps_keep_the_order_of_the_parameters(self):
+        chain = parse("rotate-angle=90&rotate-transpose=180&grayscale&rotate-angle=10")
+        assert chain.key == (
+            "rotate(angle=90,transpose=180);grayscale();rotate(angle=10)"
+        )
+
+    @pytest.mark.parametrize(
+        "query", ["thumbnail-width=10", "crop=1", "auto-orient-exif=1"]
+    )
+    def test_unknown_parameters_are_rejected(self, query):
+        with pytest.raises(ValueError, match="transformation"):
+            parse(query)
+
+    def test_downscaling_moves_before_rotation(self):
+        chain = parse("rotate-transpose=90&thumbnail-size=200*100").plan({})
+        assert chain.key == "thumbnail(size=100*200);rotate(transpose=90)"
+
+    def test_rotations_are_folded(self):
+        chain = parse("rotate-transpose=90&rotate-transpose=180&rotate-angle=30")
+        assert chain.plan({}).key == "rotate(angle=30,transpose=270)"
+        assert parse("rotate-angle=30&rotate-angle=330").plan({}).key == ""
+
+    def test_noops_are_dropped(self):
+        metadata = {"Width": 400, "Height": 200, "Orientation": None, "Mode": "L"}
+        chain = parse(
+            "auto-orient&grayscale&crop-box=0,0,400,500&thumbnail-size=500*500"
+        )
+        assert chain.plan(metadata).key == ""
+
+    def test_format_is_applied_last(self):
+        chain = parse("format=png&thumbnail-size=10*10&format=webp").plan({})
+        assert chain.key == "thumbnail(size=10*10);format(type=webp)"
+        assert chain.output_mimetype == "image/webp"
+
+    def test_options_are_checked_against_the_size(self):
+        with pytest.raises(ValueError, match="outside of the image"):
+            parse("crop-box=500,0,10,10").plan({"Width": 400, "Height": 200})
+
+    @pytest.mark.usefixtures("local_mode")
+    def test_planned_chain_has_the_same_result(self):
+        contents = oriented_jpeg()
+
+        chain = parse("auto-orient&grayscale&thumbnail-size=100*100&format=png")
+        planned = chain.plan({"Width": 400, "Height": 200, "Orientation": 6})
+        assert planned.key.startswith("thumbnail(size=100*100);auto_orient()")
+
+        results = [
+            Image.open(BytesIO(transformed))
+            for transformed, mimetype in (
+                chain.apply(contents.getvalue(), "image/jpeg"),
+                planned.apply(contents.getvalue(), "image/jpeg"),
+            )
+        ]
+        for result in results:
+            assert (result.format, result.size, result.mode) == ("PNG", (50, 100), "L")
+            assert EXIF_ORIENTATION not in result.getexif()
+            # Rotated clockwise, the (darker) blue corner is at the top right.
+            assert result.getpixel((45, 5)) < result.getpixel((5, 5))
+
+    def test_auto_orientation_stays_first_if_a_service_strips_exif(
+        self, monkeypatch, requests_mock
+    ):
+        monkeypatch.setitem(
+            transformations.transformation_urls,
+            ImageTransformation.THUMBNAIL,
+            "http://thumbnail/",
+        )
+        requests_mock.post(
+            "http://thumbnail/transform/",
+            headers={"Content-Type": "image/jpeg"},
+            content=lambda request, context: thumbnail.transform_image(
+                request.body,
+                "image/jpeg",
+                {name: values[0] for name, values in request.qs.items()},
+            ),
+        )
+        metadata = {"Width": 400, "Height": 200, "Orientation": 6}
+
+        chain = parse("auto-orient&thumbnail-size=100*100&profile=fast")
+        planned = chain.plan(metadata)
+        assert planned.key.startswith("auto_orient();thumbnail(size=100*100)")
+        transformed, _ = planned.apply(oriented_jpeg().getvalue(), "image/jpeg")
+        assert Image.open(BytesIO(transformed)).size == (50, 100)
+
+        # The balanced profile keeps the EXIF data, the thumbnail can move first.
+        chain = parse("auto-orient&thumbnail-size=100*100&profile=balanced")
+        assert chain.plan(metadata).key.startswith("thumbnail(size=100*100)")
+
+    @pytest.mark.usefixtures("s3_jpeg_fixture_1")
+    def test_new_operations_run_in_process_in_remote_mode(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.get(
+                "/images/test-file-1.jpg?crop-box=0,0,300,200"
+                "&resize-width=150&grayscale&format=webp"
+            )
+            assert response.status_code == 200, response.data
+            assert response.headers["Content-Type"] == "image/webp"
+
+            image = Image.open(BytesIO(response.data))
+            assert image.size == (150, 100)
+            assert len(set(image.convert("RGB").getpixel((10, 10)))) == 1
+
+    @pytest.mark.usefixtures("local_mode", "s3_jpeg_fixture_1")
+    def test_bulk_steps_can_repeat(self):
+        from ProgImage.repository_service.server import app
+
+        with app.test_client() as client:
+            response = client.post(
+                "/bulk/",
+                json={
+                    "test-file-1.jpg": [
+                        ["resize-width", "100"],
+                        ["rotate-transpose", "90"],
+                        ["resize-width", "20"],
+                    ]
+                },
+            )
+            assert response.status_code == 200, response.data
+            image_path = json.loads(response.data)["test-file-1.jpg"]
+
+            response = client.get(f"/images/{image_path}")
+            assert Image.open(BytesIO(response.data)).size == (20, 20)